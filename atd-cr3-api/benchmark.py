@@ -0,0 +1,360 @@
+#
+# ATD - CR3 Download API - Load Test Benchmark
+#
+# Starts the API under several servers and worker/thread configurations,
+# against a local S3 stand-in (moto) and a fake Auth0 tenant (a JWKS served
+# locally and tokens signed with its key), then drives it with concurrent
+# clients and reports requests/s and latency percentiles per route.
+#
+# Usage:
+#   python benchmark.py
+#   python benchmark.py --servers flask waitress:16 gunicorn:4x4 --clients 32 --duration 20
+#
+# Server configurations:
+#   flask           The Flask dev server, threaded (one thread per request)
+#   flask-single    The Flask dev server, a single thread
+#   waitress:T      waitress with T threads (pip install waitress)
+#   gunicorn:WxT    gunicorn with W workers of T threads (pip install gunicorn)
+#
+
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import socket
+import argparse
+import threading
+import subprocess
+import http.client
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import rsa
+from jose import jwt
+
+AUTH0_DOMAIN = "benchmark.local"
+CLIENT_ID = "atd-cr3-api-benchmark"
+AWS_S3_BUCKET = "atd-cr3-benchmark"
+AWS_S3_CR3_LOCATION = "benchmark/cris-cr3-files"
+DEFAULT_SERVERS = ["flask", "flask-single", "waitress:4", "waitress:16", "gunicorn:4x1", "gunicorn:4x4"]
+ROUTES = ["health", "download", "batch"]
+
+
+def b64_int(value):
+    """Encodes an integer as base64url, as in a JWK
+    """
+    return base64.urlsafe_b64encode(value.to_bytes((value.bit_length() + 7) // 8, "big")).rstrip(b"=").decode()
+
+
+class FakeAuth0:
+    """Serves a JWKS on a local port and signs tokens with its key, as
+    an Auth0 tenant would
+    """
+    def __init__(self):
+        public_key, self.private_key = rsa.newkeys(2048)
+        self.kid = uuid.uuid4().hex
+        jwks = json.dumps({"keys": [{
+            "kty": "RSA", "use": "sig", "alg": "RS256", "kid": self.kid,
+            "n": b64_int(public_key.n), "e": b64_int(public_key.e)
+        }]}).encode()
+
+        class JwksHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(jwks)))
+                self.end_headers()
+                self.wfile.write(jwks)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), JwksHandler)
+        self.url = "http://127.0.0.1:%s/.well-known/jwks.json" % self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def token(self, subject, expires_in=3600):
+        """Returns an access token for the API
+        """
+        now = int(time.time())
+        return jwt.encode({
+            "iss": "https://" + AUTH0_DOMAIN + "/",
+            "aud": CLIENT_ID,
+            "sub": subject,
+            "iat": now,
+            "exp": now + expires_in,
+        }, self.private_key.save_pkcs1().decode(), algorithm="RS256", headers={"kid": self.kid})
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def start_s3(endpoint_url):
+    """Starts a moto server as the S3 stand-in, with a CR3 in the bucket,
+    unless an endpoint is given. Returns the endpoint and the moto server.
+    """
+    if endpoint_url:
+        return endpoint_url, None
+    try:
+        import boto3
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        # The API only signs URLs, so any endpoint works without the sanity check
+        print("moto is not installed, the URLs are signed for a placeholder endpoint.")
+        return "http://127.0.0.1:9", None
+
+    port = free_port()
+    moto_server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    moto_server.start()
+    endpoint_url = "http://127.0.0.1:%s" % port
+    s3 = boto3.client("s3", region_name="us-east-1", endpoint_url=endpoint_url,
+                      aws_access_key_id="benchmark", aws_secret_access_key="benchmark")
+    s3.create_bucket(Bucket=AWS_S3_BUCKET)
+    s3.put_object(Bucket=AWS_S3_BUCKET, Key=AWS_S3_CR3_LOCATION + "/1.pdf", Body=b"%PDF-1.4 benchmark")
+    return endpoint_url, moto_server
+
+
+def free_port():
+    """Returns a free local TCP port
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_command(config, port):
+    """Returns the command that serves the API for a server configuration
+    """
+    name, _, option = config.partition(":")
+    if name in ["flask", "flask-single"]:
+        return [sys.executable, "-c",
+                "import server; server.APP.run(host='127.0.0.1', port=%s, threaded=%s)" % (port, name == "flask")]
+    if name == "waitress":
+        return [sys.executable, "-m", "waitress", "--listen=127.0.0.1:%s" % port,
+                "--threads=%s" % (option or "4"), "server:APP"]
+    if name == "gunicorn":
+        workers, _, threads = (option or "4x1").partition("x")
+        return [sys.executable, "-m", "gunicorn", "--bind", "127.0.0.1:%s" % port,
+                "--workers", workers, "--threads", threads or "1", "--log-level", "warning", "server:APP"]
+    raise ValueError("Unknown server configuration: %s" % config)
+
+
+def server_available(config):
+    """Checks the server of a configuration is installed
+    """
+    name = config.partition(":")[0]
+    if name in ["waitress", "gunicorn"]:
+        try:
+            __import__(name)
+        except ImportError:
+            return False
+    return True
+
+
+def start_api(config, port, env):
+    """Starts the API and waits for the health check to respond
+    """
+    process = subprocess.Popen(server_command(config, port), env=env,
+                               cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise Exception("The server exited with code %s" % process.returncode)
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/")
+            if connection.getresponse().status == 200:
+                connection.close()
+                return process
+        except (ConnectionError, OSError):
+            time.sleep(0.1)
+    stop_api(process)
+    raise Exception("The server did not start in 30 seconds")
+
+
+def stop_api(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def build_request(route, token, client, batch_size):
+    """Returns the method, path, body and headers of a request to a route
+    """
+    headers = {"Authorization": "Bearer " + token}
+    if route == "health":
+        return "GET", "/", None, {}
+    if route == "download":
+        return "GET", "/cr3/download/%s" % (client + 1), None, headers
+    body = json.dumps({"crash_ids": list(range(client * batch_size + 1, (client + 1) * batch_size + 1))})
+    headers["Content-Type"] = "application/json"
+    return "POST", "/cr3/download/batch", body, headers
+
+
+def run_clients(port, route, tokens, clients, duration, batch_size):
+    """Sends requests to a route from concurrent clients, each with its own
+    keep-alive connection, for a number of seconds
+    Returns the latencies of the successful requests and the error count.
+    """
+    latencies = [[] for _ in range(clients)]
+    errors = [0] * clients
+    start_event = threading.Event()
+
+    def client_loop(client):
+        method, path, body, headers = build_request(route, tokens[client % len(tokens)], client, batch_size)
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        start_event.wait()
+        deadline = time.perf_counter() + duration
+        while True:
+            started = time.perf_counter()
+            if started >= deadline:
+                break
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status == 200:
+                    latencies[client].append(time.perf_counter() - started)
+                else:
+                    errors[client] += 1
+            except (http.client.HTTPException, OSError):
+                errors[client] += 1
+                connection.close()
+        connection.close()
+
+    threads = [threading.Thread(target=client_loop, args=(client,)) for client in range(clients)]
+    for thread in threads:
+        thread.start()
+    start_event.set()
+    for thread in threads:
+        thread.join()
+    return [latency for client in latencies for latency in client], sum(errors)
+
+
+def percentile(values, fraction):
+    """Returns a percentile of a sorted list
+    """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def summarize(config, route, latencies, errors, duration):
+    latencies = sorted(latencies)
+    return {
+        "server": config,
+        "route": route,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / duration,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p90_ms": percentile(latencies, 0.90) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": (latencies[-1] if latencies else 0) * 1000,
+    }
+
+
+def print_results(results):
+    print("\n%-14s %-9s %9s %7s %9s %8s %8s %8s %8s" % (
+        "server", "route", "requests", "errors", "req/s", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for r in results:
+        print("%-14s %-9s %9d %7d %9.1f %8.2f %8.2f %8.2f %8.2f" % (
+            r["server"], r["route"], r["requests"], r["errors"], r["rps"],
+            r["p50_ms"], r["p90_ms"], r["p99_ms"], r["max_ms"]))
+
+
+def check_download(port, token, endpoint_url):
+    """Downloads the CR3 in the S3 stand-in with a URL from the API,
+    to make sure the benchmark measures working responses
+    """
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    connection.request("GET", "/cr3/download/1", headers={"Authorization": "Bearer " + token})
+    response = connection.getresponse()
+    if response.status != 200:
+        raise Exception("The download route returned %s: %s" % (response.status, response.read()))
+    url = json.loads(response.read())["message"]
+    if not url.startswith(endpoint_url) or endpoint_url == "http://127.0.0.1:9":
+        return
+    from urllib.request import urlopen
+    with urlopen(url, timeout=10) as pdf:
+        if not pdf.read().startswith(b"%PDF"):
+            raise Exception("The presigned URL did not return the CR3")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the CR3 Download API")
+    parser.add_argument("--servers", nargs="+", default=DEFAULT_SERVERS,
+                        help="Server configurations (default: %s)" % " ".join(DEFAULT_SERVERS))
+    parser.add_argument("--routes", nargs="+", default=ROUTES, choices=ROUTES)
+    parser.add_argument("--clients", type=int, default=16, help="Concurrent clients (default: 16)")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per route (default: 10)")
+    parser.add_argument("--warmup", type=float, default=1, help="Warm up seconds per route (default: 1)")
+    parser.add_argument("--tokens", type=int, default=100,
+                        help="Distinct access tokens, shared by the clients (default: 100)")
+    parser.add_argument("--batch-size", type=int, default=100, help="Crash ids per batch request (default: 100)")
+    parser.add_argument("--s3-endpoint", default="", help="Use this S3 endpoint instead of starting moto")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+    for config in args.servers:
+        try:
+            server_command(config, 0)
+        except ValueError as e:
+            parser.error(str(e))
+
+    auth0 = FakeAuth0()
+    tokens = [auth0.token("benchmark|%s" % i) for i in range(max(1, args.tokens))]
+    endpoint_url, moto_server = start_s3(args.s3_endpoint)
+    env = dict(os.environ,
+               AUTH0_DOMAIN=AUTH0_DOMAIN,
+               CLIENT_ID=CLIENT_ID,
+               AUTH0_JWKS_URL=auth0.url,
+               AWS_S3_KEY="benchmark",
+               AWS_S3_SECRET="benchmark",
+               AWS_S3_BUCKET=AWS_S3_BUCKET,
+               AWS_S3_CR3_LOCATION=AWS_S3_CR3_LOCATION,
+               AWS_S3_ENDPOINT_URL=endpoint_url,
+               CR3_BATCH_MAX_SIZE=str(max(500, args.batch_size)))
+
+    print("Fake Auth0 JWKS: %s, S3: %s" % (auth0.url, endpoint_url))
+    print("%s clients, %s seconds per route, %s tokens, %s crash ids per batch" % (
+        args.clients, args.duration, len(tokens), args.batch_size))
+
+    results = []
+    try:
+        for config in args.servers:
+            if not server_available(config):
+                print("Skipping %s, the server is not installed" % config)
+                continue
+            port = free_port()
+            print("\nStarting %s on port %s" % (config, port))
+            process = start_api(config, port, env)
+            try:
+                check_download(port, tokens[0], endpoint_url)
+                for route in args.routes:
+                    if args.warmup > 0:
+                        run_clients(port, route, tokens, args.clients, args.warmup, args.batch_size)
+                    latencies, errors = run_clients(port, route, tokens, args.clients, args.duration, args.batch_size)
+                    result = summarize(config, route, latencies, errors, args.duration)
+                    results.append(result)
+                    print("  %-9s %9.1f req/s, p50 %.2f ms, p99 %.2f ms, %s errors" % (
+                        route, result["rps"], result["p50_ms"], result["p99_ms"], errors))
+            finally:
+                stop_api(process)
+    finally:
+        auth0.stop()
+        if moto_server is not None:
+            moto_server.stop()
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
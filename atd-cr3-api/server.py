@@ -4,13 +4,16 @@
 
 import json
 import re
+import time
 import datetime
+import threading
 import boto3
 import os
 
 from dotenv import load_dotenv, find_dotenv
 from os import environ as env
 from functools import wraps
+from collections import OrderedDict
 from six.moves.urllib.request import urlopen
 
 from flask import Flask, request, redirect, jsonify, _request_ctx_stack
@@ -29,12 +32,22 @@ AUTH0_DOMAIN = os.getenv("AUTH0_DOMAIN", "")
 CLIENT_ID = os.getenv("CLIENT_ID", "")
 API_ENVIRONMENT = os.getenv("API_ENVIRONMENT", "STAGING")
 
+# JWKS and verified token caches
+AUTH0_JWKS_URL = os.getenv("AUTH0_JWKS_URL", "https://" + AUTH0_DOMAIN + "/.well-known/jwks.json")
+JWKS_CACHE_TTL = int(os.getenv("JWKS_CACHE_TTL", "3600"))  # seconds
+JWKS_MIN_REFRESH_INTERVAL = int(os.getenv("JWKS_MIN_REFRESH_INTERVAL", "30"))  # seconds
+JWKS_TIMEOUT = int(os.getenv("JWKS_TIMEOUT", "5"))  # seconds
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "1000"))
+
 # AWS Configuration
 AWS_DEFALUT_REGION = os.getenv("AWS_DEFALUT_REGION", "us-east-1")
 AWS_S3_KEY = os.getenv("AWS_S3_KEY", "")
 AWS_S3_SECRET = os.getenv("AWS_S3_SECRET", "")
 AWS_S3_CR3_LOCATION = os.getenv("AWS_S3_CR3_LOCATION", "")
 AWS_S3_BUCKET = os.getenv("AWS_S3_BUCKET", "")
+AWS_S3_ENDPOINT_URL = os.getenv("AWS_S3_ENDPOINT_URL", "")  # ie. a local S3 stand-in
+CR3_URL_EXPIRATION = int(os.getenv("CR3_URL_EXPIRATION", "60"))  # seconds
+CR3_BATCH_MAX_SIZE = int(os.getenv("CR3_BATCH_MAX_SIZE", "500"))
 
 
 
@@ -58,6 +71,148 @@ def handle_auth_error(ex):
     return response
 
 
+class JwksCache:
+    """Keeps the JSON Web Key Set of the Auth0 tenant in memory. The set is
+    downloaded again when it is older than the TTL, or when a token is signed
+    with an unknown key id (at most once every min_refresh_interval seconds).
+    Only one thread downloads it at a time: while there are keys to serve the
+    others keep using them, otherwise they wait for its result. After a failed
+    download the next attempt waits min_refresh_interval seconds.
+    """
+    def __init__(self, url, ttl, min_refresh_interval, timeout):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.keys = {}
+        self.fetched_at = 0
+        self.attempted_at = 0
+        self.lock = threading.Lock()
+
+    def fetch(self):
+        """Downloads the key set, must be called with the lock held
+        """
+        jsonurl = urlopen(self.url, timeout=self.timeout)
+        jwks = json.loads(jsonurl.read())
+        self.keys = {key["kid"]: key for key in jwks["keys"]}
+        self.fetched_at = time.time()
+
+    def refresh(self, requested_at, force):
+        """Downloads the key set, unless another thread tried since requested_at
+        """
+        if not self.lock.acquire(blocking=force or not self.keys):
+            # Another thread is downloading, keep serving the current keys
+            return
+        try:
+            if self.attempted_at > requested_at:
+                return
+            now = time.time()
+            since_attempt = now - self.attempted_at
+            if force and since_attempt < self.min_refresh_interval:
+                return
+            if not force and now - self.fetched_at < self.ttl:
+                return
+            # Back off after a failed download
+            if self.attempted_at > self.fetched_at and since_attempt < self.min_refresh_interval:
+                return
+            self.attempted_at = now
+            try:
+                self.fetch()
+            except Exception:
+                # Keep serving the previous keys, if there are any
+                if not self.keys:
+                    raise
+        finally:
+            self.lock.release()
+
+    def get_key(self, kid):
+        """Returns the key with a key id, or None. Raises an exception when
+        there are no keys at all
+        """
+        now = time.time()
+        if now - self.fetched_at >= self.ttl:
+            self.refresh(now, force=False)
+        key = self.keys.get(kid)
+        if key is None:
+            self.refresh(now, force=True)
+            key = self.keys.get(kid)
+        if key is None and not self.keys:
+            raise Exception("The signing keys are not available")
+        return key
+
+
+class TokenCache:
+    """Bounded LRU of the payloads of tokens that were already verified,
+    each entry expires with its token
+    """
+    def __init__(self, size):
+        self.size = size
+        self.payloads = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, token):
+        with self.lock:
+            entry = self.payloads.get(token)
+            if entry is None:
+                return None
+            payload, expires_at = entry
+            if expires_at <= time.time():
+                del self.payloads[token]
+                return None
+            self.payloads.move_to_end(token)
+            return payload
+
+    def put(self, token, payload):
+        if self.size <= 0 or "exp" not in payload:
+            return
+        with self.lock:
+            self.payloads[token] = (payload, payload["exp"])
+            self.payloads.move_to_end(token)
+            while len(self.payloads) > self.size:
+                self.payloads.popitem(last=False)
+
+
+S3_CLIENT = None
+S3_CLIENT_LOCK = threading.Lock()
+
+
+def get_s3_client():
+    """Returns the S3 client shared by every request, boto3 clients are
+    thread-safe but expensive to create
+    """
+    global S3_CLIENT
+    with S3_CLIENT_LOCK:
+        if S3_CLIENT is None:
+            S3_CLIENT = boto3.client(
+                "s3",
+                region_name=AWS_DEFALUT_REGION,
+                aws_access_key_id=AWS_S3_KEY,
+                aws_secret_access_key=AWS_S3_SECRET,
+                endpoint_url=AWS_S3_ENDPOINT_URL or None
+            )
+        return S3_CLIENT
+
+
+def get_cr3_url(crash_id):
+    """Returns a presigned download URL for the CR3 of a crash, the
+    signature is computed locally
+    Args:
+        crash_id (str): The crash id, only digits
+    """
+    return get_s3_client().generate_presigned_url(
+        ExpiresIn=CR3_URL_EXPIRATION,
+        ClientMethod='get_object',
+        Params={
+            'Bucket': AWS_S3_BUCKET,
+            'Key': AWS_S3_CR3_LOCATION + "/" + crash_id + ".pdf"
+        }
+    )
+
+
+JWKS_CACHE = JwksCache(AUTH0_JWKS_URL, JWKS_CACHE_TTL, JWKS_MIN_REFRESH_INTERVAL, JWKS_TIMEOUT)
+TOKEN_CACHE = TokenCache(TOKEN_CACHE_SIZE)
+
+
 def get_token_auth_header():
     """Obtains the access token from the Authorization Header
     """
@@ -108,8 +263,11 @@ def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         token = get_token_auth_header()
-        jsonurl = urlopen("https://"+AUTH0_DOMAIN+"/.well-known/jwks.json")
-        jwks = json.loads(jsonurl.read())
+        payload = TOKEN_CACHE.get(token)
+        if payload is not None:
+            _request_ctx_stack.top.current_user = payload
+            return f(*args, **kwargs)
+
         try:
             unverified_header = jwt.get_unverified_header(token)
         except jwt.JWTError:
@@ -123,15 +281,20 @@ def requires_auth(f):
                                 "Invalid header. "
                                 "Use an RS256 signed JWT Access Token"}, 401)
         rsa_key = {}
-        for key in jwks["keys"]:
-            if key["kid"] == unverified_header["kid"]:
-                rsa_key = {
-                    "kty": key["kty"],
-                    "kid": key["kid"],
-                    "use": key["use"],
-                    "n": key["n"],
-                    "e": key["e"]
-                }
+        try:
+            key = JWKS_CACHE.get_key(unverified_header.get("kid"))
+        except Exception:
+            raise AuthError({"code": "jwks_unavailable",
+                            "description":
+                                "Unable to retrieve the signing keys"}, 503)
+        if key:
+            rsa_key = {
+                "kty": key["kty"],
+                "kid": key["kid"],
+                "use": key["use"],
+                "n": key["n"],
+                "e": key["e"]
+            }
         if rsa_key:
             dataConfig = {
                 "verify_signature": True, 
@@ -168,6 +331,7 @@ def requires_auth(f):
                                     "Unable to parse authentication"
                                     " token."}, 401)
 
+            TOKEN_CACHE.put(token, payload)
             _request_ctx_stack.top.current_user = payload
             return f(*args, **kwargs)
         raise AuthError({"code": "invalid_header",
@@ -196,24 +360,43 @@ def download_crash_id(crash_id):
     # We only care for an integer string, anything else is not safe:
     safe_crash_id = re.sub("[^0-9]", "", crash_id)
 
-    s3 = boto3.client("s3",region_name=AWS_DEFALUT_REGION, aws_access_key_id=AWS_S3_KEY, aws_secret_access_key=AWS_S3_SECRET)
-
-    url = s3.generate_presigned_url(
-        ExpiresIn=60, # seconds
-        ClientMethod='get_object',
-        Params={
-            'Bucket': AWS_S3_BUCKET,
-            'Key': AWS_S3_CR3_LOCATION + "/" + safe_crash_id + ".pdf"
-        }
-    )
+    url = get_cr3_url(safe_crash_id)
 
     # For testing uncomment:
     # response = "Private Download, CrashID: %s , %s" % (safe_crash_id, url)
     # return redirect(url, code=302)
     return jsonify(message=url)
-    
 
 
+@APP.route("/cr3/download/batch", methods=["POST"])
+@cross_origin(headers=["Content-Type", "Authorization"])
+@cross_origin(headers=["Access-Control-Allow-Origin", CORS_URL])
+@requires_auth
+def download_crash_ids():
+    """A valid access token is required to access this route. Expects a
+    JSON body with a list of crash ids, ie. {"crash_ids": [1, 2, 3]}, and
+    returns a presigned URL per crash id: {"urls": {"1": "https://...", ...}}
+    """
+    body = request.get_json(silent=True)
+    crash_ids = body.get("crash_ids") if isinstance(body, dict) else None
+    if not isinstance(crash_ids, list) or not crash_ids:
+        return jsonify(code="invalid_request",
+                       description="A non-empty list of crash_ids is expected"), 400
+    if len(crash_ids) > CR3_BATCH_MAX_SIZE:
+        return jsonify(code="invalid_request",
+                       description="At most %s crash_ids per request" % CR3_BATCH_MAX_SIZE), 400
+
+    urls = {}
+    for crash_id in crash_ids:
+        # We only care for an integer string, anything else is not safe:
+        safe_crash_id = re.sub("[^0-9]", "", str(crash_id))
+        if not safe_crash_id:
+            return jsonify(code="invalid_request",
+                           description="Invalid crash_id: %s" % crash_id), 400
+        urls[safe_crash_id] = get_cr3_url(safe_crash_id)
+
+    return jsonify(urls=urls)
+
 
 if __name__ == "__main__":
     APP.run(host="0.0.0.0", port=env.get("PORT", 3010))
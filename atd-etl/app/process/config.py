@@ -16,10 +16,14 @@ ATD_ETL_CONFIG = {
     "AWS_DEFALUT_REGION": os.getenv("AWS_DEFALUT_REGION", ""),
     "AWS_ACCESS_KEY_ID": os.getenv("AWS_ACCESS_KEY_ID", ""),
     "AWS_SECRET_ACCESS_KEY": os.getenv("AWS_SECRET_ACCESS_KEY", ""),
+    "AWS_S3_ENDPOINT_URL": os.getenv("AWS_S3_ENDPOINT_URL", ""),
 
     # HASURA
     "HASURA_ENDPOINT": os.getenv("HASURA_ENDPOINT", ""),
     "HASURA_ADMIN_KEY": os.getenv("HASURA_ADMIN_KEY", ""),
+    # Schema API, used by run_sql (defaults to the /v1/query endpoint next to /v1/graphql)
+    "HASURA_QUERY_ENDPOINT": os.getenv("HASURA_QUERY_ENDPOINT",
+                                       os.getenv("HASURA_ENDPOINT", "").replace("/v1/graphql", "/v1/query")),
     "MAX_THREADS": int(os.getenv("MAX_THREADS", "20")),
     "MAX_ATTEMPTS": int(os.getenv("MAX_ATTEMPTS", "5")),
     "RETRY_WAIT_TIME": int(os.getenv("RETRY_WAIT_TIME", "5")),
@@ -28,7 +32,9 @@ ATD_ETL_CONFIG = {
     "ATD_CRIS_WEBSITE": "https://cris.dot.state.tx.us/",
     "ATD_CRIS_USERNAME_CR3": os.getenv("ATD_CRIS_USERNAME", ""),
     "ATD_CRIS_PASSWORD_CR3": os.getenv("ATD_CRIS_PASSWORD", ""),
-    "ATD_CRIS_CR3_DOWNLOADS_PER_RUN": os.getenv("ATD_CRIS_DOWNLOADS_PER_RUN", "25"),
+    "ATD_CRIS_CR3_DOWNLOADS_PER_RUN": int(os.getenv("ATD_CRIS_DOWNLOADS_PER_RUN", "0")),
+    "ATD_CRIS_RATE_LIMIT": float(os.getenv("ATD_CRIS_RATE_LIMIT", "2")),
+    "ATD_CRIS_RATE_BURST": int(os.getenv("ATD_CRIS_RATE_BURST", "4")),
     "ATD_CRIS_IMPORT_CSV_BUCKET": os.getenv("ATD_CRIS_IMPORT_CSV_BUCKET", ""),
     "ATD_CRIS_IMPORT_COMPARE_FUNCTION": os.getenv("ATD_CRIS_IMPORT_COMPARE_FUNCTION", "DISABLED"),
 
@@ -38,17 +44,91 @@ ATD_ETL_CONFIG = {
     "ATD_HERE_APP_CODE": os.getenv("ATD_HERE_APP_CODE", ""),
     "ATD_HERE_RECORDS_PER_RUN": os.getenv("ATD_HERE_RECORDS_PER_RUN", "500"),
     "ATD_HERE_BOUNDING_BOX": "30.7113,-98.1464;30.0146,-97.1988",
+    "ATD_HERE_RATE_LIMIT": float(os.getenv("ATD_HERE_RATE_LIMIT", "5")),
+    "ATD_HERE_RATE_BURST": int(os.getenv("ATD_HERE_RATE_BURST", "10")),
+    "ATD_RATE_LIMIT_MAX_RETRIES": int(os.getenv("ATD_RATE_LIMIT_MAX_RETRIES", "5")),
+    "ATD_HERE_BATCH_API_ENDPOINT": os.getenv("ATD_HERE_BATCH_API_ENDPOINT", "https://batch.geocoder.api.here.com/6.2/jobs"),
+    "ATD_HERE_BATCH_RECORDS_PER_RUN": int(os.getenv("ATD_HERE_BATCH_RECORDS_PER_RUN", "100000")),
+    "ATD_HERE_BATCH_POLL_INTERVAL": int(os.getenv("ATD_HERE_BATCH_POLL_INTERVAL", "10")),
+    "ATD_HERE_BATCH_TIMEOUT": int(os.getenv("ATD_HERE_BATCH_TIMEOUT", "3600")),
+
+    # GEOCODE PROVIDERS (here, here_batch, streets, stub)
+    "ATD_GEOCODE_PROVIDER": os.getenv("ATD_GEOCODE_PROVIDER", "here"),
+    "ATD_GEOCODE_BATCH_PROVIDER": os.getenv("ATD_GEOCODE_BATCH_PROVIDER", "here_batch"),
+    "ATD_GEOCODE_STUB_FILE": os.getenv("ATD_GEOCODE_STUB_FILE", "/data/geocode-stub.json"),
+    "ATD_GEOCODE_STREETS_PATH": os.getenv("ATD_GEOCODE_STREETS_PATH", "/app/tmp/atd-txdot-streets.json.gz"),
+    "ATD_GEOCODE_STREETS_MAX_AGE_DAYS": int(os.getenv("ATD_GEOCODE_STREETS_MAX_AGE_DAYS", "30")),
+    "ATD_GEOCODE_STREETS_FALLBACK": os.getenv("ATD_GEOCODE_STREETS_FALLBACK", "ENABLED"),
+
+    # ADDRESS NORMALIZER (vocabulary: HASURA or BUILTIN)
+    "ATD_ADDRESS_VOCABULARY": os.getenv("ATD_ADDRESS_VOCABULARY", "HASURA"),
+    "ATD_ADDRESS_CACHE_SIZE": int(os.getenv("ATD_ADDRESS_CACHE_SIZE", "100000")),
+
+    # GEOCODE WRITER
+    "ATD_GEOCODE_WRITE_BATCH_SIZE": int(os.getenv("ATD_GEOCODE_WRITE_BATCH_SIZE", "100")),
+    "ATD_GEOCODE_WRITE_FLUSH_SECONDS": int(os.getenv("ATD_GEOCODE_WRITE_FLUSH_SECONDS", "5")),
+
+    # GEOCODE METADATA (COMPACT or FULL) AND ARCHIVE OF FULL RESPONSES (NONE, TABLE or FILE)
+    "ATD_GEOCODE_METADATA": os.getenv("ATD_GEOCODE_METADATA", "FULL"),
+    "ATD_GEOCODE_ARCHIVE": os.getenv("ATD_GEOCODE_ARCHIVE", "NONE"),
+    "ATD_GEOCODE_ARCHIVE_PATH": os.getenv("ATD_GEOCODE_ARCHIVE_PATH", "/data/geocode-responses"),
+
+    # GEOCODE QUEUE
+    "ATD_GEOCODE_QUEUE": os.getenv("ATD_GEOCODE_QUEUE", "ENABLED"),
+    "ATD_GEOCODE_QUEUE_PATH": os.getenv("ATD_GEOCODE_QUEUE_PATH", "/app/tmp/geocode-queue.sqlite"),
+    "ATD_GEOCODE_QUEUE_PAGE_SIZE": int(os.getenv("ATD_GEOCODE_QUEUE_PAGE_SIZE", "500")),
+    "ATD_GEOCODE_QUEUE_BACKOFF_HOURS": int(os.getenv("ATD_GEOCODE_QUEUE_BACKOFF_HOURS", "24")),
+    "ATD_GEOCODE_QUEUE_MAX_BACKOFF_HOURS": int(os.getenv("ATD_GEOCODE_QUEUE_MAX_BACKOFF_HOURS", "2160")),
+    "ATD_GEOCODE_QUEUE_ERROR_BACKOFF_HOURS": int(os.getenv("ATD_GEOCODE_QUEUE_ERROR_BACKOFF_HOURS", "1")),
+
+    # GEOCODE CACHE
+    "ATD_GEOCODE_CACHE": os.getenv("ATD_GEOCODE_CACHE", "ENABLED"),
+    "ATD_GEOCODE_CACHE_PATH": os.getenv("ATD_GEOCODE_CACHE_PATH", "/app/tmp/geocode-cache.sqlite"),
+    "ATD_GEOCODE_CACHE_TTL_DAYS": int(os.getenv("ATD_GEOCODE_CACHE_TTL_DAYS", "180")),
+    "ATD_GEOCODE_CACHE_NEGATIVE_TTL_DAYS": int(os.getenv("ATD_GEOCODE_CACHE_NEGATIVE_TTL_DAYS", "14")),
 
     # SOCRATA
     "SOCRATA_KEY_ID": os.getenv("SOCRATA_KEY_ID", ""),
     "SOCRATA_KEY_SECRET": os.getenv("SOCRATA_KEY_SECRET", ""),
     "SOCRATA_APP_TOKEN": os.getenv("SOCRATA_APP_TOKEN", ""),
+    "SOCRATA_DOMAIN": os.getenv("SOCRATA_DOMAIN", "data.austintexas.gov"),
+    "SOCRATA_TIMEOUT": int(os.getenv("SOCRATA_TIMEOUT", "20")),
+    "SOCRATA_UPSERT_CHUNK_SIZE": int(os.getenv("SOCRATA_UPSERT_CHUNK_SIZE", "1000")),
+    "SOCRATA_UPSERT_MAX_THREADS": int(os.getenv("SOCRATA_UPSERT_MAX_THREADS", "4")),
+    "SOCRATA_UPSERT_MAX_ATTEMPTS": int(os.getenv("SOCRATA_UPSERT_MAX_ATTEMPTS", "5")),
+    "SOCRATA_UPSERT_RETRY_WAIT_TIME": int(os.getenv("SOCRATA_UPSERT_RETRY_WAIT_TIME", "2")),
+    "SOCRATA_CRASH_CACHE_SIZE": int(os.getenv("SOCRATA_CRASH_CACHE_SIZE", "20000")),
+    "SOCRATA_MANIFEST": os.getenv("SOCRATA_MANIFEST", "ENABLED"),
+    "SOCRATA_MANIFEST_PATH": os.getenv("SOCRATA_MANIFEST_PATH", "/app/tmp/socrata-manifests"),
+    "SOCRATA_MANIFEST_DELETE": os.getenv("SOCRATA_MANIFEST_DELETE", "DISABLED"),
+
+    # LOCATIONS (in-process assignment and per-location sweep)
+    "ATD_LOCATIONS_CACHE_PATH": os.getenv("ATD_LOCATIONS_CACHE_PATH", "/app/tmp/locations"),
+    "ATD_LOCATIONS_PAGE_SIZE": int(os.getenv("ATD_LOCATIONS_PAGE_SIZE", "10000")),
+    "ATD_LOCATIONS_WORKERS": int(os.getenv("ATD_LOCATIONS_WORKERS", str(os.cpu_count() or 1))),
+    "ATD_LOCATIONS_WRITE_BATCH_SIZE": int(os.getenv("ATD_LOCATIONS_WRITE_BATCH_SIZE", "1000")),
+    "ATD_LOCATIONS_SWEEP_PATH": os.getenv("ATD_LOCATIONS_SWEEP_PATH", "/app/tmp/location-sweep.sqlite"),
+    "ATD_LOCATIONS_SWEEP_CHUNK_SIZE": int(os.getenv("ATD_LOCATIONS_SWEEP_CHUNK_SIZE", "25")),
 
     # CR3
     "ATD_CRIS_CR3_URL": "https://cris.dot.state.tx.us/secure/ImageServices/DisplayImageServlet?target=",
-    "AWS_CRIS_CR3_DOWNLOAD_PATH": os.getenv("AWS_CRIS_CR3_DOWNLOAD_PATH", "/app/tmp"),
     "AWS_CRIS_CR3_BUCKET_NAME": os.getenv("AWS_CRIS_CR3_BUCKET_NAME", ""),
     "AWS_CRIS_CR3_BUCKET_PATH": os.getenv("AWS_CRIS_CR3_BUCKET_PATH", "production/cris-cr3-files-unassigned"),
+    "ATD_CRIS_CR3_DOWNLOAD_THREADS": int(os.getenv("ATD_CRIS_CR3_DOWNLOAD_THREADS", "10")),
+    "ATD_CRIS_CR3_UPLOAD_THREADS": int(os.getenv("ATD_CRIS_CR3_UPLOAD_THREADS", "4")),
+    "ATD_CRIS_CR3_STREAM_CHUNK_KB": int(os.getenv("ATD_CRIS_CR3_STREAM_CHUNK_KB", "64")),
+    "ATD_CRIS_CR3_STREAM_BUFFER_CHUNKS": int(os.getenv("ATD_CRIS_CR3_STREAM_BUFFER_CHUNKS", "16")),
+    "ATD_CRIS_CR3_MULTIPART_CHUNK_MB": int(os.getenv("ATD_CRIS_CR3_MULTIPART_CHUNK_MB", "8")),
+    "ATD_CRIS_CR3_PAGE_SIZE": int(os.getenv("ATD_CRIS_CR3_PAGE_SIZE", "500")),
+    "ATD_CRIS_CR3_FLAG_BATCH_SIZE": int(os.getenv("ATD_CRIS_CR3_FLAG_BATCH_SIZE", "100")),
+    "ATD_CR3HEAL_PAGE_SIZE": int(os.getenv("ATD_CR3HEAL_PAGE_SIZE", "10000")),
+    "ATD_CR3HEAL_SHARD_DIGITS": int(os.getenv("ATD_CR3HEAL_SHARD_DIGITS", "2")),
+    "ATD_CR3HEAL_LIST_THREADS": int(os.getenv("ATD_CR3HEAL_LIST_THREADS", "16")),
+    "ATD_CR3HEAL_UPDATE_BATCH_SIZE": int(os.getenv("ATD_CR3HEAL_UPDATE_BATCH_SIZE", "1000")),
+    # Aborts (unless --force) when more than this fraction of the flagged crashes has no PDF
+    "ATD_CR3HEAL_MAX_MISSING_FRACTION": float(os.getenv("ATD_CR3HEAL_MAX_MISSING_FRACTION", "0.05")),
+    # Crash ids above this are kept in a set instead of the bitmaps
+    "ATD_CR3HEAL_MAX_CRASH_ID": int(os.getenv("ATD_CR3HEAL_MAX_CRASH_ID", "100000000")),
 
     # REQUEST
     "ATD_CRIS_REQUEST_USERNAME": os.getenv("ATD_CRIS_REQUEST_USERNAME", ""),
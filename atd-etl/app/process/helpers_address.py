@@ -0,0 +1,242 @@
+"""
+Address Normalizer
+Author: Austin Transportation Department, Data and Technology Services
+
+Description: Turns the address fields of a crash into a canonical address,
+ie. "1100 NORTH Lamar Boulevard Blvd" becomes "1100 N LAMAR BLVD". The
+address is split into tokens, the direction and street suffix tokens are
+replaced with their abbreviation (by position: one direction at the start
+and one at the end of the street, one suffix at the end), and repeated
+spellings of the same direction or suffix are dropped. Name words that are
+also suffixes or directions are kept, ie. "SPRING CREEK DR" or "EAST AVE".
+
+The vocabularies come from the atd_txdot__street_sfx_lkp and
+atd_txdot__nsew_dir_lkp lookup tables, merged with a built-in vocabulary
+that is also used when Hasura cannot be reached. Normalized streets and
+addresses are memoized in LRU caches, since the same raw values repeat
+across thousands of crashes.
+
+The canonical address is also the key of the geocode cache.
+"""
+
+import re
+import threading
+from functools import lru_cache
+
+from .config import ATD_ETL_CONFIG
+from .request import run_query
+
+# Abbreviations of the most common street suffixes (USPS), by spelling
+BUILTIN_STREET_SUFFIXES = {
+    "ALLEY": "ALY", "ALY": "ALY",
+    "AVENUE": "AVE", "AVE": "AVE", "AV": "AVE",
+    "BEND": "BND", "BND": "BND",
+    "BOULEVARD": "BLVD", "BLVD": "BLVD", "BLV": "BLVD",
+    "BYPASS": "BYP", "BYP": "BYP",
+    "CIRCLE": "CIR", "CIR": "CIR",
+    "COURT": "CT", "CT": "CT",
+    "COVE": "CV", "CV": "CV",
+    "CREEK": "CRK", "CRK": "CRK",
+    "CROSSING": "XING", "XING": "XING",
+    "DRIVE": "DR", "DR": "DR",
+    "EXPRESSWAY": "EXPY", "EXPY": "EXPY",
+    "FREEWAY": "FWY", "FWY": "FWY",
+    "GLEN": "GLN", "GLN": "GLN",
+    "HIGHWAY": "HWY", "HWY": "HWY",
+    "HILL": "HL", "HL": "HL",
+    "HOLLOW": "HOLW", "HOLW": "HOLW",
+    "LANE": "LN", "LN": "LN",
+    "LOOP": "LOOP",
+    "PARKWAY": "PKWY", "PKWY": "PKWY", "PKY": "PKWY",
+    "PASS": "PASS",
+    "PATH": "PATH",
+    "PLACE": "PL", "PL": "PL",
+    "PLAZA": "PLZ", "PLZ": "PLZ",
+    "POINT": "PT", "PT": "PT",
+    "RIDGE": "RDG", "RDG": "RDG",
+    "ROAD": "RD", "RD": "RD",
+    "RUN": "RUN",
+    "SQUARE": "SQ", "SQ": "SQ",
+    "STREET": "ST", "ST": "ST", "STR": "ST",
+    "SVRD": "SVRD",
+    "TERRACE": "TER", "TER": "TER",
+    "TRAIL": "TRL", "TRL": "TRL",
+    "VIEW": "VW", "VW": "VW",
+    "VISTA": "VIS", "VIS": "VIS",
+    "WALK": "WALK",
+    "WAY": "WAY",
+}
+
+BUILTIN_DIRECTIONS = {
+    "NORTH": "N", "N": "N", "NB": "N",
+    "SOUTH": "S", "S": "S", "SB": "S",
+    "EAST": "E", "E": "E", "EB": "E",
+    "WEST": "W", "W": "W", "WB": "W",
+    "NORTHEAST": "NE", "NE": "NE",
+    "NORTHWEST": "NW", "NW": "NW",
+    "SOUTHEAST": "SE", "SE": "SE",
+    "SOUTHWEST": "SW", "SW": "SW",
+}
+
+# Tokens left behind by empty fields
+JUNK_TOKENS = {"", "NONE", "NULL"}
+
+vocabulary_query = """
+    query getAddressVocabulary {
+      atd_txdot__street_sfx_lkp {
+        street_sfx_id
+        street_sfx_desc
+      }
+      atd_txdot__nsew_dir_lkp {
+        nsew_dir_id
+        nsew_dir_desc
+      }
+    }
+"""
+
+vocabulary = None
+vocabulary_lock = threading.Lock()
+
+
+def merge_vocabulary(builtin, descriptions):
+    """
+    Adds the single-word descriptions of a lookup table to a vocabulary,
+    using the built-in abbreviation when there is one
+    :param builtin: dict - The built-in vocabulary
+    :param descriptions: list - The descriptions in the lookup table
+    :return: dict
+    """
+    merged = dict(builtin)
+    for description in descriptions:
+        token = str(description or "").upper().strip()
+        if token and " " not in token and token not in merged:
+            merged[token] = token
+    return merged
+
+
+def get_vocabulary():
+    """
+    Returns the street suffix and direction vocabularies, loading
+    the lookup tables from Hasura once per process
+    :return: tuple - (suffixes, directions), dicts of spelling and abbreviation
+    """
+    global vocabulary
+    if vocabulary is not None:
+        return vocabulary
+
+    with vocabulary_lock:
+        if vocabulary is None:
+            suffixes, directions = [], []
+            if ATD_ETL_CONFIG["ATD_ADDRESS_VOCABULARY"] == "HASURA":
+                response = run_query(vocabulary_query)
+                try:
+                    suffixes = [row["street_sfx_desc"] for row in response["data"]["atd_txdot__street_sfx_lkp"]]
+                    directions = [row["nsew_dir_desc"] for row in response["data"]["atd_txdot__nsew_dir_lkp"]]
+                except (KeyError, TypeError):
+                    print("[Error] Could not load the address vocabulary, using the built-in one: %s" % response)
+            vocabulary = (merge_vocabulary(BUILTIN_STREET_SUFFIXES, suffixes),
+                          merge_vocabulary(BUILTIN_DIRECTIONS, directions))
+    return vocabulary
+
+
+def tokenize(value):
+    """
+    Splits a raw value into upper case tokens, without punctuation
+    :param value: string - The raw value
+    :return: list
+    """
+    return [token for token in re.split(r"[\s.#]+", str(value).upper()) if token not in JUNK_TOKENS]
+
+
+def normalize_street_tokens(tokens):
+    """
+    Returns the canonical tokens of a street: block number, prefix
+    direction, name, suffix and suffix direction
+    :param tokens: list - The tokens, as returned by tokenize
+    :return: list
+    """
+    suffixes, directions = get_vocabulary()
+    tokens = list(tokens)
+
+    block = []
+    if tokens and tokens[0].isdigit():
+        block = [tokens.pop(0)]
+        # Repeated block numbers ie. "1100 1100 LAMAR"
+        while tokens and tokens[0] == block[0]:
+            tokens.pop(0)
+
+    # At most one suffix direction, suffix and prefix direction, and never
+    # the last name token, ie. "100 EAST AVE" or "1100 SPRING CREEK DR"
+    suffix_direction = []
+    if len(tokens) > 1 and tokens[-1] in directions:
+        suffix_direction = [directions[tokens.pop()]]
+
+    suffix = []
+    if len(tokens) > 1 and tokens[-1] in suffixes:
+        suffix = [suffixes[tokens.pop()]]
+        # Repeated suffix ie. "LAMAR BOULEVARD BLVD"
+        while len(tokens) > 1 and suffixes.get(tokens[-1]) == suffix[0]:
+            tokens.pop()
+
+    prefix = []
+    if len(tokens) > 1 and tokens[0] in directions:
+        prefix = [directions[tokens.pop(0)]]
+        # Repeated prefix direction ie. "N NORTH LAMAR"
+        while len(tokens) > 1 and directions.get(tokens[0]) == prefix[0]:
+            tokens.pop(0)
+
+    return block + prefix + tokens + suffix + suffix_direction
+
+
+@lru_cache(maxsize=ATD_ETL_CONFIG["ATD_ADDRESS_CACHE_SIZE"])
+def normalize_street(block_num, prefix, name, suffix):
+    """
+    Returns the canonical street of the raw address fields of a crash,
+    memoized on the raw field tuple
+    :param block_num: string - The block number (ie. rpt_block_num)
+    :param prefix: string - The prefix direction (ie. rpt_street_pfx)
+    :param name: string - The street name (ie. rpt_street_name)
+    :param suffix: string - The street suffix (ie. rpt_street_sfx)
+    :return: string - The canonical street, or an empty string
+    """
+    tokens = []
+    for value in [block_num, prefix, name, suffix]:
+        if value is not None:
+            tokens += tokenize(value)
+    return " ".join(normalize_street_tokens(tokens))
+
+
+@lru_cache(maxsize=ATD_ETL_CONFIG["ATD_ADDRESS_CACHE_SIZE"])
+def normalize_address(address):
+    """
+    Returns the canonical version of a full address, ie.
+    "n lamar blvd  & W. 5th Street, Austin, TX" becomes
+    "N LAMAR BLVD & W 5TH ST, AUSTIN, TX"
+    :param address: string - The address
+    :return: string
+    """
+    parts = [part for part in str(address).split(",")]
+    streets = [" ".join(normalize_street_tokens(tokenize(street))) for street in parts[0].split("&")]
+    places = [" ".join(tokenize(part)) for part in parts[1:]]
+    return ", ".join([" & ".join(street for street in streets if street)]
+                     + [place for place in places if place])
+
+
+@lru_cache(maxsize=None)
+def normalize_keyword(keyword):
+    """
+    Returns a street keyword in the canonical form of normalize_street, so it
+    can be matched against normalized streets, ie. "PRIVATE ROAD" becomes
+    "PRIVATE RD"
+    :param keyword: string - The keyword
+    :return: string
+    """
+    return " ".join(normalize_street_tokens(tokenize(keyword)))
+
+
+def normalizer_cache_info():
+    """
+    Returns the hit and miss statistics of the normalizer caches
+    :return: dict
+    """
+    return {"streets": normalize_street.cache_info(), "addresses": normalize_address.cache_info()}
@@ -6,124 +6,393 @@ Description: This script contains methods that help in the download
 and processing of CR3 files, this can include downloading the file
 from a CRIS endpoint, uploading files to S3, etc.
 
-The application requires the requests library:
+CR3 files are streamed from the CRIS response straight into a boto3
+managed upload (multipart for large files) through a bounded in-memory
+pipe, without temporary files or subprocesses. Downloads and uploads run
+in separate thread pools (ATD_CRIS_CR3_DOWNLOAD_THREADS and
+ATD_CRIS_CR3_UPLOAD_THREADS), and the S3 endpoint can point to a local
+stand-in (ie. MinIO or moto) with AWS_S3_ENDPOINT_URL.
+
+The application requires the requests library, and the boto3 library:
     https://pypi.org/project/requests/
+    https://pypi.org/project/boto3/
 """
 
-import requests
+import io
+import time
+import queue
 import base64
-import subprocess
+import threading
+import concurrent.futures
 
+import boto3
+from boto3.s3.transfer import TransferConfig
 
 # We need to import our configuration, and the run_query method
 from .config import ATD_ETL_CONFIG
 from .request import run_query
+from .helpers_rate_limit import request_with_rate_limit
+
+KILOBYTE = 1024
+MEGABYTE = 1024 * 1024
+
+# Every PDF starts with this signature, CRIS answers with an HTML page
+# (ie. the login page) when the session expired
+PDF_SIGNATURE = b"%PDF"
+
+
+class StreamPipe(io.RawIOBase):
+    """
+    Bounded, thread-safe pipe between a download (writer) and an upload
+    (reader). The writer blocks when max_chunks chunks are waiting, so
+    the memory of a transfer never exceeds max_chunks * chunk size.
+    """
+    def __init__(self, max_chunks):
+        self.chunks = queue.Queue(maxsize=max(1, max_chunks))
+        self.buffer = b""
+        self.error = None
+        self.finished = False
+        self.cancelled = threading.Event()
+
+    def readable(self):
+        return True
+
+    def put(self, item):
+        """
+        Queues an item, blocks while the pipe is full and raises an
+        error if the reader gave up (ie. the upload failed)
+        """
+        while True:
+            if self.cancelled.is_set():
+                raise IOError("The upload was cancelled")
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def write_chunk(self, chunk):
+        """
+        Queues a chunk, blocks while the pipe is full
+        :param chunk: bytes - The chunk
+        """
+        if chunk:
+            self.put(chunk)
+
+    def finish(self, error=None):
+        """
+        Marks the end of the stream, the reader raises the error if there is one
+        :param error: Exception - Why the download failed, or None
+        """
+        self.error = error
+        try:
+            self.put(None)
+        except IOError:
+            pass
+
+    def cancel(self):
+        """
+        Called by the reader when it stops reading, so the writer does not block
+        """
+        self.cancelled.set()
+
+    def readinto(self, target):
+        while not self.buffer and not self.finished:
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.finished = True
+                if self.error is not None:
+                    raise IOError("The download failed: %s" % str(self.error))
+            else:
+                self.buffer = chunk
+        size = min(len(target), len(self.buffer))
+        target[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+s3_client = None
+s3_client_lock = threading.Lock()
+
 
+def get_s3_client():
+    """
+    Returns the process-wide S3 client (boto3 clients are thread-safe),
+    pointed to AWS_S3_ENDPOINT_URL when it is set
+    :return: botocore.client.S3
+    """
+    global s3_client
+    with s3_client_lock:
+        if s3_client is None:
+            s3_client = boto3.client(
+                "s3",
+                endpoint_url=ATD_ETL_CONFIG["AWS_S3_ENDPOINT_URL"] or None,
+                region_name=ATD_ETL_CONFIG["AWS_DEFALUT_REGION"] or None,
+                aws_access_key_id=ATD_ETL_CONFIG["AWS_ACCESS_KEY_ID"] or None,
+                aws_secret_access_key=ATD_ETL_CONFIG["AWS_SECRET_ACCESS_KEY"] or None,
+            )
+        return s3_client
+
+
+upload_executor = None
+upload_executor_lock = threading.Lock()
+
+
+def get_upload_executor():
+    """
+    Returns the process-wide thread pool of the S3 uploads
+    :return: concurrent.futures.ThreadPoolExecutor
+    """
+    global upload_executor
+    with upload_executor_lock:
+        if upload_executor is None:
+            upload_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=ATD_ETL_CONFIG["ATD_CRIS_CR3_UPLOAD_THREADS"])
+        return upload_executor
 
-def run_command(command):
+
+def shutdown_upload_executor():
+    """
+    Waits for the pending uploads and stops the upload threads
+    """
+    global upload_executor
+    with upload_executor_lock:
+        if upload_executor is not None:
+            upload_executor.shutdown(wait=True)
+            upload_executor = None
+
+
+transfer_stats = {"files": 0, "bytes": 0, "failed": 0, "seconds": 0.0}
+transfer_stats_lock = threading.Lock()
+
+
+def get_cr3_key(crash_id):
     """
-    Runs a command
-    :param command: array of strings containing the command and flags
+    Returns the S3 key of the CR3 of a crash
+    :param crash_id: string - The crash id
+    :return: string
     """
-    print(command)
-    print(subprocess.check_output(command, shell=True).decode("utf-8"))
+    return "%s/%s.pdf" % (ATD_ETL_CONFIG["AWS_CRIS_CR3_BUCKET_PATH"], crash_id)
+
+
+def upload_stream(pipe, key):
+    """
+    Uploads the content of a pipe to the CR3 bucket, with a managed
+    (multipart when needed) upload
+    :param pipe: StreamPipe - The pipe the download writes to
+    :param key: string - The S3 key
+    """
+    transfer_config = TransferConfig(
+        multipart_threshold=ATD_ETL_CONFIG["ATD_CRIS_CR3_MULTIPART_CHUNK_MB"] * MEGABYTE,
+        multipart_chunksize=ATD_ETL_CONFIG["ATD_CRIS_CR3_MULTIPART_CHUNK_MB"] * MEGABYTE,
+        max_concurrency=1,
+        use_threads=False,
+    )
+    try:
+        get_s3_client().upload_fileobj(
+            pipe, ATD_ETL_CONFIG["AWS_CRIS_CR3_BUCKET_NAME"], key,
+            ExtraArgs={"ContentType": "application/pdf"}, Config=transfer_config)
+    finally:
+        pipe.cancel()
 
 
 # Now we need to implement our methods.
 def download_cr3(crash_id, cookies):
     """
-    Downloads a CR3 pdf from the CRIS website.
+    Streams a CR3 pdf from the CRIS website to S3.
     :param crash_id: string - The crash id
     :param cookies: dict - A dictionary containing key=value pairs with cookie name and values.
+    :return: int - The size of the file in bytes
     """
     crash_id_encoded = base64.b64encode(str("CrashId=" + crash_id).encode("utf-8")).decode("utf-8")
     url = ATD_ETL_CONFIG["ATD_CRIS_CR3_URL"] + crash_id_encoded
-    download_path = ATD_ETL_CONFIG["AWS_CRIS_CR3_DOWNLOAD_PATH"] + "%s.pdf" % crash_id
+    key = get_cr3_key(crash_id)
+    chunk_size = ATD_ETL_CONFIG["ATD_CRIS_CR3_STREAM_CHUNK_KB"] * KILOBYTE
 
-    print("Downloading (%s): '%s' from %s" % (crash_id, download_path, url))
-    resp = requests.get(url, allow_redirects=True, cookies=cookies)
-    open(download_path, 'wb').write(resp.content)
+    print("Downloading (%s): 's3://%s/%s' from %s" % (
+        crash_id, ATD_ETL_CONFIG["AWS_CRIS_CR3_BUCKET_NAME"], key, url))
+    start = time.time()
+    resp = request_with_rate_limit("cris", "GET", url, allow_redirects=True, cookies=cookies, stream=True)
+    with resp:
+        resp.raise_for_status()
+        pipe = StreamPipe(ATD_ETL_CONFIG["ATD_CRIS_CR3_STREAM_BUFFER_CHUNKS"])
+        upload = get_upload_executor().submit(upload_stream, pipe, key)
+        size = 0
+        error = None
+        try:
+            for chunk in resp.iter_content(chunk_size=chunk_size):
+                if size == 0 and not chunk.startswith(PDF_SIGNATURE):
+                    raise Exception("The response of crash %s is not a PDF" % crash_id)
+                size += len(chunk)
+                pipe.write_chunk(chunk)
+            if size == 0:
+                raise Exception("The response of crash %s is empty" % crash_id)
+        except Exception as e:
+            error = e
+        pipe.finish(error)
+        if error is not None:
+            # The upload fails too, without writing the object
+            concurrent.futures.wait([upload])
+            raise error
+        # Raises the upload error, if any
+        upload.result()
 
+    with transfer_stats_lock:
+        transfer_stats["files"] += 1
+        transfer_stats["bytes"] += size
+        transfer_stats["seconds"] += time.time() - start
+    return size
 
-def upload_cr3(crash_id):
+
+def report_cr3_transfers():
     """
-    Uploads a file to S3 using the awscli command
-    :param crash_id: string - The crash id
+    Returns the number of CR3 files and bytes transferred
+    :return: string
     """
-    file = "/app/tmp/%s.pdf" % crash_id
-    destination = "s3://%s/%s/%s.pdf" % (
-        ATD_ETL_CONFIG["AWS_CRIS_CR3_BUCKET_NAME"],
-        ATD_ETL_CONFIG["AWS_CRIS_CR3_BUCKET_PATH"],
-        crash_id
-    )
+    with transfer_stats_lock:
+        return "CR3 transfers: %s files, %.1f MB, %s failed, %.2f seconds per file" % (
+            transfer_stats["files"], transfer_stats["bytes"] / float(MEGABYTE), transfer_stats["failed"],
+            transfer_stats["seconds"] / max(1, transfer_stats["files"]))
 
-    run_command("aws s3 cp %s %s --no-progress" % (file, destination))
+
+crashes_without_cr3_query = """
+    query CrashesWithoutCR3($cursor: Int!, $limit: Int!) {
+      atd_txdot_crashes(
+        limit: $limit,
+        order_by: {crash_id: asc},
+        where: {
+          city_id: {_eq: 22}
+          cr3_stored_flag: {_eq: "N"}
+          crash_id: {_gt: $cursor}
+        }
+      ) {
+        crash_id
+      }
+    }
+"""
 
 
-def delete_cr3s(crash_id):
+def get_crash_id_list(cursor=0, page_size=500):
     """
-    Deletes the downloaded CR3 pdf file
-    :param crash_id: string - The crash id
+    Downloads a page of crashes that do not have a CR3 associated, in
+    crash_id order, starting after a cursor.
+    :param cursor: int - The last crash_id of the previous page (0 for the first page)
+    :param page_size: int - The maximum number of crashes
+    :return: list - The crash records
     """
-    file = "/app/tmp/%s.pdf" % crash_id
-    run_command("rm %s" % file)
+    response = run_query(crashes_without_cr3_query, variables={"cursor": int(cursor), "limit": int(page_size)})
+    if response is None or "errors" in response:
+        raise Exception("Could not read the crashes without a CR3: %s" % response)
+    return response["data"]["atd_txdot_crashes"]
 
 
-def get_crash_id_list(downloads_per_run="25"):
+update_records_cr3_mutation = """
+    mutation CrashesUpdateRecordsCR3($crash_ids: [Int!]!) {
+      update_atd_txdot_crashes(where: {crash_id: {_in: $crash_ids}}, _set: {cr3_stored_flag: "%s", updated_by: "System"}) {
+        affected_rows
+      }
+    }
+"""
+
+
+def update_crash_ids(crash_ids, flag="Y"):
     """
-    Downloads a list of crashes that do not have a CR3 associated.
+    Updates the status of a list of crashes to having (Y) or not having (N) an available CR3 pdf in the S3 bucket.
+    :param crash_ids: list - The Crash IDs that need to be updated
+    :param flag: string - The value of cr3_stored_flag
     :return: dict - Response from request.post
     """
-    query_crashes_cr3 = """
-        query CrashesWithoutCR3 {
-          atd_txdot_crashes(
-            limit: %s,
-            where: {
-              city_id: {_eq: 22}
-              cr3_stored_flag: {_eq: "N"}
-            }
-          ) {
-            crash_id
-          }
-        }
-    """ % (str(downloads_per_run))
-
-    return run_query(query_crashes_cr3)
+    if flag not in ["Y", "N"]:
+        raise ValueError("Invalid cr3_stored_flag: %s" % flag)
+    return run_query(update_records_cr3_mutation % flag,
+                     variables={"crash_ids": [int(crash_id) for crash_id in crash_ids]})
 
 
-def update_crash_id(crash_id):
+class Cr3FlagBatch:
     """
-    Updates the status of a crash to having an available CR3 pdf in the S3 bucket.
-    :param crash_id: string - The Crash ID that needs to be updated
-    :return: dict - Response from request.post
+    Thread-safe buffer of the crashes whose CR3 was stored, flagged
+    with one mutation per batch
     """
+    def __init__(self, batch_size):
+        self.batch_size = max(1, batch_size)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.stats = {"flagged": 0, "failed": 0, "requests": 0}
 
-    update_record_cr3 = """
-        mutation CrashesUpdateRecordCR3 {
-          update_atd_txdot_crashes(where: {crash_id: {_eq: %s}}, _set: {cr3_stored_flag: "Y", updated_by: "System"}) {
-            affected_rows
-          }
-        }
-    """ % crash_id
-    print(update_record_cr3)
-    return run_query(update_record_cr3)
+    def add(self, crash_id):
+        """
+        Queues a crash, and flags the batch when it is full
+        :param crash_id: string - The crash id
+        """
+        with self.lock:
+            self.pending.append(crash_id)
+            if len(self.pending) < self.batch_size:
+                return
+            crash_ids, self.pending = self.pending, []
+        self.flag(crash_ids)
+
+    def flag(self, crash_ids):
+        """
+        Sets cr3_stored_flag of a batch of crashes
+        :param crash_ids: list - The crash ids
+        """
+        response = update_crash_ids(crash_ids)
+        with self.lock:
+            self.stats["requests"] += 1
+            if response is not None and "errors" not in response:
+                self.stats["flagged"] += response["data"]["update_atd_txdot_crashes"]["affected_rows"]
+                return
+            # The PDFs are in S3, the next run downloads them again
+            self.stats["failed"] += len(crash_ids)
+        print("[Error] Could not flag %s crashes: %s" % (len(crash_ids), response))
+
+    def flush(self):
+        """
+        Flags the remaining crashes
+        """
+        with self.lock:
+            crash_ids, self.pending = self.pending, []
+        if crash_ids:
+            self.flag(crash_ids)
+
+    def report(self):
+        return "CR3 flags: %s crashes flagged in %s requests, %s failed" % (
+            self.stats["flagged"], self.stats["requests"], self.stats["failed"])
+
+
+cr3_flag_batch = None
+cr3_flag_batch_lock = threading.Lock()
+
+
+def get_cr3_flag_batch():
+    """
+    Returns the process-wide batch of cr3_stored_flag updates
+    :return: Cr3FlagBatch
+    """
+    global cr3_flag_batch
+    with cr3_flag_batch_lock:
+        if cr3_flag_batch is None:
+            cr3_flag_batch = Cr3FlagBatch(ATD_ETL_CONFIG["ATD_CRIS_CR3_FLAG_BATCH_SIZE"])
+        return cr3_flag_batch
 
 
 def process_crash_cr3(crash_record, cookies):
     """
-    Downloads a CR3 pdf, uploads it to s3, updates the database and deletes the pdf.
+    Streams a CR3 pdf to s3, and queues the update of the database.
     :param crash_record: dict - The individual crash record being processed
     :param cookies: dict - The cookies taken from the browser object
+    :return: bool - True if the CR3 was stored
     """
     try:
         crash_id = str(crash_record["crash_id"])
         print("Processing Crash: " + crash_id)
 
         download_cr3(crash_id, cookies)
-        upload_cr3(crash_id)
-        update_crash_id(crash_id)
-        delete_cr3s(crash_id)
+        get_cr3_flag_batch().add(crash_id)
+        return True
 
     except Exception as e:
+        with transfer_stats_lock:
+            transfer_stats["failed"] += 1
         print("Error: %s" % str(e))
-        return
+        return False
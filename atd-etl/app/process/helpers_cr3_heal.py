@@ -0,0 +1,242 @@
+"""
+Helpers for the CR3 Healer
+Author: Austin Transportation Department, Data and Technology Services
+
+Description: Reconciles cr3_stored_flag with the CR3 files in S3. All the
+crash ids and flags are streamed from Hasura (keyset paging on crash_id),
+then the CR3 bucket prefix is listed with paginated list_objects_v2 calls,
+one per prefix shard (ie. the first two digits of the crash id), in
+parallel. Both sides are kept in compact bitmaps indexed by crash id, so
+the differences of hundreds of thousands of crashes take a few MB:
+
+- Flagged crashes without a PDF in S3 are set to "N", which queues them
+  for process_cris_cr3.py.
+- Crashes not flagged with a PDF in S3 are set to "Y".
+- PDFs of crash ids that are not in the database are only reported.
+
+A listing that misses most of the PDFs (ie. a wrong bucket path or missing
+permissions) would queue every flagged crash for download again, so the
+healer aborts when more than ATD_CR3HEAL_MAX_MISSING_FRACTION of the flagged
+crashes have no PDF, unless it is forced.
+
+Hasura is read before S3, so a CR3 stored while the healer runs is never
+mistaken for a missing file (the PDF is uploaded before it is flagged).
+
+The application requires the boto3 library:
+    https://pypi.org/project/boto3/
+"""
+
+import re
+import time
+import array
+import concurrent.futures
+
+from .config import ATD_ETL_CONFIG
+from .request import run_query
+from .helpers_cr3 import get_s3_client, update_crash_ids
+
+# The file name of a CR3, ie. production/cris-cr3-files-unassigned/12345.pdf
+CR3_KEY_PATTERN = re.compile(r"/(\d+)\.pdf$")
+
+crash_flags_query = """
+    query getCrashFlags($cursor: Int!, $limit: Int!) {
+      atd_txdot_crashes(
+        limit: $limit,
+        order_by: {crash_id: asc},
+        where: {crash_id: {_gt: $cursor}}
+      ) {
+        crash_id
+        cr3_stored_flag
+      }
+    }
+"""
+
+
+class CrashIdSet:
+    """
+    Set of non-negative integers stored as a bitmap, one bit per id,
+    ie. 2.5 MB for ids up to 20 million. Ids above max_id (ie. a stray
+    key in the bucket) are kept in a plain set, so they never grow the
+    bitmap.
+    """
+    def __init__(self, max_id=None):
+        self.bits = bytearray(1024)
+        self.count = 0
+        self.max_id = ATD_ETL_CONFIG["ATD_CR3HEAL_MAX_CRASH_ID"] if max_id is None else max_id
+        self.outliers = set()
+
+    def add(self, crash_id):
+        if crash_id > self.max_id:
+            self.outliers.add(crash_id)
+            return
+        index = crash_id >> 3
+        if index >= len(self.bits):
+            self.bits.extend(bytearray(max(index + 1, len(self.bits) * 2) - len(self.bits)))
+        mask = 1 << (crash_id & 7)
+        if not self.bits[index] & mask:
+            self.bits[index] |= mask
+            self.count += 1
+
+    def __contains__(self, crash_id):
+        if crash_id > self.max_id:
+            return crash_id in self.outliers
+        index = crash_id >> 3
+        return index < len(self.bits) and bool(self.bits[index] & (1 << (crash_id & 7)))
+
+    def __len__(self):
+        return self.count + len(self.outliers)
+
+    def __iter__(self):
+        for index, byte in enumerate(self.bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield (index << 3) | bit
+        for crash_id in sorted(self.outliers):
+            yield crash_id
+
+    def difference(self, other):
+        """
+        Returns the ids in this set that are not in the other set
+        :param other: CrashIdSet
+        :return: list
+        """
+        return [crash_id for crash_id in self if crash_id not in other]
+
+
+def stream_crash_flags(page_size):
+    """
+    Reads the crash ids and CR3 flags of every crash from Hasura
+    :param page_size: int - The number of crashes per request
+    :return: tuple - (all crash ids, flagged crash ids), CrashIdSets
+    """
+    crashes, flagged = CrashIdSet(), CrashIdSet()
+    cursor = 0
+    while True:
+        response = run_query(crash_flags_query, variables={"cursor": cursor, "limit": page_size})
+        if response is None or "errors" in response:
+            raise Exception("Could not read the crash flags: %s" % response)
+        page = response["data"]["atd_txdot_crashes"]
+        for record in page:
+            crashes.add(record["crash_id"])
+            if record["cr3_stored_flag"] == "Y":
+                flagged.add(record["crash_id"])
+        if len(page) < page_size:
+            return crashes, flagged
+        cursor = page[-1]["crash_id"]
+
+
+def get_shard_prefixes(prefix, digits):
+    """
+    Returns the prefixes of the shards of the CR3 bucket path, one per
+    combination of the first digits of the crash id
+    :param prefix: string - The bucket path, ie. production/cris-cr3-files-unassigned
+    :param digits: int - The number of digits per shard (0 for a single shard)
+    :return: list
+    """
+    prefix = prefix.rstrip("/") + "/"
+    if digits <= 0:
+        return [prefix]
+    # Crash ids with all the digits of a shard, and the shorter ones (ie. "7.pdf")
+    return [prefix + str(shard) for shard in range(10 ** (digits - 1), 10 ** digits)] + \
+        [prefix + "%s." % crash_id for crash_id in range(10 ** (digits - 1))]
+
+
+def list_shard(bucket, prefix):
+    """
+    Lists the crash ids of the CR3 files under a prefix
+    :param bucket: string - The bucket name
+    :param prefix: string - The shard prefix
+    :return: tuple - (array of crash ids, number of objects)
+    """
+    crash_ids = array.array("L")
+    objects = 0
+    paginator = get_s3_client().get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            objects += 1
+            match = CR3_KEY_PATTERN.search(item["Key"])
+            if match:
+                crash_ids.append(int(match.group(1)))
+    return crash_ids, objects
+
+
+def list_cr3_files(bucket, prefix, digits, threads):
+    """
+    Lists the crash ids of every CR3 file in the bucket path, one
+    paginated listing per shard, in parallel
+    :return: CrashIdSet
+    """
+    stored = CrashIdSet()
+    shards = get_shard_prefixes(prefix, digits)
+    objects = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        for crash_ids, shard_objects in executor.map(lambda shard: list_shard(bucket, shard), shards):
+            objects += shard_objects
+            for crash_id in crash_ids:
+                stored.add(crash_id)
+    print("S3: %s objects listed in %s shards, %s CR3 files" % (objects, len(shards), len(stored)))
+    return stored
+
+
+def update_flags(crash_ids, flag, batch_size):
+    """
+    Sets cr3_stored_flag of a list of crashes, one mutation per batch
+    :return: int - The number of crashes updated
+    """
+    updated = 0
+    for i in range(0, len(crash_ids), batch_size):
+        batch = crash_ids[i:i + batch_size]
+        response = update_crash_ids(batch, flag=flag)
+        if response is None or "errors" in response:
+            print("[Error] Could not set cr3_stored_flag to '%s' on %s crashes: %s" % (flag, len(batch), response))
+            continue
+        updated += response["data"]["update_atd_txdot_crashes"]["affected_rows"]
+    return updated
+
+
+def heal_cr3_flags(dry_run=False, force=False):
+    """
+    Reconciles cr3_stored_flag with the CR3 files in S3
+    :param dry_run: bool - Only report the differences
+    :param force: bool - Update the flags even when too many PDFs are missing
+    :return: dict - Statistics of the run
+    """
+    start = time.time()
+    crashes, flagged = stream_crash_flags(ATD_ETL_CONFIG["ATD_CR3HEAL_PAGE_SIZE"])
+    print("Hasura: %s crashes, %s flagged with a CR3 (%.1f seconds)" % (
+        len(crashes), len(flagged), time.time() - start))
+
+    start = time.time()
+    stored = list_cr3_files(
+        bucket=ATD_ETL_CONFIG["AWS_CRIS_CR3_BUCKET_NAME"],
+        prefix=ATD_ETL_CONFIG["AWS_CRIS_CR3_BUCKET_PATH"],
+        digits=ATD_ETL_CONFIG["ATD_CR3HEAL_SHARD_DIGITS"],
+        threads=ATD_ETL_CONFIG["ATD_CR3HEAL_LIST_THREADS"],
+    )
+    print("S3 listed in %.1f seconds" % (time.time() - start))
+
+    missing = flagged.difference(stored)
+    unflagged = [crash_id for crash_id in stored.difference(flagged) if crash_id in crashes]
+    orphans = stored.difference(crashes)
+    stats = {"crashes": len(crashes), "flagged": len(flagged), "stored": len(stored),
+             "missing": len(missing), "unflagged": len(unflagged), "orphans": len(orphans),
+             "set_n": 0, "set_y": 0}
+    print("Flagged without a PDF: %s, PDF without a flag: %s, PDF without a crash: %s" % (
+        len(missing), len(unflagged), len(orphans)))
+    if orphans:
+        print("PDFs without a crash (first 20): %s" % orphans[:20])
+
+    max_missing = ATD_ETL_CONFIG["ATD_CR3HEAL_MAX_MISSING_FRACTION"] * len(flagged)
+    if not dry_run and not force and len(missing) > max_missing:
+        raise Exception("%s of %s flagged crashes have no PDF in S3 (more than %.0f%%), check "
+                        "AWS_CRIS_CR3_BUCKET_NAME, AWS_CRIS_CR3_BUCKET_PATH and the S3 permissions, "
+                        "or run again with --force" % (
+                            len(missing), len(flagged), ATD_ETL_CONFIG["ATD_CR3HEAL_MAX_MISSING_FRACTION"] * 100))
+
+    if not dry_run:
+        batch_size = ATD_ETL_CONFIG["ATD_CR3HEAL_UPDATE_BATCH_SIZE"]
+        # Set to N, so the CR3 downloader picks them up again
+        stats["set_n"] = update_flags(missing, "N", batch_size)
+        stats["set_y"] = update_flags(unflagged, "Y", batch_size)
+    return stats
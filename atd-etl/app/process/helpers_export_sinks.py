@@ -0,0 +1,152 @@
+"""
+Helpers for File Exports
+Author: Austin Transportation Department, Data & Technology Services
+
+Description: This script contains streaming writers (sinks) that save
+formatted crash and person records to local files instead of Socrata.
+Records are written page by page as they come out of the formatters,
+so memory usage stays constant regardless of the size of the table.
+
+Supported formats: NDJSON, CSV and GeoJSON, optionally gzip-compressed.
+"""
+
+import os
+import csv
+import json
+import gzip
+import tempfile
+
+
+def open_text_file(path, compress):
+    """
+    Opens a text file for writing, gzip-compressed if needed
+    :param path: string - The path of the file
+    :param compress: bool - True to gzip the file
+    :return: file - The file object
+    """
+    if compress:
+        return gzip.open(path, "wt", encoding="utf-8", newline="")
+    return open(path, "w", encoding="utf-8", newline="")
+
+
+def parse_point(point):
+    """
+    Parses the point created by create_point_datatype into a GeoJSON geometry
+    :param point: string - A point in the form of "POINT (longitude latitude)"
+    :return: dict - A GeoJSON Point geometry, or None
+    """
+    if not point:
+        return None
+    try:
+        longitude, latitude = point[point.index("(") + 1:point.index(")")].split()
+        return {"type": "Point", "coordinates": [float(longitude), float(latitude)]}
+    except ValueError:
+        return None
+
+
+class NdjsonSink:
+    """
+    Writes one JSON record per line
+    """
+    def __init__(self, path, compress=False):
+        self.path = path
+        self.file = open_text_file(path, compress)
+        self.total_records = 0
+
+    def write(self, records):
+        for record in records:
+            self.file.write(json.dumps(record, default=str))
+            self.file.write("\n")
+        self.total_records += len(records)
+
+    def close(self):
+        self.file.close()
+
+
+class GeojsonSink:
+    """
+    Writes a GeoJSON FeatureCollection, one feature per record. The geometry
+    comes from the "point" column; records without one get a null geometry.
+    """
+    def __init__(self, path, compress=False):
+        self.path = path
+        self.file = open_text_file(path, compress)
+        self.file.write('{"type": "FeatureCollection", "features": [\n')
+        self.total_records = 0
+
+    def write(self, records):
+        for record in records:
+            properties = dict(record)
+            feature = {
+                "type": "Feature",
+                "geometry": parse_point(properties.pop("point", None)),
+                "properties": properties,
+            }
+            if self.total_records > 0:
+                self.file.write(",\n")
+            self.file.write(json.dumps(feature, default=str))
+            self.total_records += 1
+
+    def close(self):
+        self.file.write("\n]}\n")
+        self.file.close()
+
+
+class CsvSink:
+    """
+    Writes a CSV file. Formatted records do not all share the same columns,
+    so rows are first spooled to a temporary file while the list of columns
+    grows, then the header and the padded rows are written to the output.
+    """
+    def __init__(self, path, compress=False):
+        self.path = path
+        self.compress = compress
+        self.columns = []
+        self.column_index = {}
+        self.spool = tempfile.TemporaryFile("w+", encoding="utf-8", newline="",
+                                            dir=os.path.dirname(path) or None)
+        self.writer = csv.writer(self.spool)
+        self.total_records = 0
+
+    def write(self, records):
+        for record in records:
+            for column in record.keys():
+                if column not in self.column_index:
+                    self.column_index[column] = len(self.columns)
+                    self.columns.append(column)
+            row = [""] * len(self.columns)
+            for column, value in record.items():
+                row[self.column_index[column]] = "" if value is None else value
+            self.writer.writerow(row)
+        self.total_records += len(records)
+
+    def close(self):
+        self.spool.seek(0)
+        column_count = len(self.columns)
+        with open_text_file(self.path, self.compress) as output:
+            writer = csv.writer(output)
+            writer.writerow(self.columns)
+            for row in csv.reader(self.spool):
+                writer.writerow(row + [""] * (column_count - len(row)))
+        self.spool.close()
+
+
+SINK_CLASSES = {
+    "ndjson": NdjsonSink,
+    "csv": CsvSink,
+    "geojson": GeojsonSink,
+}
+
+
+def open_sink(sink_type, output_path, name, compress=False):
+    """
+    Creates a file sink for a table
+    :param sink_type: string - One of ndjson, csv or geojson
+    :param output_path: string - The folder where the file is written
+    :param name: string - The name of the file, without extension
+    :param compress: bool - True to gzip the file
+    :return: object - The sink, with write(records) and close() methods
+    """
+    os.makedirs(output_path, exist_ok=True)
+    file_name = "%s.%s%s" % (name, sink_type, ".gz" if compress else "")
+    return SINK_CLASSES[sink_type](os.path.join(output_path, file_name), compress)
@@ -0,0 +1,154 @@
+"""
+Geocode Archive Helper
+Author: Austin Transportation Department, Data and Technology Services
+
+Description: With ATD_GEOCODE_METADATA=COMPACT, geocode_match_metadata only
+holds the fields we use, and the full provider responses can be archived
+outside of atd_txdot_crashes (and its change log), keyed by crash_id:
+
+- TABLE: Upserted into atd_txdot_geocode_responses, one insert per batch.
+- FILE: Appended to a gzip-compressed NDJSON file per run, in
+  ATD_GEOCODE_ARCHIVE_PATH.
+- NONE: The full responses are not kept (default).
+"""
+
+import os
+import gzip
+import json
+import datetime
+import threading
+
+from .config import ATD_ETL_CONFIG
+from .request import run_query
+
+
+def build_compact_metadata(response):
+    """
+    Returns the fields of a HERE-shaped response we use: relevance, match
+    level, matched address and coordinates
+    :param response: dict - The HERE-shaped response
+    :return: dict
+    """
+    try:
+        result = response["Response"]["View"][0]["Result"][0]
+    except (KeyError, IndexError, TypeError):
+        return {}
+
+    location = result.get("Location", {})
+    position = (location.get("NavigationPosition") or [{}])[0]
+    metadata = {
+        "relevance": result.get("Relevance"),
+        "match_level": result.get("MatchLevel"),
+        "match_type": result.get("MatchType"),
+        "label": location.get("Address", {}).get("Label"),
+        "latitude": position.get("Latitude"),
+        "longitude": position.get("Longitude"),
+    }
+    if "Provider" in response:
+        metadata["provider"] = response["Provider"]
+    return metadata
+
+
+insert_responses_mutation = """
+    mutation insertGeocodeResponses($objects: [atd_txdot_geocode_responses_insert_input!]!) {
+      insert_atd_txdot_geocode_responses(
+        objects: $objects,
+        on_conflict: {
+          constraint: atd_txdot_geocode_responses_pkey,
+          update_columns: [geocode_provider, response, created_at]
+        }
+      ) {
+        affected_rows
+      }
+    }
+"""
+
+
+class GeocodeArchive:
+    """
+    Thread-safe buffer of full geocode responses, written in batches
+    """
+    def __init__(self, mode, batch_size, path=None):
+        self.mode = mode
+        self.batch_size = max(1, batch_size)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.stats = {"archived": 0, "failed": 0}
+        self.file = None
+        if mode == "FILE":
+            os.makedirs(path, exist_ok=True)
+            self.file_path = os.path.join(path, "geocode-responses-%s.ndjson.gz" % (
+                datetime.datetime.now().strftime("%Y%m%d-%H%M%S")))
+            self.file = gzip.open(self.file_path, "wt", encoding="utf-8")
+
+    def add(self, crash_id, provider_id, response):
+        """
+        Queues the full response of a crash
+        :param crash_id: int - The crash id
+        :param provider_id: int - The value of geocode_provider
+        :param response: dict - The full response
+        """
+        with self.lock:
+            self.pending.append({"crash_id": int(crash_id), "geocode_provider": provider_id,
+                                 "response": response,
+                                 "created_at": datetime.datetime.now().isoformat()})
+            if len(self.pending) < self.batch_size:
+                return
+            objects, self.pending = self.pending, []
+            self.write(objects)
+
+    def write(self, objects):
+        """
+        Writes a batch of responses, must be called with the lock held
+        :param objects: list - The atd_txdot_geocode_responses rows
+        """
+        if self.mode == "FILE":
+            for row in objects:
+                self.file.write(json.dumps(row) + "\n")
+            self.stats["archived"] += len(objects)
+            return
+
+        response = run_query(insert_responses_mutation, variables={"objects": objects})
+        if response is not None and "errors" not in response:
+            self.stats["archived"] += len(objects)
+        else:
+            self.stats["failed"] += len(objects)
+            print("[Error] Could not archive %s geocode responses: %s" % (len(objects), response))
+
+    def close(self):
+        """
+        Writes the remaining responses
+        """
+        with self.lock:
+            if self.pending:
+                self.write(self.pending)
+                self.pending = []
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def report(self):
+        return "Geocode archive (%s): %s responses archived, %s failed" % (
+            self.mode, self.stats["archived"], self.stats["failed"])
+
+
+geocode_archive = None
+geocode_archive_lock = threading.Lock()
+
+
+def get_geocode_archive():
+    """
+    Returns the process-wide geocode archive, or None if it is disabled
+    :return: GeocodeArchive
+    """
+    global geocode_archive
+    if ATD_ETL_CONFIG["ATD_GEOCODE_ARCHIVE"] not in ["TABLE", "FILE"]:
+        return None
+    with geocode_archive_lock:
+        if geocode_archive is None:
+            geocode_archive = GeocodeArchive(
+                mode=ATD_ETL_CONFIG["ATD_GEOCODE_ARCHIVE"],
+                batch_size=ATD_ETL_CONFIG["ATD_GEOCODE_WRITE_BATCH_SIZE"],
+                path=ATD_ETL_CONFIG["ATD_GEOCODE_ARCHIVE_PATH"],
+            )
+        return geocode_archive
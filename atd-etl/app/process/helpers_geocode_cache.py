@@ -0,0 +1,228 @@
+"""
+Geocode Cache Helper
+Author: Austin Transportation Department, Data and Technology Services
+
+Description: Many crashes share the exact same final address (the same
+intersections and block faces over and over). This script provides a
+persistent cache of geocode results, keyed by the provider and the
+normalized address, so repeat addresses are answered locally instead of
+calling the HERE API. The address key is the canonical address (see
+helpers_address), the provider key is the cache_name of the provider
+(providers without one, ie. the stub, are never cached).
+
+Every entry stores the coordinates, the relevance and a trimmed version
+of the response, and it expires after a TTL. When the full responses are
+needed (ATD_GEOCODE_METADATA=FULL or an ATD_GEOCODE_ARCHIVE), the entries
+hold the full response instead, and trimmed entries are treated as misses.
+Addresses that the provider could not find are stored too (negative
+entries) with a shorter TTL. Provider errors (ie. throttling, network
+errors) are never cached.
+
+The cache is a SQLite file defined in ATD_GEOCODE_CACHE_PATH.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from .config import ATD_ETL_CONFIG
+from .helpers_address import normalize_address
+
+SECONDS_PER_DAY = 86400
+
+
+def normalize_cache_key(address):
+    """
+    Returns the key under which an address is cached, the canonical
+    address, so spelling variants of the same address share one entry
+    :param address: string - The final address, as returned by remove_duplicates
+    :return: string
+    """
+    return normalize_address(address)
+
+
+def trim_here_response(response):
+    """
+    Returns a copy of a HERE response with only the best result and the
+    fields we use. The trimmed response keeps the shape of the original,
+    so get_match_quality_here and get_coordinates_here can read it.
+    :param response: dict - The full HERE response
+    :return: dict
+    """
+    try:
+        result = response["Response"]["View"][0]["Result"][0]
+    except (KeyError, IndexError, TypeError):
+        return {"Response": {"View": []}}
+
+    location = result.get("Location", {})
+    trimmed = {
+        "Response": {
+            "View": [{
+                "Result": [{
+                    "Relevance": result.get("Relevance"),
+                    "MatchLevel": result.get("MatchLevel"),
+                    "MatchType": result.get("MatchType"),
+                    "Location": {
+                        "DisplayPosition": location.get("DisplayPosition"),
+                        "NavigationPosition": location.get("NavigationPosition"),
+                        "Address": {
+                            "Label": location.get("Address", {}).get("Label")
+                        }
+                    }
+                }]
+            }]
+        }
+    }
+    # Responses from a local provider are tagged with its name
+    if "Provider" in response:
+        trimmed["Provider"] = response["Provider"]
+    return trimmed
+
+
+def is_cacheable_response(response):
+    """
+    Returns True if a HERE response is a valid answer (found or not found),
+    False if it is an error that should be retried later.
+    :param response: dict - The HERE response
+    :return: bool
+    """
+    return isinstance(response, dict) \
+        and "error" not in response \
+        and isinstance(response.get("Response"), dict) \
+        and "View" in response["Response"]
+
+
+class GeocodeCache:
+    """
+    Thread-safe persistent geocode cache backed by SQLite
+    """
+    def __init__(self, path, ttl_days, negative_ttl_days, full_responses=False):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.ttl = ttl_days * SECONDS_PER_DAY
+        self.negative_ttl = negative_ttl_days * SECONDS_PER_DAY
+        self.full_responses = full_responses
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "negative_hits": 0, "misses": 0, "stored": 0}
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # Caches created before the provider key cannot tell which provider
+        # answered, they are dropped
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(geocode_cache)")]
+        if columns and "provider" not in columns:
+            print("Geocode cache: dropping the entries without a provider")
+            self.connection.execute("DROP TABLE geocode_cache")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS geocode_cache (
+                provider TEXT NOT NULL,
+                address_key TEXT NOT NULL,
+                latitude REAL,
+                longitude REAL,
+                relevance REAL,
+                response TEXT NOT NULL,
+                is_negative INTEGER NOT NULL,
+                created_at INTEGER NOT NULL,
+                expires_at INTEGER NOT NULL,
+                is_full INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (provider, address_key)
+            ) WITHOUT ROWID
+        """)
+        self.connection.commit()
+
+    def get(self, provider, address):
+        """
+        Returns the response cached by a provider for an address (trimmed,
+        unless the cache keeps full responses), or None
+        :param provider: string - The cache_name of the provider
+        :param address: string - The final address
+        :return: dict
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT response, is_negative FROM geocode_cache"
+                " WHERE provider = ? AND address_key = ? AND expires_at > ? AND is_full >= ?",
+                (provider, normalize_cache_key(address), int(time.time()),
+                 int(self.full_responses))).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["negative_hits" if row[1] else "hits"] += 1
+            return json.loads(row[0])
+
+    def put(self, provider, address, response, latitude, longitude, relevance):
+        """
+        Stores the response of a provider for an address, unless it is an error
+        :param provider: string - The cache_name of the provider
+        :param address: string - The final address
+        :param response: dict - The full HERE response
+        :param latitude: float - The latitude, 0 if not found
+        :param longitude: float - The longitude, 0 if not found
+        :param relevance: float - The match quality
+        """
+        if not is_cacheable_response(response):
+            return
+
+        is_negative = latitude == 0 or longitude == 0
+        now = int(time.time())
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO geocode_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (provider, normalize_cache_key(address), latitude, longitude, relevance,
+                 json.dumps(response if self.full_responses else trim_here_response(response)),
+                 int(is_negative), now, now + (self.negative_ttl if is_negative else self.ttl),
+                 int(self.full_responses)))
+            self.connection.commit()
+            self.stats["stored"] += 1
+
+    def purge_expired(self):
+        """
+        Removes expired entries from the cache
+        :return: int - The number of entries removed
+        """
+        with self.lock:
+            cursor = self.connection.execute(
+                "DELETE FROM geocode_cache WHERE expires_at <= ?", (int(time.time()),))
+            self.connection.commit()
+            return cursor.rowcount
+
+    def report(self):
+        """
+        Returns a printable summary of the cache statistics for this run
+        :return: string
+        """
+        lookups = self.stats["hits"] + self.stats["negative_hits"] + self.stats["misses"]
+        hit_rate = (lookups - self.stats["misses"]) / lookups * 100 if lookups > 0 else 0
+        return "Geocode cache: %s lookups, %s hits, %s negative hits, %s misses (API calls), " \
+               "%s stored, %.1f%% hit rate" % (lookups, self.stats["hits"], self.stats["negative_hits"],
+                                                self.stats["misses"], self.stats["stored"], hit_rate)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+geocode_cache = None
+geocode_cache_lock = threading.Lock()
+
+
+def get_geocode_cache():
+    """
+    Returns the process-wide geocode cache, or None if it is disabled
+    :return: GeocodeCache
+    """
+    global geocode_cache
+    if ATD_ETL_CONFIG["ATD_GEOCODE_CACHE"] != "ENABLED":
+        return None
+    with geocode_cache_lock:
+        if geocode_cache is None:
+            geocode_cache = GeocodeCache(
+                path=ATD_ETL_CONFIG["ATD_GEOCODE_CACHE_PATH"],
+                ttl_days=ATD_ETL_CONFIG["ATD_GEOCODE_CACHE_TTL_DAYS"],
+                negative_ttl_days=ATD_ETL_CONFIG["ATD_GEOCODE_CACHE_NEGATIVE_TTL_DAYS"],
+                full_responses=ATD_ETL_CONFIG["ATD_GEOCODE_METADATA"] == "FULL"
+                or ATD_ETL_CONFIG["ATD_GEOCODE_ARCHIVE"] in ["TABLE", "FILE"],
+            )
+        return geocode_cache
@@ -0,0 +1,311 @@
+"""
+Geocode Providers
+Author: Austin Transportation Department, Data and Technology Services
+
+Description: This script defines the geocoding providers used by the
+geocoder. Every provider answers with a HERE-shaped response, so the
+rest of the geocoder (match quality, coordinates, cache, metadata) does
+not need to know which provider was used.
+
+- here: One HTTP request per address against the HERE geocoder.
+- here_batch: Submits all addresses as a single HERE batch geocoding job.
+- streets: Answers from the street centerlines, without network access,
+  and falls back to HERE for the addresses it cannot resolve.
+- stub: Answers from a local JSON file, for tests and dry runs.
+
+The application requires the requests library:
+    https://pypi.org/project/requests/
+"""
+
+import io
+import re
+import csv
+import json
+import time
+import zipfile
+
+from .config import ATD_ETL_CONFIG
+from .helpers_geocode_cache import normalize_cache_key
+from .helpers_rate_limit import request_with_rate_limit
+
+
+def build_here_response(latitude, longitude, relevance, match_level=None, label=None, provider=None):
+    """
+    Builds a HERE-shaped geocode response with a single result
+    :param latitude: float - The latitude
+    :param longitude: float - The longitude
+    :param relevance: float - The match quality from 0 to 1
+    :param match_level: string - The match level (ie. houseNumber, intersection)
+    :param label: string - The matched address
+    :param provider: string - The name of the provider, if it is not HERE
+    :return: dict
+    """
+    position = [{"Latitude": latitude, "Longitude": longitude}]
+    response = {
+        "Response": {
+            "View": [{
+                "Result": [{
+                    "Relevance": relevance,
+                    "MatchLevel": match_level,
+                    "Location": {
+                        "DisplayPosition": position[0],
+                        "NavigationPosition": position,
+                        "Address": {"Label": label}
+                    }
+                }]
+            }]
+        }
+    }
+    if provider:
+        response["Provider"] = provider
+    return response
+
+
+def build_here_empty_response():
+    """
+    Builds a HERE-shaped response for an address that was not found
+    :return: dict
+    """
+    return {"Response": {"View": []}}
+
+
+class GeocodeProvider:
+    """
+    Base class for geocode providers
+    """
+    name = None
+    # The value stored in atd_txdot_crashes.geocode_provider
+    provider_id = 0
+    # The key of the responses in the geocode cache, None to never cache them
+    cache_name = None
+
+    def geocode(self, address):
+        """
+        Geocodes a single address
+        :param address: string - The address
+        :return: dict - A HERE-shaped response, or {"error": ...}
+        """
+        raise NotImplementedError
+
+    def geocode_batch(self, addresses):
+        """
+        Geocodes a list of addresses. Providers without a batch endpoint
+        geocode them one at a time.
+        :param addresses: list - List of addresses
+        :return: dict - Dict of address and response
+        """
+        return {address: self.geocode(address) for address in addresses}
+
+    def get_provider_id(self, response):
+        """
+        Returns the value for the geocode_provider column of a response
+        :param response: dict - The response returned by this provider
+        :return: int
+        """
+        return self.provider_id
+
+
+class HereProvider(GeocodeProvider):
+    """
+    Geocodes one address per request against the HERE geocoder
+    """
+    name = "here"
+    provider_id = 1
+    cache_name = "here"
+
+    def geocode(self, address):
+        # Imported here to avoid a circular import with the geocode helper
+        from .helpers_hasura_geocode import geocode_address_here
+        return geocode_address_here(address)
+
+
+class HereBatchProvider(HereProvider):
+    """
+    Geocodes all addresses in a single HERE batch geocoding job:
+    the job is submitted, polled until it completes and its results
+    are downloaded and mapped back to the addresses.
+    """
+    name = "here_batch"
+
+    def __init__(self):
+        self.endpoint = ATD_ETL_CONFIG["ATD_HERE_BATCH_API_ENDPOINT"]
+        self.credentials = {
+            "app_id": ATD_ETL_CONFIG["ATD_HERE_APP_ID"],
+            "app_code": ATD_ETL_CONFIG["ATD_HERE_APP_CODE"],
+        }
+
+    def submit_job(self, addresses):
+        """
+        Submits a batch job and returns its request id
+        :param addresses: list - List of addresses, the position is the record id
+        :return: string
+        """
+        body = "recId|searchText\n" + "\n".join(
+            "%s|%s" % (rec_id, address.replace("|", " ")) for rec_id, address in enumerate(addresses))
+        parameters = dict(self.credentials, **{
+            "action": "run",
+            "header": "true",
+            "inDelim": "|",
+            "outDelim": "|",
+            "outCols": "relevance,matchLevel,latitude,longitude,displayLatitude,displayLongitude,locationLabel",
+            "outputcombined": "true",
+            "mapview": ATD_ETL_CONFIG["ATD_HERE_BOUNDING_BOX"],
+            "prox": "30.268064,-97.742814,1000",
+            "gen": "9",
+        })
+        response = request_with_rate_limit("here", "POST", self.endpoint, params=parameters,
+                                           data=body.encode("utf-8"), headers={"Content-Type": "text/plain"})
+        response.raise_for_status()
+        return re.search(r"<RequestId>([^<]+)</RequestId>", response.text).group(1)
+
+    def wait_for_job(self, request_id):
+        """
+        Polls the status of a batch job until it completes
+        :param request_id: string - The request id
+        """
+        poll_interval = ATD_ETL_CONFIG["ATD_HERE_BATCH_POLL_INTERVAL"]
+        deadline = time.time() + ATD_ETL_CONFIG["ATD_HERE_BATCH_TIMEOUT"]
+        while time.time() < deadline:
+            response = request_with_rate_limit("here", "GET", "%s/%s" % (self.endpoint, request_id),
+                                               params=dict(self.credentials, action="status"))
+            response.raise_for_status()
+            status = re.search(r"<Status>([^<]+)</Status>", response.text).group(1)
+            print("Batch job %s: %s" % (request_id, status))
+            if status == "completed":
+                return
+            if status in ["failed", "cancelled", "deleted"]:
+                raise Exception("Batch job %s %s" % (request_id, status))
+            time.sleep(poll_interval)
+        raise Exception("Batch job %s timed out" % request_id)
+
+    def download_results(self, request_id):
+        """
+        Downloads the results of a batch job
+        :param request_id: string - The request id
+        :return: dict - Dict of record id and HERE-shaped response
+        """
+        response = request_with_rate_limit("here", "GET", "%s/%s/result" % (self.endpoint, request_id),
+                                           params=dict(self.credentials, outputcompressed="true"))
+        response.raise_for_status()
+
+        results = {}
+        with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+            for file_name in archive.namelist():
+                with archive.open(file_name) as file:
+                    reader = csv.DictReader(io.TextIOWrapper(file, encoding="utf-8"), delimiter="|")
+                    for row in reader:
+                        rec_id = int(row["recId"])
+                        # Results are sorted by relevance, keep the best one
+                        if rec_id in results or row.get("SeqNumber", "1") not in ["1", ""]:
+                            continue
+                        if not row.get("latitude") or not row.get("longitude"):
+                            results[rec_id] = build_here_empty_response()
+                            continue
+                        results[rec_id] = build_here_response(
+                            latitude=float(row["latitude"]),
+                            longitude=float(row["longitude"]),
+                            relevance=float(row.get("relevance") or 0),
+                            match_level=row.get("matchLevel"),
+                            label=row.get("locationLabel"),
+                        )
+        return results
+
+    def geocode_batch(self, addresses):
+        if len(addresses) == 0:
+            return {}
+        try:
+            request_id = self.submit_job(addresses)
+            print("Batch job %s submitted with %s addresses" % (request_id, len(addresses)))
+            self.wait_for_job(request_id)
+            results = self.download_results(request_id)
+        except Exception as e:
+            print("[Error] Batch geocoding failed: %s" % str(e))
+            return {address: {"error": str(e)} for address in addresses}
+
+        return {address: results.get(rec_id, build_here_empty_response())
+                for rec_id, address in enumerate(addresses)}
+
+
+class StubProvider(GeocodeProvider):
+    """
+    Answers from a local JSON file of normalized address and result:
+    {"100 N LAMAR BLVD, AUSTIN, TX": {"latitude": 30.1, "longitude": -97.7, "relevance": 1}}
+    Addresses missing from the file are not found.
+    """
+    name = "stub"
+
+    def __init__(self, path=None):
+        path = path or ATD_ETL_CONFIG["ATD_GEOCODE_STUB_FILE"]
+        with open(path) as file:
+            self.results = {normalize_cache_key(address): result
+                            for address, result in json.load(file).items()}
+
+    def geocode(self, address):
+        result = self.results.get(normalize_cache_key(address))
+        if result is None:
+            return build_here_empty_response()
+        return build_here_response(
+            latitude=result["latitude"],
+            longitude=result["longitude"],
+            relevance=result.get("relevance", 1),
+            match_level=result.get("match_level"),
+            label=result.get("label", address),
+        )
+
+
+class StreetsProvider(GeocodeProvider):
+    """
+    Resolves intersections and block addresses locally against the street
+    centerlines (see helpers_geocode_streets), and falls back to HERE for
+    the addresses that cannot be resolved, unless the fallback is disabled.
+    """
+    name = "streets"
+    provider_id = 2
+    # The HERE fallback responses are cached here too, they have no Provider marker
+    cache_name = "streets"
+
+    def __init__(self):
+        # Imported here so shapely is only required by this provider
+        from .helpers_geocode_streets import get_street_index
+        self.street_index = get_street_index()
+        self.fallback = HereProvider() if ATD_ETL_CONFIG["ATD_GEOCODE_STREETS_FALLBACK"] == "ENABLED" else None
+        self.stats = {"resolved": 0, "fallback": 0, "not_found": 0}
+
+    def geocode(self, address):
+        result = self.street_index.geocode(address)
+        if result is not None:
+            self.stats["resolved"] += 1
+            longitude, latitude, relevance, match_level = result
+            return build_here_response(latitude, longitude, relevance, match_level=match_level,
+                                       label=address, provider=self.name)
+        if self.fallback is None:
+            self.stats["not_found"] += 1
+            return build_here_empty_response()
+        self.stats["fallback"] += 1
+        return self.fallback.geocode(address)
+
+    def get_provider_id(self, response):
+        if isinstance(response, dict) and response.get("Provider") == self.name:
+            return self.provider_id
+        return self.fallback.provider_id if self.fallback else self.provider_id
+
+    def report(self):
+        return "Streets geocoder: %s resolved locally, %s sent to HERE, %s not found" % (
+            self.stats["resolved"], self.stats["fallback"], self.stats["not_found"])
+
+
+GEOCODE_PROVIDERS = {
+    HereProvider.name: HereProvider,
+    HereBatchProvider.name: HereBatchProvider,
+    StreetsProvider.name: StreetsProvider,
+    StubProvider.name: StubProvider,
+}
+
+
+def get_geocode_provider(name=None):
+    """
+    Returns a new instance of a geocode provider
+    :param name: string - The provider name (defaults to ATD_GEOCODE_PROVIDER)
+    :return: GeocodeProvider
+    """
+    return GEOCODE_PROVIDERS[name or ATD_ETL_CONFIG["ATD_GEOCODE_PROVIDER"]]()
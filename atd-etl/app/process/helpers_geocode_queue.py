@@ -0,0 +1,263 @@
+"""
+Geocode Queue Helper
+Author: Austin Transportation Department, Data and Technology Services
+
+Description: Decides which crashes get the geocode quota of a run. Crashes
+without coordinates are read from Hasura in priority order: by severity
+(fatal first, then serious injuries, then the rest) and, within each
+severity, by recency (crash_date and crash_id descending), paging with a
+keyset cursor instead of an offset.
+
+Crashes that could not be geocoded are remembered in a SQLite file with
+the reason, the number of attempts and the time of the next retry, which
+backs off exponentially. They are skipped until then, unless their address
+changed since they failed, so the quota of every run goes to crashes that
+can actually be geocoded.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+from .config import ATD_ETL_CONFIG
+from .request import run_query
+from .helpers_address import normalize_street
+
+SECONDS_PER_HOUR = 3600
+
+# Severity tiers, in the order they are geocoded (crash_sev_id:
+# 4 killed, 1 incapacitating, 2 non-incapacitating, 3 possible, 5 not injured, 0 unknown)
+SEVERITY_TIERS = [
+    {"crash_sev_id": {"_eq": 4}},
+    {"crash_sev_id": {"_eq": 1}},
+    {"crash_sev_id": {"_in": [2, 3]}},
+    {"_or": [{"crash_sev_id": {"_nin": [1, 2, 3, 4]}}, {"crash_sev_id": {"_is_null": True}}]},
+]
+
+geocode_queue_query = """
+    query getGeocodeQueue($where: atd_txdot_crashes_bool_exp!, $limit: Int!) {
+      atd_txdot_crashes(
+        where: $where,
+        order_by: [{crash_date: desc_nulls_last}, {crash_id: desc}],
+        limit: $limit
+      ) {
+        crash_id
+        crash_date
+        crash_sev_id
+        geocoded
+        rpt_block_num
+        rpt_street_pfx
+        rpt_street_name
+        rpt_street_sfx
+        rpt_sec_block_num
+        rpt_sec_street_pfx
+        rpt_sec_street_name
+        rpt_sec_street_sfx
+        rpt_city_id
+        rpt_cris_cnty_id
+      }
+    }
+"""
+
+# Same filter as get_geocode_list
+NOT_GEOCODED_FILTER = {
+    "longitude": {"_is_null": True},
+    "latitude": {"_is_null": True},
+    "latitude_geocoded": {"_is_null": True},
+    "longitude_geocoded": {"_is_null": True},
+    "latitude_primary": {"_is_null": True},
+    "longitude_primary": {"_is_null": True},
+    "city_id": {"_eq": 22},
+}
+
+
+def get_address_key(record):
+    """
+    Returns the canonical address fields of a crash, used to detect
+    whether its address changed since it last failed
+    :param record: dict - The record as it comes straight from hasura
+    :return: string
+    """
+    return " | ".join(
+        normalize_street(record.get(prefix + "block_num"), record.get(prefix + "street_pfx"),
+                         record.get(prefix + "street_name"), record.get(prefix + "street_sfx"))
+        for prefix in ["rpt_", "rpt_sec_"])
+
+
+def build_cursor_filter(cursor):
+    """
+    Returns the filter of the records after a cursor, in the order
+    crash_date desc (nulls last), crash_id desc
+    :param cursor: tuple - (crash_date, crash_id) of the last record, or None
+    :return: dict
+    """
+    if cursor is None:
+        return {}
+    crash_date, crash_id = cursor
+    if crash_date is None:
+        return {"crash_date": {"_is_null": True}, "crash_id": {"_lt": crash_id}}
+    return {"_or": [
+        {"crash_date": {"_lt": crash_date}},
+        {"crash_date": {"_eq": crash_date}, "crash_id": {"_lt": crash_id}},
+        {"crash_date": {"_is_null": True}},
+    ]}
+
+
+class GeocodeQueue:
+    """
+    Priority queue of crashes to geocode, with a persistent memory of failures
+    """
+    def __init__(self, path, page_size, backoff_hours, max_backoff_hours, error_backoff_hours):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.page_size = page_size
+        self.backoff = backoff_hours * SECONDS_PER_HOUR
+        self.max_backoff = max_backoff_hours * SECONDS_PER_HOUR
+        self.error_backoff = error_backoff_hours * SECONDS_PER_HOUR
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.stats = {"read": 0, "queued": 0, "skipped": 0, "failed": 0, "done": 0}
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS geocode_failures (
+                crash_id INTEGER PRIMARY KEY,
+                address_key TEXT NOT NULL,
+                reason TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                failed_at INTEGER NOT NULL,
+                retry_at INTEGER NOT NULL
+            )
+        """)
+        self.connection.commit()
+
+    def get_failures(self, crash_ids):
+        """
+        Returns the failures of a list of crashes
+        :param crash_ids: list - The crash ids
+        :return: dict - Dict of crash_id and (address_key, retry_at)
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT crash_id, address_key, retry_at FROM geocode_failures WHERE crash_id IN (%s)"
+                % ",".join("?" * len(crash_ids)), crash_ids).fetchall()
+        return {row[0]: (row[1], row[2]) for row in rows}
+
+    def is_skipped(self, record, failure, now):
+        """
+        Returns True if a crash failed before, its backoff has not expired
+        and its address has not changed since it failed
+        """
+        if failure is None:
+            return False
+        address_key, retry_at = failure
+        return retry_at > now and address_key == get_address_key(record)
+
+    def get_records(self, quota):
+        """
+        Returns up to quota crashes to geocode, in priority order
+        :param quota: int - The maximum number of records
+        :return: list
+        """
+        records = []
+        now = int(time.time())
+        for tier in SEVERITY_TIERS:
+            cursor = None
+            while len(records) < quota:
+                where = {"_and": [NOT_GEOCODED_FILTER, tier, build_cursor_filter(cursor)]}
+                response = run_query(geocode_queue_query, variables={"where": where, "limit": self.page_size})
+                if response is None or "errors" in response:
+                    raise Exception("Could not read the geocode queue: %s" % response)
+
+                page = response["data"]["atd_txdot_crashes"]
+                self.stats["read"] += len(page)
+                failures = self.get_failures([record["crash_id"] for record in page]) if page else {}
+                for record in page:
+                    if self.is_skipped(record, failures.get(record["crash_id"]), now):
+                        self.stats["skipped"] += 1
+                        continue
+                    records.append(record)
+                    if len(records) >= quota:
+                        break
+
+                if len(page) < self.page_size:
+                    break
+                cursor = (page[-1]["crash_date"], page[-1]["crash_id"])
+
+        with self.lock:
+            self.pending.update({record["crash_id"]: record for record in records})
+        self.stats["queued"] = len(records)
+        return records
+
+    def mark_failed(self, crash_id, reason, is_error=False):
+        """
+        Records that a crash could not be geocoded. Errors (ie. the provider
+        could not be reached) are retried sooner than addresses that were
+        not found, and every new failure doubles the backoff.
+        :param crash_id: int - The crash id
+        :param reason: string - Why it failed
+        :param is_error: bool - True if the failure is not caused by the address
+        """
+        with self.lock:
+            record = self.pending.pop(crash_id, None)
+            if record is None:
+                return
+            row = self.connection.execute(
+                "SELECT address_key, attempts FROM geocode_failures WHERE crash_id = ?", (crash_id,)).fetchone()
+            address_key = get_address_key(record)
+            # The backoff starts over when the address changed
+            attempts = row[1] + 1 if row is not None and row[0] == address_key else 1
+            now = int(time.time())
+            backoff = self.error_backoff if is_error else min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO geocode_failures VALUES (?, ?, ?, ?, ?, ?)",
+                (crash_id, address_key, reason, attempts, now, now + int(backoff)))
+            self.connection.commit()
+            self.stats["failed"] += 1
+
+    def mark_done(self, crash_id):
+        """
+        Records that a crash was geocoded, and forgets its failures
+        :param crash_id: int - The crash id
+        """
+        with self.lock:
+            if self.pending.pop(crash_id, None) is None:
+                return
+            self.connection.execute("DELETE FROM geocode_failures WHERE crash_id = ?", (crash_id,))
+            self.connection.commit()
+            self.stats["done"] += 1
+
+    def report(self):
+        return "Geocode queue: %s read, %s skipped (failed before), %s queued, %s geocoded, %s failed" % (
+            self.stats["read"], self.stats["skipped"], self.stats["queued"], self.stats["done"],
+            self.stats["failed"])
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+geocode_queue = None
+geocode_queue_lock = threading.Lock()
+
+
+def get_geocode_queue():
+    """
+    Returns the process-wide geocode queue, or None if it is disabled
+    :return: GeocodeQueue
+    """
+    global geocode_queue
+    if ATD_ETL_CONFIG["ATD_GEOCODE_QUEUE"] != "ENABLED":
+        return None
+    with geocode_queue_lock:
+        if geocode_queue is None:
+            geocode_queue = GeocodeQueue(
+                path=ATD_ETL_CONFIG["ATD_GEOCODE_QUEUE_PATH"],
+                page_size=ATD_ETL_CONFIG["ATD_GEOCODE_QUEUE_PAGE_SIZE"],
+                backoff_hours=ATD_ETL_CONFIG["ATD_GEOCODE_QUEUE_BACKOFF_HOURS"],
+                max_backoff_hours=ATD_ETL_CONFIG["ATD_GEOCODE_QUEUE_MAX_BACKOFF_HOURS"],
+                error_backoff_hours=ATD_ETL_CONFIG["ATD_GEOCODE_QUEUE_ERROR_BACKOFF_HOURS"],
+            )
+        return geocode_queue
@@ -0,0 +1,307 @@
+"""
+Street Centerline Geocoder
+Author: Austin Transportation Department, Data and Technology Services
+
+Description: A local geocoder backed by the street centerlines in the
+atd_txdot_streets table. The centerlines are downloaded from Hasura once,
+kept in a local snapshot file and loaded into an in-memory STRtree, so
+addresses are resolved without any network access:
+
+- Intersections ("A & B, AUSTIN, TX") are the geometric intersection of
+  the segments named A and the segments named B.
+- Block addresses ("1100 N LAMAR BLVD, AUSTIN, TX") are interpolated
+  along the segment whose address range contains the block number.
+
+The street geometries are expected in WGS 84 (longitude, latitude).
+
+The application requires the shapely library, it is only imported when
+the street index is loaded:
+    https://pypi.org/project/Shapely/
+"""
+
+import os
+import gzip
+import json
+import time
+import threading
+from functools import lru_cache
+
+from .config import ATD_ETL_CONFIG
+from .request import run_query
+from .helpers_address import get_vocabulary
+from .helpers_geocode_cache import normalize_cache_key
+
+SECONDS_PER_DAY = 86400
+
+DIRECTIONS = {
+    "N": "N", "NORTH": "N",
+    "S": "S", "SOUTH": "S",
+    "E": "E", "EAST": "E",
+    "W": "W", "WEST": "W",
+    "NB": "N", "SB": "S", "EB": "E", "WB": "W",
+}
+
+streets_query = """
+    query getStreets($limit: Int!, $offset: Int!) {
+      atd_txdot_streets(limit: $limit, offset: $offset, order_by: {street_id: asc}) {
+        street_id
+        prefix_direction
+        street_name
+        street_type
+        suffix_direction
+        left_from_address
+        left_to_address
+        right_from_address
+        right_to_address
+        shape
+      }
+    }
+"""
+
+
+def download_streets(page_size=5000):
+    """
+    Downloads all the street segments from Hasura
+    :param page_size: int - The number of segments per request
+    :return: list - List of street segment dicts, the shape is GeoJSON
+    """
+    streets = []
+    while True:
+        response = run_query(streets_query, variables={"limit": page_size, "offset": len(streets)})
+        if response is None or "errors" in response:
+            raise Exception("Could not download the street segments: %s" % response)
+        page = response["data"]["atd_txdot_streets"]
+        streets += [street for street in page if street.get("shape")]
+        if len(page) < page_size:
+            return streets
+
+
+def load_streets(path=None, max_age_days=None):
+    """
+    Returns the street segments from the local snapshot, the snapshot is
+    downloaded from Hasura when it is missing or older than max_age_days.
+    If the download fails, an outdated snapshot is still used.
+    :param path: string - The snapshot path (defaults to ATD_GEOCODE_STREETS_PATH)
+    :param max_age_days: int - Days before the snapshot is refreshed
+    :return: list - List of street segment dicts
+    """
+    path = path or ATD_ETL_CONFIG["ATD_GEOCODE_STREETS_PATH"]
+    max_age_days = ATD_ETL_CONFIG["ATD_GEOCODE_STREETS_MAX_AGE_DAYS"] if max_age_days is None else max_age_days
+    is_fresh = os.path.exists(path) and time.time() - os.path.getmtime(path) < max_age_days * SECONDS_PER_DAY
+
+    if not is_fresh:
+        try:
+            streets = download_streets()
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with gzip.open(path + ".part", "wt") as file:
+                json.dump(streets, file)
+            os.replace(path + ".part", path)
+            print("Street snapshot: %s segments downloaded to '%s'" % (len(streets), path))
+            return streets
+        except Exception as e:
+            if not os.path.exists(path):
+                raise
+            print("[Error] Could not refresh the street snapshot, using '%s': %s" % (path, str(e)))
+
+    with gzip.open(path, "rt") as file:
+        return json.load(file)
+
+
+def street_key(tokens):
+    """
+    Returns the lookup key of a tokenized street name, without
+    the directions and with the prefix/suffix directions normalized
+    :param tokens: list - The tokens of the street name
+    :return: string
+    """
+    return " ".join(DIRECTIONS.get(token, token) for token in tokens)
+
+
+class StreetIndex:
+    """
+    In-memory index of street centerlines: segments by name, and a STRtree
+    over their geometries for the geometric intersection of two streets.
+    """
+    def __init__(self, streets):
+        # Imported here so the rest of the geocoder runs without shapely
+        from shapely.geometry import shape
+        from shapely.strtree import STRtree
+
+        self.segments = []
+        self.geometries = []
+        self.segments_by_name = {}
+        self.street_types = set()
+
+        for street in streets:
+            geometry = shape(street["shape"])
+            if geometry.is_empty:
+                continue
+            index = len(self.segments)
+            self.segments.append(street)
+            self.geometries.append(geometry)
+
+            street_type = normalize_cache_key(street.get("street_type") or "")
+            if street_type:
+                self.street_types.add(get_vocabulary()[0].get(street_type, street_type))
+
+            full_name = street_key(normalize_cache_key(" ".join(
+                filter(None, [street.get("prefix_direction"), street.get("street_name"),
+                              street.get("street_type"), street.get("suffix_direction")]))).split())
+            bare_name = normalize_cache_key(street.get("street_name") or "")
+            for name in {full_name, bare_name}:
+                if name:
+                    self.segments_by_name.setdefault(name, []).append(index)
+
+        self.tree = STRtree(self.geometries)
+        # Shapely 1.x returns geometries from the tree, 2.x returns indices
+        self.index_by_geometry = {id(geometry): index for index, geometry in enumerate(self.geometries)}
+
+    def query(self, geometry):
+        """
+        Returns the indices of the segments whose bounding box intersects a geometry
+        :param geometry: shapely geometry
+        :return: list
+        """
+        return [int(hit) if not hasattr(hit, "geom_type") else self.index_by_geometry[id(hit)]
+                for hit in self.tree.query(geometry)]
+
+    def find_segments(self, street):
+        """
+        Returns the segment indices of a street, matching the full name first
+        and then the name without directions and street type
+        :param street: string - The street (ie. N LAMAR BLVD)
+        :return: list
+        """
+        tokens = normalize_cache_key(street).split()
+        segments = self.segments_by_name.get(street_key(tokens))
+        if segments:
+            return segments
+
+        if len(tokens) > 1 and tokens[0] in DIRECTIONS:
+            tokens = tokens[1:]
+        if len(tokens) > 1 and tokens[-1] in DIRECTIONS:
+            tokens = tokens[:-1]
+        if len(tokens) > 1 and tokens[-1] in self.street_types:
+            tokens = tokens[:-1]
+        return self.segments_by_name.get(" ".join(tokens), [])
+
+    def geocode_intersection(self, first_street, second_street):
+        """
+        Returns the point where two streets cross, or None
+        :return: tuple - (longitude, latitude, relevance)
+        """
+        second_segments = set(self.find_segments(second_street))
+        if not second_segments:
+            return None
+
+        points = []
+        for first_index in self.find_segments(first_street):
+            first_geometry = self.geometries[first_index]
+            for second_index in self.query(first_geometry):
+                if second_index not in second_segments:
+                    continue
+                crossing = first_geometry.intersection(self.geometries[second_index])
+                if not crossing.is_empty:
+                    points.append(crossing.centroid)
+
+        if not points:
+            return None
+
+        # Streets that cross more than once (ie. loops) are a less certain match
+        longitude = sum(point.x for point in points) / len(points)
+        latitude = sum(point.y for point in points) / len(points)
+        spread = max(max(abs(point.x - longitude), abs(point.y - latitude)) for point in points)
+        return longitude, latitude, 1 if spread < 0.0005 else 0.7
+
+    def geocode_block(self, number, street):
+        """
+        Interpolates a block number along the segment of a street whose
+        address range contains it, or returns None
+        :return: tuple - (longitude, latitude, relevance)
+        """
+        candidates = []
+        for index in self.find_segments(street):
+            segment = self.segments[index]
+            for side in ["left", "right"]:
+                address_from = segment.get("%s_from_address" % side)
+                address_to = segment.get("%s_to_address" % side)
+                if address_from is None or address_to is None:
+                    continue
+                if min(address_from, address_to) <= number <= max(address_from, address_to):
+                    # Prefer the side with the same parity as the number
+                    candidates.append((address_from % 2 != number % 2, index, address_from, address_to))
+
+        if not candidates:
+            return None
+
+        _, index, address_from, address_to = min(candidates)
+        fraction = 0.5 if address_from == address_to else (number - address_from) / (address_to - address_from)
+        point = interpolate(self.geometries[index], fraction)
+        return point.x, point.y, 0.9
+
+    @lru_cache(maxsize=100000)
+    def geocode(self, address):
+        """
+        Geocodes an address rendered by render_geocode_address
+        :param address: string - The address
+        :return: tuple - (longitude, latitude, relevance, match_level), or None
+        """
+        address = normalize_cache_key(address)
+        for suffix in [", AUSTIN, TX", ", AUSTIN"]:
+            if address.endswith(suffix):
+                address = address[:-len(suffix)]
+
+        if " & " in address:
+            first_street, second_street = address.split(" & ", 1)
+            result = self.geocode_intersection(first_street, second_street)
+            return result + ("intersection",) if result else None
+
+        tokens = address.split()
+        if len(tokens) < 2 or not tokens[0].isdigit():
+            return None
+        result = self.geocode_block(int(tokens[0]), " ".join(tokens[1:]))
+        return result + ("houseNumber",) if result else None
+
+
+def interpolate(geometry, fraction):
+    """
+    Returns the point at a fraction of the length of a line
+    :param geometry: LineString or MultiLineString
+    :param fraction: float - From 0 to 1
+    :return: Point
+    """
+    from shapely.ops import linemerge
+
+    fraction = min(1.0, max(0.0, fraction))
+    if geometry.geom_type == "MultiLineString":
+        merged = linemerge(geometry)
+        if merged.geom_type == "LineString":
+            geometry = merged
+        else:
+            # Disconnected parts, walk them in order
+            distance = geometry.length * fraction
+            for part in geometry.geoms:
+                if distance <= part.length:
+                    return part.interpolate(distance)
+                distance -= part.length
+            return geometry.geoms[-1].interpolate(1, normalized=True)
+    return geometry.interpolate(fraction, normalized=True)
+
+
+street_index = None
+street_index_lock = threading.Lock()
+
+
+def get_street_index():
+    """
+    Returns the process-wide street index, loading it on first use
+    :return: StreetIndex
+    """
+    global street_index
+    with street_index_lock:
+        if street_index is None:
+            start = time.time()
+            street_index = StreetIndex(load_streets())
+            print("Street index: %s segments loaded in %.1f seconds" % (
+                len(street_index.segments), time.time() - start))
+        return street_index
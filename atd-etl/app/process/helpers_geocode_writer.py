@@ -0,0 +1,163 @@
+"""
+Geocode Writer Helper
+Author: Austin Transportation Department, Data and Technology Services
+
+Description: Collects geocode results and writes them back to Hasura in
+batches: each flush is a single GraphQL request with one aliased
+update_atd_txdot_crashes mutation per crash, and all values are passed
+as GraphQL variables. A flush happens when the batch is full, or when
+the oldest pending result has waited longer than the flush interval.
+
+If a batch is rejected (Hasura runs all the mutations of a request in a
+single transaction), its records are written one at a time so a single
+bad record does not hold back the rest.
+
+The application requires the requests library:
+    https://pypi.org/project/requests/
+"""
+
+import time
+import threading
+
+from .config import ATD_ETL_CONFIG
+from .request import run_query
+
+
+def build_update_mutation(updates):
+    """
+    Builds a mutation with one aliased update per crash, and its variables
+    :param updates: list - List of (crash_id, set_values) tuples
+    :return: tuple - The mutation string and the variables dict
+    """
+    declarations = []
+    mutations = []
+    variables = {}
+    for index, (crash_id, set_values) in enumerate(updates):
+        declarations.append("$crash_id_%s: Int!, $set_%s: atd_txdot_crashes_set_input!" % (index, index))
+        mutations.append("""
+      update_%s: update_atd_txdot_crashes(where: {crash_id: {_eq: $crash_id_%s}}, _set: $set_%s) {
+        affected_rows
+      }""" % (index, index, index))
+        variables["crash_id_%s" % index] = int(crash_id)
+        variables["set_%s" % index] = set_values
+
+    mutation = """
+    mutation updateCrashesGeocoded(%s) {%s
+    }
+    """ % (", ".join(declarations), "".join(mutations))
+
+    return mutation, variables
+
+
+class GeocodeWriter:
+    """
+    Thread-safe buffer of geocode updates, flushed by size or by time
+    """
+    def __init__(self, batch_size, flush_interval):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = []
+        self.oldest = None
+        self.stats = {"records": 0, "requests": 0, "failed": 0}
+        self.closed = threading.Event()
+        self.timer = threading.Thread(target=self.flush_on_interval, daemon=True)
+        self.timer.start()
+
+    def add(self, crash_id, set_values):
+        """
+        Queues an update for a crash, flushing if the batch is full
+        :param crash_id: int - The crash id
+        :param set_values: dict - The columns to update
+        """
+        with self.lock:
+            self.pending.append((crash_id, set_values))
+            if self.oldest is None:
+                self.oldest = time.time()
+            is_full = len(self.pending) >= self.batch_size
+        if is_full:
+            self.flush()
+
+    def take_pending(self):
+        with self.lock:
+            updates = self.pending[:self.batch_size]
+            self.pending = self.pending[self.batch_size:]
+            self.oldest = time.time() if self.pending else None
+            return updates
+
+    def flush(self):
+        """
+        Writes all pending updates to Hasura, one request per batch
+        """
+        with self.flush_lock:
+            updates = self.take_pending()
+            while updates:
+                self.write(updates)
+                updates = self.take_pending()
+
+    def write(self, updates):
+        """
+        Writes a batch of updates, or one at a time if the batch is rejected
+        :param updates: list - List of (crash_id, set_values) tuples
+        """
+        mutation, variables = build_update_mutation(updates)
+        response = run_query(mutation, variables=variables)
+        self.stats["requests"] += 1
+
+        if response is not None and "errors" not in response:
+            self.stats["records"] += len(updates)
+            print("Geocode writer: %s records updated in one request" % len(updates))
+            return
+
+        print("Geocode writer: batch rejected, writing %s records one at a time: %s" % (len(updates), response))
+        for update in updates:
+            mutation, variables = build_update_mutation([update])
+            response = run_query(mutation, variables=variables)
+            self.stats["requests"] += 1
+            if response is not None and "errors" not in response:
+                self.stats["records"] += 1
+            else:
+                self.stats["failed"] += 1
+                print("[Error] Could not update crash_id: %s, %s" % (update[0], response))
+
+    def flush_on_interval(self):
+        """
+        Flushes pending updates that have waited longer than the flush interval
+        """
+        while not self.closed.wait(min(1, self.flush_interval)):
+            with self.lock:
+                is_due = self.oldest is not None and time.time() - self.oldest >= self.flush_interval
+            if is_due:
+                self.flush()
+
+    def close(self):
+        """
+        Stops the interval flush and writes the remaining updates
+        """
+        self.closed.set()
+        self.timer.join()
+        self.flush()
+
+    def report(self):
+        return "Geocode writer: %s records updated in %s requests, %s failed" % (
+            self.stats["records"], self.stats["requests"], self.stats["failed"])
+
+
+geocode_writer = None
+geocode_writer_lock = threading.Lock()
+
+
+def get_geocode_writer():
+    """
+    Returns the process-wide geocode writer
+    :return: GeocodeWriter
+    """
+    global geocode_writer
+    with geocode_writer_lock:
+        if geocode_writer is None:
+            geocode_writer = GeocodeWriter(
+                batch_size=ATD_ETL_CONFIG["ATD_GEOCODE_WRITE_BATCH_SIZE"],
+                flush_interval=ATD_ETL_CONFIG["ATD_GEOCODE_WRITE_FLUSH_SECONDS"],
+            )
+        return geocode_writer
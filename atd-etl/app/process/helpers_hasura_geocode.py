@@ -9,11 +9,10 @@ The accuracy of the geocoder is contingent on the quality of the addresses
 provided in the data; therefore, data refining needs to be a priority for
 when designing business logic or philosophy.
 
-The application requires the requests library:
-    https://pypi.org/project/requests/
+The HERE requests are made through the process-wide rate limiter, see
+helpers_rate_limit.
 """
 
-import requests
 import datetime
 import json
 
@@ -25,11 +24,19 @@ today = datetime.date.today()
 #
 from .config import ATD_ETL_CONFIG
 from .request import run_query
+from .helpers_address import normalize_street, normalize_address, normalize_keyword
+from .helpers_geocode_cache import get_geocode_cache
+from .helpers_geocode_providers import get_geocode_provider
+from .helpers_geocode_writer import get_geocode_writer
+from .helpers_geocode_queue import get_geocode_queue
+from .helpers_geocode_archive import get_geocode_archive, build_compact_metadata
+from .helpers_rate_limit import request_with_rate_limit
 
 
-def get_geocode_list():
+def get_geocode_list(limit=None):
     """
     Returns a list of records that need to be geocoded.
+    :param limit: int - Maximum number of records (defaults to ATD_HERE_RECORDS_PER_RUN)
     :return: dict
     """
     non_geocoded_records = """
@@ -61,47 +68,28 @@ def get_geocode_list():
       }
     }
     """ % (
-        ATD_ETL_CONFIG["ATD_HERE_RECORDS_PER_RUN"]
+        limit or ATD_ETL_CONFIG["ATD_HERE_RECORDS_PER_RUN"]
     )
 
     return run_query(non_geocoded_records)
 
 
-def update_record(crash_id, **kwargs):
-    """
-    Inserts lat/long into database geocoded fields.
-    :param crash_id: string - The crash id
-    :param kwargs: array - Additional variables we want to feed into the query
-    :return: dict - JSON response from Hasura
-    """
-
-    update_crash_latlong_query = """
-    mutation updateCrashGeocoded {
-      update_atd_txdot_crashes(
-        where: {crash_id: {_eq: %s}},
-        _set: {
-          geocode_date: "%s",
-          geocode_match_metadata: "%s",
-          geocode_match_quality: %s,
-          geocode_provider: 1,
-          geocode_status: "SUCCESS",
-          geocoded: "Y",
-          latitude_geocoded: %s,
-          longitude_geocoded: %s
-            }) {
-        affected_rows
-      }
+def update_record(**kwargs):
+    """
+    Returns the columns to set on a crash record once it is geocoded.
+    :param kwargs: array - The geocode values we want to feed into the update
+    :return: dict - The values for the _set argument of update_atd_txdot_crashes
+    """
+    return {
+        "geocode_date": kwargs["geocode_date"],
+        "geocode_match_metadata": json.dumps(kwargs["geocode_match_metadata"]),
+        "geocode_match_quality": kwargs["geocode_match_quality"],
+        "geocode_provider": kwargs.get("geocode_provider", 1),
+        "geocode_status": "SUCCESS",
+        "geocoded": "Y",
+        "latitude_geocoded": kwargs["latitude_geocoded"],
+        "longitude_geocoded": kwargs["longitude_geocoded"],
     }
-    """ % (
-        crash_id,
-        kwargs["geocode_date"],
-        json.dumps(kwargs["geocode_match_metadata"]).replace('"', '\\"'),
-        kwargs["geocode_match_quality"],
-        kwargs["latitude_geocoded"],
-        kwargs["longitude_geocoded"],
-    )
-
-    return update_crash_latlong_query
 
 
 def build_address(record, primary=True):
@@ -110,23 +98,14 @@ def build_address(record, primary=True):
     :param record: dict - The individual record as provided by get_geocode_list
     :return: string
     """
-    final_address = ""
-
-    if primary:
-        final_address = f'{record["rpt_block_num"]} {record["rpt_street_pfx"]} {record["rpt_street_name"]} {record["rpt_street_sfx"]}'
-    else:
-        final_address = f'{record["rpt_sec_block_num"]} {record["rpt_sec_street_pfx"]} {record["rpt_sec_street_name"]} {record["rpt_sec_street_sfx"]}'
-
-    final_address = (
-        final_address.replace("None", "")
-        .replace("null", "")
-        .replace(" ,", ",")
-        .replace("  ", " ")
-        .strip()
+    prefix = "rpt_" if primary else "rpt_sec_"
+    return normalize_street(
+        record.get(prefix + "block_num"),
+        record.get(prefix + "street_pfx"),
+        record.get(prefix + "street_name"),
+        record.get(prefix + "street_sfx"),
     )
 
-    return final_address
-
 
 def is_faulty_street(street):
     """
@@ -138,10 +117,12 @@ def is_faulty_street(street):
     if street == "" or street is None:
         return True
 
+    # The streets are normalized (see build_address), so are the keywords,
+    # ie. "PRIVATE ROAD" becomes "PRIVATE RD"
     list_of_bad_keywords = [
-        "PARKING LOT",
-        "NOT REPORTED",
-        "PRIVATE ROAD",
+        normalize_keyword("PARKING LOT"),
+        normalize_keyword("NOT REPORTED"),
+        normalize_keyword("PRIVATE ROAD"),
     ]
 
     # If it contains the words NOT REPORTED
@@ -228,9 +209,9 @@ def geocode_address_here(address):
     }
 
     try:
-        # Make request to API Endpoint
-        return requests.get(
-            ATD_ETL_CONFIG["ATD_HERE_API_ENDPOINT"], params=parameters
+        # Make request to API Endpoint, throttled requests are retried
+        return request_with_rate_limit(
+            "here", "GET", ATD_ETL_CONFIG["ATD_HERE_API_ENDPOINT"], params=parameters
         ).json()
         # coordinates = request.json()['Response']['View'][0]['Result'][0]['Location']['DisplayPosition']
     except Exception as e:
@@ -268,24 +249,7 @@ def remove_duplicates(address):
     :param address: string - The address being evaluated
     :return: string
     """
-    list_of_duplicates = {
-        "N N": "N",
-        "S S": "S",
-        "E E": "E",
-        "W W": "W",
-        "DR DR": "DR",
-        "LN LN": "LN",
-        "ST ST": "ST",
-        "RD RD": "RD",
-        "BLVD BLVD": "BLVD",
-        " ,": ",",
-        "  ": " ",
-    }
-
-    for k, v in list_of_duplicates.items():
-        address = address.replace(k, v).strip()
-
-    return address
+    return normalize_address(address)
 
 
 def get_coordinates_here(response):
@@ -306,10 +270,12 @@ def get_coordinates_here(response):
         return 0, 0
 
 
-def process_geocode_record(record):
+def render_geocode_address(record):
     """
-    This method will geocode a record and update it in the database
+    Renders the final address to be geocoded for a record, or returns
+    None if the record does not have enough information to be geocoded.
     :param record: dict - The record as it comes straight from hasura
+    :return: string
     """
 
     crash_id = record["crash_id"]
@@ -326,7 +292,7 @@ def process_geocode_record(record):
             "[Error] Skipping geocode, both primary and secondary streets are faulty, crash_id: %s"
             % crash_id
         )
-        return  # Nothing to do here
+        return None  # Nothing to do here
 
     # If either one of the streets is bad, then:
     if is_faulty_street(primary_address) or is_faulty_street(secondary_address):
@@ -336,7 +302,7 @@ def process_geocode_record(record):
         # If both are missing the block number, then it will be a
         # wild guess by just having one street, skip this record.
         if both_block_num_missing(record):
-            return  # Nothing to do here
+            return None  # Nothing to do here
 
     # Both addresses are ok
     is_intersection_response = is_intersection(record)
@@ -351,7 +317,7 @@ def process_geocode_record(record):
 
     if final_address is None:
         print("No street could be found for crash_id: %s" % crash_id)
-        return
+        return None
 
     final_address += ", AUSTIN, TX"
 
@@ -386,9 +352,50 @@ def process_geocode_record(record):
             "[Error] Skipping geocode, incomplete final address for crash_id: %s"
             % crash_id
         )
-        return
+        return None
+
+    return final_address
+
+
+def get_cached_response(final_address, provider):
+    """
+    Returns the response of a provider for an address from the cache, or
+    None if it is not cached, the cache is disabled or the provider is not
+    cached (ie. the stub)
+    :param final_address: string - The address to geocode
+    :param provider: GeocodeProvider - The provider
+    :return: dict
+    """
+    geocode_cache = get_geocode_cache()
+    if geocode_cache is None or provider.cache_name is None:
+        return None
+    return geocode_cache.get(provider.cache_name, final_address)
+
+
+def store_geocode_response(final_address, geocode_response, provider):
+    """
+    Stores a geocode response in the cache, if the cache is enabled and
+    the provider is cached
+    :param final_address: string - The address that was geocoded
+    :param geocode_response: dict - The HERE-shaped response
+    :param provider: GeocodeProvider - The provider that answered
+    """
+    geocode_cache = get_geocode_cache()
+    if geocode_cache and provider.cache_name is not None:
+        latitude, longitude = get_coordinates_here(geocode_response)
+        geocode_cache.put(provider.cache_name, final_address, geocode_response, latitude, longitude,
+                          get_match_quality_here(geocode_response))
+
 
-    geocode_response = geocode_address_here(final_address)
+def save_geocode_response(crash_id, geocode_response, provider_id=1):
+    """
+    Queues the update of a crash record with the coordinates of a geocode
+    response, the update is written to Hasura in batches by the geocode writer
+    :param crash_id: int - The crash id
+    :param geocode_response: dict - The HERE-shaped response
+    :param provider_id: int - The value for the geocode_provider column
+    :return: bool - True if the record was updated
+    """
     calculated_match_quality = get_match_quality_here(geocode_response)
     latitude, longitude = get_coordinates_here(geocode_response)
 
@@ -397,17 +404,115 @@ def process_geocode_record(record):
             "[Error] Skipping geocode, there are reported errors in the geocode for crash id: %s, error: %s"
             % (crash_id, json.dumps(geocode_response))
         )
-        return
+        return False
+
+    # Keep only the fields we use in the crash record, the full response can be archived
+    if ATD_ETL_CONFIG["ATD_GEOCODE_METADATA"] == "COMPACT":
+        geocode_match_metadata = build_compact_metadata(geocode_response)
+    else:
+        geocode_match_metadata = geocode_response
 
-    mutation_query = update_record(
-        crash_id=crash_id,
+    geocode_archive = get_geocode_archive()
+    if geocode_archive:
+        geocode_archive.add(crash_id, provider_id, geocode_response)
+
+    set_values = update_record(
         geocode_date=today.strftime("%Y-%m-%d"),
-        geocode_match_metadata=geocode_response,
+        geocode_match_metadata=geocode_match_metadata,
         geocode_match_quality=calculated_match_quality,
+        geocode_provider=provider_id,
         latitude_geocoded=latitude,
         longitude_geocoded=longitude,
     )
 
-    print(mutation_query)
+    print("Geocoded crash_id: %s, %s, %s" % (crash_id, latitude, longitude))
+
+    get_geocode_writer().add(crash_id, set_values)
+    return True
+
+
+def record_geocode_failure(crash_id, geocode_response):
+    """
+    Records in the geocode queue that a crash could not be geocoded
+    :param crash_id: int - The crash id
+    :param geocode_response: dict - The provider response, None if there was no address to geocode
+    """
+    geocode_queue = get_geocode_queue()
+    if geocode_queue is None:
+        return
+    if geocode_response is None:
+        geocode_queue.mark_failed(crash_id, "incomplete address")
+    elif "error" in geocode_response:
+        geocode_queue.mark_failed(crash_id, "error: %s" % geocode_response["error"], is_error=True)
+    else:
+        geocode_queue.mark_failed(crash_id, "not found")
+
+
+def record_geocode_success(crash_id):
+    """
+    Records in the geocode queue that a crash was geocoded
+    :param crash_id: int - The crash id
+    """
+    geocode_queue = get_geocode_queue()
+    if geocode_queue is not None:
+        geocode_queue.mark_done(crash_id)
+
+
+def process_geocode_record(record, provider=None):
+    """
+    This method will geocode a record and update it in the database
+    :param record: dict - The record as it comes straight from hasura
+    :param provider: GeocodeProvider - The provider (defaults to ATD_GEOCODE_PROVIDER)
+    """
+    provider = provider or get_geocode_provider()
+    crash_id = record["crash_id"]
+    final_address = render_geocode_address(record)
+    if final_address is None:
+        record_geocode_failure(crash_id, None)
+        return
+
+    # Repeat addresses are answered by the cache, otherwise ask the provider
+    geocode_response = get_cached_response(final_address, provider)
+
+    if geocode_response is None:
+        geocode_response = provider.geocode(final_address)
+        store_geocode_response(final_address, geocode_response, provider)
+
+    if save_geocode_response(crash_id, geocode_response, provider.get_provider_id(geocode_response)):
+        record_geocode_success(crash_id)
+    else:
+        record_geocode_failure(crash_id, geocode_response)
+
 
-    run_query(mutation_query)
+def process_geocode_batch(records, provider):
+    """
+    Geocodes a list of records in batch: the addresses are deduplicated
+    across all records, the ones not in the cache are sent to the provider
+    in a single batch, and the results are mapped back to the crash ids.
+    :param records: list - The records as they come straight from hasura
+    :param provider: GeocodeProvider - The batch provider
+    :return: list - List of (crash_id, response) tuples
+    """
+    crash_ids_by_address = {}
+    for record in records:
+        final_address = render_geocode_address(record)
+        if final_address is not None:
+            crash_ids_by_address.setdefault(final_address, []).append(record["crash_id"])
+
+    responses = {}
+    for final_address in crash_ids_by_address.keys():
+        cached_response = get_cached_response(final_address, provider)
+        if cached_response is not None:
+            responses[final_address] = cached_response
+
+    missing_addresses = [address for address in crash_ids_by_address.keys() if address not in responses]
+    print("Batch: %s records, %s unique addresses, %s cached, %s sent to '%s'" % (
+        len(records), len(crash_ids_by_address), len(responses), len(missing_addresses), provider.name))
+
+    for final_address, geocode_response in provider.geocode_batch(missing_addresses).items():
+        store_geocode_response(final_address, geocode_response, provider)
+        responses[final_address] = geocode_response
+
+    return [(crash_id, responses[final_address])
+            for final_address, crash_ids in crash_ids_by_address.items()
+            for crash_id in crash_ids]
@@ -0,0 +1,486 @@
+"""
+Helpers for Location Assignment
+Author: Austin Transportation Department, Data and Technology Services
+
+Description: This script contains methods that assign a location
+(atd_txdot_locations) to CR3 crashes and non-CR3 (blueform) collisions
+whose coordinates fall inside the location polygon.
+
+The application requires the requests library, and the shapely library
+for the in-process assignment:
+    https://pypi.org/project/requests/
+    https://pypi.org/project/Shapely/
+"""
+
+import os
+import gzip
+import glob
+import json
+import time
+import sqlite3
+import multiprocessing
+import concurrent.futures
+
+from .request import run_query, run_sql
+
+
+def assign_collision_locations(function_name, only_unassigned=True):
+    """
+    Assigns the locations of all the collisions of a table in a single
+    set-based statement, by calling one of the SQL functions in
+    atd-vzd/triggers/assign_collision_locations.sql
+    :param function_name: string - assign_cr3_collision_locations or assign_noncr3_collision_locations
+    :param only_unassigned: bool - False to re-evaluate collisions that already have a location
+    :return: int - The number of records updated
+    """
+    response = run_sql("SELECT public.%s(%s);" % (function_name, "true" if only_unassigned else "false"))
+    try:
+        # The first row of the result holds the column names
+        return int(response["result"][1][0])
+    except (KeyError, IndexError, TypeError, ValueError):
+        raise Exception("Could not assign the locations with %s: %s" % (function_name, response))
+
+
+#
+# In-process assignment: the location polygons are downloaded once (and cached
+# on disk by checksum), indexed in a shapely STRtree, and the unassigned records
+# are streamed from Hasura and tested in worker processes. The results are
+# written back grouped by location, with one `_in` update per location.
+#
+
+LOCATION_TABLES = {
+    "cr3": {
+        "table": "atd_txdot_crashes",
+        "id_column": "crash_id",
+        "latitude": "latitude_primary",
+        "longitude": "longitude_primary",
+        "sql_function": "assign_cr3_collision_locations",
+        "find_function": "find_cr3_collisions_for_location",
+    },
+    "noncr3": {
+        "table": "atd_apd_blueform",
+        "id_column": "form_id",
+        "latitude": "latitude",
+        "longitude": "longitude",
+        "sql_function": "assign_noncr3_collision_locations",
+        "find_function": "find_noncr3_collisions_for_location",
+    },
+}
+
+locations_checksum_sql = """
+    SELECT md5(string_agg(location_id || ':' || md5(ST_AsBinary(shape)), ',' ORDER BY location_id))
+    FROM atd_txdot_locations
+    WHERE shape IS NOT NULL;
+"""
+
+location_shapes_query = """
+    query getLocationShapes($limit: Int!, $offset: Int!) {
+      atd_txdot_locations(
+        where: {shape: {_is_null: false}},
+        order_by: {location_id: asc},
+        limit: $limit,
+        offset: $offset
+      ) {
+        location_id
+        shape
+      }
+    }
+"""
+
+unassigned_records_query = """
+    query getUnassignedRecords {
+      %(table)s(
+        where: {
+          _or: [{location_id: {_is_null: true}}, {location_id: {_eq: "None"}}]
+          %(latitude)s: {_is_null: false}
+          %(longitude)s: {_is_null: false}
+          %(id_column)s: {_gt: %(after)s}
+        },
+        order_by: {%(id_column)s: asc},
+        limit: %(limit)s
+      ) {
+        %(id_column)s
+        %(latitude)s
+        %(longitude)s
+      }
+    }
+"""
+
+
+def get_locations_checksum():
+    """
+    Returns a checksum of all the location shapes, computed in the database
+    :return: string
+    """
+    response = run_sql(locations_checksum_sql)
+    try:
+        return response["result"][1][0]
+    except (KeyError, IndexError, TypeError):
+        raise Exception("Could not compute the checksum of the location shapes: %s" % response)
+
+
+def download_location_shapes(page_size=1000):
+    """
+    Downloads the shapes of all the locations as GeoJSON
+    :param page_size: int - The number of locations per request
+    :return: list - List of (location_id, GeoJSON) tuples
+    """
+    shapes = []
+    while True:
+        response = run_query(location_shapes_query, variables={"limit": page_size, "offset": len(shapes)})
+        if response is None or "errors" in response:
+            raise Exception("Could not download the location shapes: %s" % response)
+        page = response["data"]["atd_txdot_locations"]
+        shapes += [(location["location_id"], location["shape"]) for location in page]
+        if len(page) < page_size:
+            return shapes
+
+
+def load_location_shapes(cache_path):
+    """
+    Returns the shapes of all the locations, from the disk cache if the
+    checksum of the shapes in the database did not change since they
+    were downloaded
+    :param cache_path: string - The folder of the cache files
+    :return: list - List of (location_id, GeoJSON) tuples
+    """
+    checksum = get_locations_checksum()
+    cache_file = os.path.join(cache_path, "locations-%s.json.gz" % checksum)
+    if os.path.exists(cache_file):
+        print("Location shapes: loaded from cache '%s'" % cache_file)
+        with gzip.open(cache_file, "rt") as file:
+            return json.load(file)
+
+    shapes = download_location_shapes()
+    os.makedirs(cache_path, exist_ok=True)
+    # Only the cache of the current checksum is kept
+    for old_file in glob.glob(os.path.join(cache_path, "locations-*.json.gz")):
+        os.remove(old_file)
+    with gzip.open(cache_file + ".part", "wt") as file:
+        json.dump(shapes, file)
+    os.replace(cache_file + ".part", cache_file)
+    print("Location shapes: %s downloaded, cached in '%s'" % (len(shapes), cache_file))
+    return shapes
+
+
+class LocationIndex:
+    """
+    STRtree of the location polygons, answering which location contains a point
+    """
+    def __init__(self, shapes):
+        # Imported here so the rest of the ETL runs without shapely
+        from shapely.geometry import shape
+        from shapely.strtree import STRtree
+
+        self.location_ids = []
+        self.polygons = []
+        for location_id, geojson in shapes:
+            polygon = shape(geojson)
+            if not polygon.is_empty:
+                self.location_ids.append(location_id)
+                self.polygons.append(polygon)
+        self.tree = STRtree(self.polygons)
+
+    def assign(self, points):
+        """
+        Returns the location of every point that falls inside a polygon.
+        When a point falls inside more than one, the lowest location_id
+        wins, as in the SQL functions.
+        :param points: list - List of (record_id, longitude, latitude) tuples
+        :return: dict - Dict of record_id and location_id
+        """
+        import shapely
+
+        geometries = shapely.points([(point[1], point[2]) for point in points])
+        # Vectorized: every (point, polygon) pair where the polygon contains the point
+        point_indices, polygon_indices = self.tree.query(geometries, predicate="within")
+
+        assignments = {}
+        for point_index, polygon_index in zip(point_indices.tolist(), polygon_indices.tolist()):
+            record_id = points[point_index][0]
+            location_id = self.location_ids[polygon_index]
+            if record_id not in assignments or location_id < assignments[record_id]:
+                assignments[record_id] = location_id
+        return assignments
+
+
+# The index of the worker processes, inherited from the parent process
+worker_location_index = None
+
+
+def assign_points_chunk(points):
+    return worker_location_index.assign(points)
+
+
+def assign_points(location_index, points, executor=None, workers=1):
+    """
+    Assigns a list of points, spread across the worker processes if there is an executor
+    :param location_index: LocationIndex - The index
+    :param points: list - List of (record_id, longitude, latitude) tuples
+    :param executor: ProcessPoolExecutor - The worker processes, or None
+    :param workers: int - The number of worker processes
+    :return: dict - Dict of record_id and location_id
+    """
+    if executor is None or len(points) < workers * 100:
+        return location_index.assign(points)
+
+    chunk_size = -(-len(points) // workers)
+    assignments = {}
+    for chunk_assignments in executor.map(assign_points_chunk,
+                                          [points[i:i + chunk_size] for i in range(0, len(points), chunk_size)]):
+        assignments.update(chunk_assignments)
+    return assignments
+
+
+def build_location_updates(table_config, assignments, batch_size):
+    """
+    Builds the mutations that write a page of assignments, grouped by location:
+    one aliased update with an `_in` filter per location, and up to batch_size
+    records per request
+    :param table_config: dict - The LOCATION_TABLES entry
+    :param assignments: dict - Dict of record_id and location_id
+    :param batch_size: int - Maximum number of records per request
+    :return: list - The mutations
+    """
+    record_ids_by_location = {}
+    for record_id, location_id in assignments.items():
+        record_ids_by_location.setdefault(location_id, []).append(record_id)
+
+    mutations = []
+    updates = []
+    records = 0
+    for location_id, record_ids in sorted(record_ids_by_location.items()):
+        for i in range(0, len(record_ids), batch_size):
+            ids = sorted(record_ids[i:i + batch_size])
+            if updates and records + len(ids) > batch_size:
+                mutations.append("mutation updateLocations {%s\n}" % "".join(updates))
+                updates, records = [], 0
+            updates.append("""
+  update_%s: update_%s(where: {%s: {_in: %s}}, _set: {location_id: %s}) {
+    affected_rows
+  }""" % (len(updates), table_config["table"], table_config["id_column"], json.dumps(ids), json.dumps(location_id)))
+            records += len(ids)
+    if updates:
+        mutations.append("mutation updateLocations {%s\n}" % "".join(updates))
+    return mutations
+
+
+def assign_locations_in_process(table_name, cache_path, page_size, workers, batch_size):
+    """
+    Streams all the unassigned records of a table through the STRtree
+    of the location polygons and writes the assignments back to Hasura
+    :param table_name: string - cr3 or noncr3
+    :param cache_path: string - The folder of the location shapes cache
+    :param page_size: int - The number of records read per request
+    :param workers: int - The number of worker processes
+    :param batch_size: int - The maximum number of records updated per request
+    :return: dict - Statistics of the run
+    """
+    global worker_location_index
+
+    table_config = LOCATION_TABLES[table_name]
+    location_index = LocationIndex(load_location_shapes(cache_path))
+    print("Location index: %s polygons" % len(location_index.polygons))
+
+    # Worker processes are forked after the index is built, so they share it
+    worker_location_index = location_index
+    executor = None
+    if workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+
+    stats = {"read": 0, "assigned": 0, "requests": 0, "failed": 0}
+    after = 0
+    try:
+        while True:
+            response = run_query(unassigned_records_query % dict(table_config, after=after, limit=page_size))
+            if response is None or "errors" in response:
+                raise Exception("Could not read the unassigned records: %s" % response)
+            page = response["data"][table_config["table"]]
+            if not page:
+                break
+
+            points = [(record[table_config["id_column"]], record[table_config["longitude"]],
+                       record[table_config["latitude"]]) for record in page]
+            assignments = assign_points(location_index, points, executor, workers)
+            for mutation in build_location_updates(table_config, assignments, batch_size):
+                result = run_query(mutation)
+                stats["requests"] += 1
+                if result is None or "errors" in result:
+                    stats["failed"] += 1
+                    print("[Error] Could not update the locations: %s" % result)
+
+            stats["read"] += len(page)
+            stats["assigned"] += len(assignments)
+            after = page[-1][table_config["id_column"]]
+            print("%s records read, %s assigned, %s update requests" % (
+                stats["read"], stats["assigned"], stats["requests"]))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return stats
+
+
+
+#
+# Resumable location sweep: every location is looked up with its find_*_collisions_for_location
+# function, and its unassigned records are updated with one `_in` mutation. The locations are
+# split in chunks processed by worker processes, and the finished locations are saved in a
+# SQLite file, so an interrupted sweep resumes where it stopped.
+#
+
+all_locations_query = """
+    query getLocations {
+      atd_txdot_locations(order_by: {location_id: asc}) {
+        location_id
+      }
+    }
+"""
+
+location_collisions_query = """
+    query collisionsByLocation {
+      %(find_function)s(args: {id: %(location_id)s}%(filter)s) {
+        %(id_column)s
+      }
+    }
+"""
+
+
+class SweepProgress:
+    """
+    The progress of the location sweep of a table, saved in a SQLite file.
+    Only the parent process writes to it.
+    """
+    def __init__(self, path, table_name):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.table_name = table_name
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS sweep_locations (
+                table_name TEXT NOT NULL,
+                location_id TEXT NOT NULL,
+                assigned INTEGER NOT NULL,
+                finished_at INTEGER NOT NULL,
+                PRIMARY KEY (table_name, location_id)
+            )
+        """)
+        self.connection.commit()
+
+    def get_done(self):
+        """
+        Returns the set of locations already swept
+        :return: set
+        """
+        return set(row[0] for row in self.connection.execute(
+            "SELECT location_id FROM sweep_locations WHERE table_name = ?", (self.table_name,)))
+
+    def save(self, results):
+        """
+        Saves the locations of a finished chunk
+        :param results: list - List of (location_id, assigned) tuples
+        """
+        now = int(time.time())
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO sweep_locations VALUES (?, ?, ?, ?)",
+            [(self.table_name, location_id, assigned, now) for location_id, assigned in results])
+        self.connection.commit()
+
+    def reset(self):
+        """
+        Forgets the progress, so the next sweep starts from the first location
+        """
+        self.connection.execute("DELETE FROM sweep_locations WHERE table_name = ?", (self.table_name,))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def sweep_location(table_name, location_id, only_unassigned):
+    """
+    Assigns a location to its collisions
+    :param table_name: string - cr3 or noncr3
+    :param location_id: string - The location id
+    :param only_unassigned: bool - Skip the records that already have a location
+    :return: int - The number of records assigned
+    """
+    table_config = LOCATION_TABLES[table_name]
+    query = location_collisions_query % dict(
+        table_config,
+        location_id=json.dumps(location_id),
+        filter=', where: {_or: [{location_id: {_is_null: true}}, {location_id: {_eq: "None"}}]}'
+        if only_unassigned else "",
+    )
+    response = run_query(query)
+    if response is None or "errors" in response:
+        raise Exception("Could not find the collisions of location %s: %s" % (location_id, response))
+
+    assignments = {record[table_config["id_column"]]: location_id
+                   for record in response["data"][table_config["find_function"]]}
+    for mutation in build_location_updates(table_config, assignments, len(assignments) or 1):
+        result = run_query(mutation)
+        if result is None or "errors" in result:
+            raise Exception("Could not update the collisions of location %s: %s" % (location_id, result))
+    return len(assignments)
+
+
+def sweep_location_chunk(table_name, location_ids, only_unassigned):
+    """
+    Sweeps a chunk of locations, in a worker process
+    :return: list - List of (location_id, assigned) tuples of the finished locations
+    """
+    return [(location_id, sweep_location(table_name, location_id, only_unassigned))
+            for location_id in location_ids]
+
+
+def sweep_locations(table_name, progress_path, workers, chunk_size, only_unassigned=True, restart=False):
+    """
+    Sweeps all the locations of a table, resuming the previous sweep if it did not finish
+    :param table_name: string - cr3 or noncr3
+    :param progress_path: string - The SQLite file of the sweep progress
+    :param workers: int - The number of worker processes
+    :param chunk_size: int - The number of locations per task
+    :param only_unassigned: bool - Skip the records that already have a location
+    :param restart: bool - Discard the progress of the previous sweep
+    :return: dict - Statistics of the run
+    """
+    progress = SweepProgress(progress_path, table_name)
+    if restart:
+        progress.reset()
+
+    response = run_query(all_locations_query)
+    if response is None or "errors" in response:
+        raise Exception("Could not read the locations: %s" % response)
+    location_ids = [location["location_id"] for location in response["data"]["atd_txdot_locations"]]
+
+    done = progress.get_done()
+    remaining = [location_id for location_id in location_ids if location_id not in done]
+    print("Location sweep (%s): %s locations, %s already swept, %s remaining, %s workers" % (
+        table_name, len(location_ids), len(location_ids) - len(remaining), len(remaining), workers))
+
+    stats = {"locations": 0, "assigned": 0, "failed_chunks": 0}
+    chunks = [remaining[i:i + chunk_size] for i in range(0, len(remaining), chunk_size)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(sweep_location_chunk, table_name, chunk, only_unassigned) for chunk in chunks]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                # The chunk is not saved, the next run picks it up again
+                stats["failed_chunks"] += 1
+                print("[Error] %s" % str(e))
+                continue
+            progress.save(results)
+            stats["locations"] += len(results)
+            stats["assigned"] += sum(assigned for _, assigned in results)
+            print("%s of %s locations swept, %s records assigned" % (
+                stats["locations"], len(remaining), stats["assigned"]))
+
+    # A complete sweep starts over next time
+    if stats["failed_chunks"] == 0:
+        progress.reset()
+    progress.close()
+    return stats
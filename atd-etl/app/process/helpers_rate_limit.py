@@ -0,0 +1,175 @@
+"""
+Rate Limit Helper
+Author: Austin Transportation Department, Data and Technology Services
+
+Description: Process-wide token-bucket rate limiters for outbound calls to
+external APIs (ie. HERE geocoding, CRIS CR3 downloads). All threads calling
+the same provider share one bucket, so the process runs at the maximum
+allowed rate regardless of the number of threads. When a provider throttles
+us (HTTP 429 or 503), the Retry-After header is honored by pausing the
+whole bucket, and the request is retried instead of being dropped.
+
+The rate (requests per second) and burst size of every provider are set in
+the configuration, ie. ATD_HERE_RATE_LIMIT and ATD_HERE_RATE_BURST.
+
+The application requires the requests library:
+    https://pypi.org/project/requests/
+"""
+
+import time
+import threading
+import requests
+from email.utils import parsedate_to_datetime
+
+from .config import ATD_ETL_CONFIG
+
+# Configuration keys of the rate and burst of each provider
+RATE_LIMIT_CONFIG = {
+    "here": ("ATD_HERE_RATE_LIMIT", "ATD_HERE_RATE_BURST"),
+    "cris": ("ATD_CRIS_RATE_LIMIT", "ATD_CRIS_RATE_BURST"),
+}
+
+# Status codes that signal we are being throttled
+THROTTLE_STATUS_CODES = [429, 503]
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket. Tokens are refilled at `rate` per second up
+    to `burst`; every request takes one token, waiting if none is left.
+    """
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "waits": 0, "wait_seconds": 0.0, "throttled": 0, "retries": 0}
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.rate > 0:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.rate <= 0 or self.tokens >= 1:
+                    self.tokens -= 1
+                    self.stats["requests"] += 1
+                    if waited > 0:
+                        self.stats["waits"] += 1
+                        self.stats["wait_seconds"] += waited
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def throttle(self, retry_after, retry):
+        """
+        Pauses the bucket for every thread after being throttled
+        :param retry_after: float - Seconds to wait before the next request
+        :param retry: bool - True if the request is retried after the pause
+        """
+        with self.lock:
+            self.stats["throttled"] += 1
+            if retry:
+                self.stats["retries"] += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            self.tokens = 0
+
+    def report(self):
+        return "Rate limiter '%s' (%s/s, burst %s): %s requests, %s waits (%.1fs), %s throttled, %s retries" % (
+            self.name, self.rate, int(self.burst), self.stats["requests"], self.stats["waits"],
+            self.stats["wait_seconds"], self.stats["throttled"], self.stats["retries"])
+
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider):
+    """
+    Returns the process-wide rate limiter of a provider
+    :param provider: string - The provider name (ie. here, cris)
+    :return: RateLimiter
+    """
+    with rate_limiters_lock:
+        if provider not in rate_limiters:
+            rate_key, burst_key = RATE_LIMIT_CONFIG[provider]
+            rate_limiters[provider] = RateLimiter(provider, ATD_ETL_CONFIG[rate_key], ATD_ETL_CONFIG[burst_key])
+        return rate_limiters[provider]
+
+
+def parse_retry_after(value, default):
+    """
+    Parses a Retry-After header, either in seconds or as an HTTP date
+    :param value: string - The header value
+    :param default: float - The value to use if the header is missing or invalid
+    :return: float - Seconds to wait
+    """
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+def request_with_rate_limit(provider, method, url, **kwargs):
+    """
+    Makes an HTTP request through the rate limiter of a provider. Throttled
+    requests are retried after the Retry-After delay (or an exponential
+    backoff when the header is missing), up to ATD_RATE_LIMIT_MAX_RETRIES times.
+    :param provider: string - The provider name (ie. here, cris)
+    :param method: string - The HTTP method
+    :param url: string - The URL
+    :param kwargs: dict - Additional arguments for requests.request
+    :return: requests.Response - The last response
+    """
+    rate_limiter = get_rate_limiter(provider)
+    max_retries = ATD_ETL_CONFIG["ATD_RATE_LIMIT_MAX_RETRIES"]
+    retry_wait_time = ATD_ETL_CONFIG["RETRY_WAIT_TIME"]
+
+    for current_attempt in range(max_retries + 1):
+        rate_limiter.acquire()
+        response = requests.request(method, url, **kwargs)
+        if response.status_code not in THROTTLE_STATUS_CODES:
+            return response
+
+        retry_after = parse_retry_after(response.headers.get("Retry-After"),
+                                        retry_wait_time * (2 ** current_attempt))
+        retry = current_attempt < max_retries
+        # The other threads wait too, even when this request is not retried
+        rate_limiter.throttle(retry_after, retry)
+        if not retry:
+            return response
+
+        print("Throttled by '%s' (HTTP %s), retrying in %.1f seconds" % (
+            provider, response.status_code, retry_after))
+        # Releases the connection of a streamed response
+        response.close()
+
+    return response
+
+
+def report_rate_limiters():
+    """
+    Prints the metrics of every rate limiter used in this process
+    """
+    with rate_limiters_lock:
+        for rate_limiter in rate_limiters.values():
+            print(rate_limiter.report())
@@ -12,8 +12,13 @@ The application requires the requests and sodapy libraries:
 
 import requests
 import json
+import time
+import concurrent.futures
+from collections import OrderedDict
 from copy import deepcopy
+from sodapy import Socrata
 from process.config import ATD_ETL_CONFIG
+from process.socrata_queries import *
 
 # Dict to translate canonical modes to broader categories for VZV
 mode_categories = {
@@ -24,6 +29,9 @@ mode_categories = {
     "other": [6, 8, 9]
 }
 
+# LRU cache of crash data shared by the people of a crash, keyed by crash_id
+crash_metadata_cache = OrderedDict()
+
 
 def replace_chars(target_str, char_list, replacement_str):
     """
@@ -58,6 +66,109 @@ def run_hasura_query(query):
         return None
 
 
+def get_socrata_client():
+    """
+    Returns a Socrata client for the configured domain. The domain may carry
+    an explicit http:// scheme, which allows pointing the exporter at a local
+    SODA stub server for testing.
+    :return: Socrata - The Socrata client
+    """
+    domain = ATD_ETL_CONFIG["SOCRATA_DOMAIN"]
+    uri_prefix = "https://"
+    for scheme in ["http://", "https://"]:
+        if domain.startswith(scheme):
+            uri_prefix = scheme
+            domain = domain[len(scheme):]
+
+    client = Socrata(domain, ATD_ETL_CONFIG["SOCRATA_APP_TOKEN"],
+                     username=ATD_ETL_CONFIG["SOCRATA_KEY_ID"],
+                     password=ATD_ETL_CONFIG["SOCRATA_KEY_SECRET"],
+                     timeout=ATD_ETL_CONFIG["SOCRATA_TIMEOUT"])
+    client.uri_prefix = uri_prefix
+    return client
+
+
+def chunk_records(records, chunk_size):
+    """
+    Splits a list of records into chunks of at most chunk_size records
+    :param records: list - List of record dicts
+    :param chunk_size: int - The maximum number of records per chunk
+    :return: list - List of lists of record dicts
+    """
+    chunk_size = max(1, int(chunk_size))
+    return [records[i:i + chunk_size] for i in range(0, len(records), chunk_size)]
+
+
+def upsert_chunk(client, dataset_uid, chunk, chunk_number):
+    """
+    Upserts a single chunk of records to Socrata, retrying with exponential
+    backoff up to SOCRATA_UPSERT_MAX_ATTEMPTS times.
+    :param client: Socrata - The Socrata client
+    :param dataset_uid: string - The Socrata dataset id
+    :param chunk: list - List of record dicts
+    :param chunk_number: int - The position of the chunk within the page
+    :return: dict - Timing and outcome of the chunk upsert
+    """
+    max_attempts = ATD_ETL_CONFIG["SOCRATA_UPSERT_MAX_ATTEMPTS"]
+    retry_wait_time = ATD_ETL_CONFIG["SOCRATA_UPSERT_RETRY_WAIT_TIME"]
+    start = time.time()
+    error = None
+
+    for current_attempt in range(1, max_attempts + 1):
+        try:
+            client.upsert(dataset_uid, chunk)
+            return {
+                "chunk": chunk_number,
+                "records": len(chunk),
+                "attempts": current_attempt,
+                "seconds": time.time() - start,
+                "error": None
+            }
+        except Exception as e:
+            error = str(e)
+            print("Chunk %s: attempt (%s out of %s) failed: %s" %
+                  (chunk_number, current_attempt, max_attempts, error))
+            if current_attempt < max_attempts:
+                time.sleep(retry_wait_time * (2 ** (current_attempt - 1)))
+
+    return {
+        "chunk": chunk_number,
+        "records": len(chunk),
+        "attempts": max_attempts,
+        "seconds": time.time() - start,
+        "error": error
+    }
+
+
+def upsert_records(client, dataset_uid, records, chunk_size=None, max_threads=None):
+    """
+    Splits records into chunks and upserts them to Socrata concurrently
+    using a bounded thread pool. Each chunk is retried independently.
+    :param client: Socrata - The Socrata client
+    :param dataset_uid: string - The Socrata dataset id
+    :param records: list - List of record dicts
+    :param chunk_size: int - Records per chunk (defaults to SOCRATA_UPSERT_CHUNK_SIZE)
+    :param max_threads: int - Concurrent chunk upserts (defaults to SOCRATA_UPSERT_MAX_THREADS)
+    :return: list - List of dicts with per-chunk timing, sorted by chunk number
+    """
+    chunk_size = chunk_size or ATD_ETL_CONFIG["SOCRATA_UPSERT_CHUNK_SIZE"]
+    max_threads = max_threads or ATD_ETL_CONFIG["SOCRATA_UPSERT_MAX_THREADS"]
+    chunks = chunk_records(records, chunk_size)
+    results = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
+        futures = [executor.submit(upsert_chunk, client, dataset_uid, chunk, chunk_number)
+                   for chunk_number, chunk in enumerate(chunks, start=1)]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            print("Chunk %s: %s records in %.2fs (%s attempts)%s" % (
+                result["chunk"], result["records"], result["seconds"], result["attempts"],
+                "" if result["error"] is None else ", FAILED: %s" % result["error"]))
+            results.append(result)
+
+    return sorted(results, key=lambda result: result["chunk"])
+
+
 def flatten_hasura_response(records):
     """
     Flattens data response from Hasura
@@ -226,36 +337,82 @@ def add_value_prefix(records, prefix_dict):
     return records
 
 
+def index_crash_metadata(crash):
+    """
+    Builds the cache entry for a crash: its date and a lookup of
+    the mode of each unit number.
+    Units (unit_nbr & unit_id) => Crash metadata (unit_id)
+    :param crash: dict - Crash record with atd_mode_category_metadata and units
+    :return: dict - The crash date and a dict of unit_nbr and mode
+    """
+    modes_by_unit_id = {}
+    for unit in crash.get("atd_mode_category_metadata") or []:
+        modes_by_unit_id[unit.get("unit_id")] = {
+            "mode_desc": unit.get("mode_desc"),
+            "mode_id": unit.get("mode_id")
+        }
+
+    modes_by_unit_nbr = {}
+    for unit in crash.get("units") or []:
+        mode = modes_by_unit_id.get(unit.get("unit_id"))
+        if mode is not None:
+            modes_by_unit_nbr[unit.get("unit_nbr")] = mode
+        else:
+            modes_by_unit_nbr.pop(unit.get("unit_nbr"), None)
+
+    return {
+        "crash_date": crash.get("crash_date"),
+        "modes_by_unit_nbr": modes_by_unit_nbr
+    }
+
+
+def load_crash_metadata(crash_ids):
+    """
+    Makes sure the crash data for a list of crash ids is in the cache,
+    fetching the missing crashes from Hasura in a single query.
+    :param crash_ids: list - List of crash ids
+    """
+    cache_size = ATD_ETL_CONFIG["SOCRATA_CRASH_CACHE_SIZE"]
+    missing_crash_ids = set()
+    for crash_id in crash_ids:
+        if crash_id in crash_metadata_cache:
+            crash_metadata_cache.move_to_end(crash_id)
+        elif crash_id is not None:
+            missing_crash_ids.add(crash_id)
+
+    if len(missing_crash_ids) == 0:
+        return
+
+    query = crash_metadata_query_template.substitute(
+        crash_ids=", ".join(str(crash_id) for crash_id in sorted(missing_crash_ids)))
+    data = run_hasura_query(query)
+    for crash in data["data"]["atd_txdot_crashes"]:
+        crash_metadata_cache[crash["crash_id"]] = index_crash_metadata(crash)
+
+    while len(crash_metadata_cache) > max(cache_size, len(crash_ids)):
+        crash_metadata_cache.popitem(last=False)
+
+
 def set_person_mode(records):
     """
     Sets mode of person from crash record metadata and person mode flag
-    Person (unit_nbr) => Units (unit_nbr & unit_id) => Crash metadata (unit_id)
+    Person (unit_nbr) => Crash cache (unit_nbr) => mode
     :param records: list - List of record dicts
     """
-    for record in records:
-        # Gather person, unit, and crash data
-        person_unit_number = record.get("unit_nbr")
-        crash = record.get("crash")
-        units = crash.get("units", [])
+    load_crash_metadata([record.get("crash_id") for record in records])
 
-        # Find unit_id
-        unit_id = ""
-        for unit in units:
-            if unit.get("unit_nbr") == person_unit_number:
-                unit_id = unit.get("unit_id")
+    for record in records:
+        crash = crash_metadata_cache.get(record.pop("crash_id", None))
+        person_unit_number = record.pop("unit_nbr", None)
+        if crash is None:
+            continue
 
         # Find unit in metadata and set mode_desc column and set mode id
-        mode_id = ""
-        crash_metadata = crash.get("atd_mode_category_metadata", [])
-        if crash_metadata != None:
-            for unit in crash_metadata:
-                if unit.get("unit_id") == unit_id:
-                    record["mode_desc"] = unit.get("mode_desc")
-                    mode_id = unit.get("mode_id")
-                    record["mode_id"] = mode_id
-        del record["crash"]["units"]
-        del record["crash"]["atd_mode_category_metadata"]
-        del record["unit_nbr"]
+        mode = crash["modes_by_unit_nbr"].get(person_unit_number)
+        if mode is not None:
+            record["mode_desc"] = mode["mode_desc"]
+            record["mode_id"] = mode["mode_id"]
+        record["crash_date"] = crash["crash_date"]
 
     return records
 
@@ -284,28 +441,68 @@ def format_crash_data(data, formatter_config):
 
 def format_person_data(data, formatter_config):
     """
-    Prepares person data for Socrata upsertion
+    Prepares person data for Socrata upsertion. The data may contain
+    any of the person tables listed in the formatter config.
     :param data: dict - Dict containing list of Hasura records
     :param formatter_config: dict - Dict containing config for data formatting
     """
-    person_records = data['data'][formatter_config["tables"][0]]
-    primary_person_records = data['data'][formatter_config["tables"][1]]
-
-    # Make record IDs unique by adding prefixes and set mode of person
-    person_records = add_value_prefix(
-        person_records, formatter_config["prefixes"])
-    person_records = set_person_mode(
-        person_records)
-    primary_person_records = add_value_prefix(
-        primary_person_records, formatter_config["prefixes"])
-    primary_person_records = set_person_mode(
-        primary_person_records)
+    people_records = []
+    for table in formatter_config["tables"]:
+        table_records = data['data'].get(table)
+        if table_records is None:
+            continue
+
+        # Make record IDs unique by adding prefixes and set mode of person
+        table_records = add_value_prefix(
+            table_records, formatter_config["prefixes"])
+        table_records = set_person_mode(table_records)
+        people_records += table_records
 
     # Join records and format
-    people_records = person_records + primary_person_records
     formatted_records = rename_record_columns(
         people_records, formatter_config["columns_to_rename"])
     formatted_records = flatten_hasura_response(
         formatted_records)
 
     return formatted_records
+
+
+# Define tables to query from Hasura and publish to Socrata
+query_configs = [
+    {
+        "table": "crash",
+        "templates": [crashes_query_template],
+        "formatter": format_crash_data,
+        "formatter_config": {
+            "tables": ["atd_txdot_crashes"],
+            "columns_to_rename": {
+                "veh_body_styl_desc": "unit_desc",
+                "veh_unit_desc_desc": "unit_mode",
+                "latitude_primary": "latitude",
+                "longitude_primary": "longitude"
+            }
+        },
+        "id_column": "crash_id",
+        # "dataset_uid": "3aut-fhzp"  # TEST
+        "dataset_uid": "y2wy-tgr5"  # PROD
+    },
+    {
+        "table": "person",
+        # Each person table is paged on its own, they differ in size
+        "templates": [person_query_template, primaryperson_query_template],
+        "formatter": format_person_data,
+        "formatter_config": {
+            "tables": ["atd_txdot_person", "atd_txdot_primaryperson"],
+            "columns_to_rename": {
+                "primaryperson_id": "person_id"
+            },
+            "prefixes": {
+                "person_id": "P",
+                "primaryperson_id": "PP",
+            }
+        },
+        "id_column": "person_id",
+        # "dataset_uid": "v3x4-fjgm"  # TEST
+        "dataset_uid": "xecs-rpy9"  # PROD
+    }
+]
@@ -0,0 +1,150 @@
+"""
+Helpers for the Socrata Export Manifest
+Author: Austin Transportation Department, Data & Technology Services
+
+Description: This script contains methods that keep a local manifest for
+each Socrata dataset, mapping the row id of every exported record to a
+fingerprint (hash) of the formatted record. The exporter uses it to upsert
+only those rows that changed since the last run, and to list the rows that
+no longer come out of Hasura so they can be deleted from Socrata.
+
+The manifest is a SQLite file per dataset uid, stored in the folder
+defined by SOCRATA_MANIFEST_PATH.
+"""
+
+import os
+import json
+import sqlite3
+import hashlib
+from process.config import ATD_ETL_CONFIG
+
+# SQLite limits the number of host parameters per statement
+SQLITE_MAX_VARIABLES = 900
+
+
+def manifest_enabled():
+    """
+    Returns True if the export manifest is enabled in the configuration
+    :return: bool
+    """
+    return ATD_ETL_CONFIG["SOCRATA_MANIFEST"] == "ENABLED"
+
+
+def open_manifest(dataset_uid):
+    """
+    Opens (or creates) the manifest database for a dataset and resets the
+    list of rows seen during this run.
+    :param dataset_uid: string - The Socrata dataset id
+    :return: sqlite3.Connection - The manifest connection
+    """
+    manifest_path = ATD_ETL_CONFIG["SOCRATA_MANIFEST_PATH"]
+    os.makedirs(manifest_path, exist_ok=True)
+
+    connection = sqlite3.connect(os.path.join(manifest_path, "%s.sqlite" % dataset_uid))
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            row_id TEXT PRIMARY KEY,
+            fingerprint BLOB NOT NULL
+        ) WITHOUT ROWID
+    """)
+    connection.execute("CREATE TEMP TABLE seen (row_id TEXT PRIMARY KEY) WITHOUT ROWID")
+    return connection
+
+
+def fingerprint_record(record):
+    """
+    Returns a compact hash of a formatted record. Keys are sorted so the
+    fingerprint does not depend on the column order.
+    :param record: dict - The formatted record
+    :return: bytes - A 16-byte digest
+    """
+    serialized = json.dumps(record, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(serialized.encode("utf-8"), digest_size=16).digest()
+
+
+def get_fingerprints(connection, row_ids):
+    """
+    Returns the stored fingerprints for a list of row ids
+    :param connection: sqlite3.Connection - The manifest connection
+    :param row_ids: list - List of row ids
+    :return: dict - Dict of row id and fingerprint
+    """
+    fingerprints = {}
+    for i in range(0, len(row_ids), SQLITE_MAX_VARIABLES):
+        batch = row_ids[i:i + SQLITE_MAX_VARIABLES]
+        cursor = connection.execute(
+            "SELECT row_id, fingerprint FROM fingerprints WHERE row_id IN (%s)"
+            % ",".join("?" * len(batch)), batch)
+        fingerprints.update(cursor.fetchall())
+    return fingerprints
+
+
+def filter_changed_records(connection, records, id_column):
+    """
+    Marks every record as seen and returns only those whose fingerprint
+    differs from the one stored in the manifest.
+    :param connection: sqlite3.Connection - The manifest connection
+    :param records: list - List of formatted record dicts
+    :param id_column: string - The column holding the Socrata row id
+    :return: tuple - List of changed records, and dict of row id and new fingerprint
+    """
+    row_ids = [str(record[id_column]) for record in records]
+    connection.executemany("INSERT OR IGNORE INTO seen (row_id) VALUES (?)",
+                           [(row_id,) for row_id in row_ids])
+    stored_fingerprints = get_fingerprints(connection, row_ids)
+
+    changed_records = []
+    new_fingerprints = {}
+    for row_id, record in zip(row_ids, records):
+        fingerprint = fingerprint_record(record)
+        if stored_fingerprints.get(row_id) != fingerprint:
+            changed_records.append(record)
+            new_fingerprints[row_id] = fingerprint
+
+    return changed_records, new_fingerprints
+
+
+def save_fingerprints(connection, fingerprints):
+    """
+    Stores the fingerprints of records that were upserted successfully
+    :param connection: sqlite3.Connection - The manifest connection
+    :param fingerprints: dict - Dict of row id and fingerprint
+    """
+    connection.executemany(
+        "INSERT OR REPLACE INTO fingerprints (row_id, fingerprint) VALUES (?, ?)",
+        fingerprints.items())
+    connection.commit()
+
+
+def get_deleted_row_ids(connection):
+    """
+    Returns the row ids in the manifest that were not seen during this run
+    :param connection: sqlite3.Connection - The manifest connection
+    :return: list - List of row ids
+    """
+    cursor = connection.execute(
+        "SELECT row_id FROM fingerprints WHERE row_id NOT IN (SELECT row_id FROM seen)")
+    return [row[0] for row in cursor.fetchall()]
+
+
+def remove_fingerprints(connection, row_ids):
+    """
+    Removes row ids from the manifest, once they are deleted from Socrata
+    :param connection: sqlite3.Connection - The manifest connection
+    :param row_ids: list - List of row ids
+    """
+    connection.executemany("DELETE FROM fingerprints WHERE row_id = ?",
+                           [(row_id,) for row_id in row_ids])
+    connection.commit()
+
+
+def build_delete_records(row_ids, id_column):
+    """
+    Builds the SODA delete payload for a list of row ids
+    :param row_ids: list - List of row ids
+    :param id_column: string - The column holding the Socrata row id
+    :return: list - List of record dicts flagged as deleted
+    """
+    return [{id_column: row_id, ":deleted": True} for row_id in row_ids]
@@ -9,10 +9,11 @@ MAX_ATTEMPTS = ATD_ETL_CONFIG["MAX_ATTEMPTS"]
 RETRY_WAIT_TIME = ATD_ETL_CONFIG["RETRY_WAIT_TIME"]
 
 
-def run_query(query):
+def run_query(query, variables=None):
     """
     Runs a GraphQL query against Hasura via an HTTP POST request.
     :param query: string - The GraphQL query to execute (query, mutation, etc.)
+    :param variables: dict - The GraphQL variables of the query, if any
     :return: object - A Json dictionary directly from Hasura
     """
     # Build Header with Admin Secret
@@ -24,8 +25,11 @@ def run_query(query):
     for current_attempt in range(MAX_ATTEMPTS):
         # Try making the request via POST
         try:
+            payload = {'query': query}
+            if variables is not None:
+                payload['variables'] = variables
             return requests.post(ATD_ETL_CONFIG["HASURA_ENDPOINT"],
-                                 json={'query': query},
+                                 json=payload,
                                  headers=headers).json()
         except Exception as e:
             print("Exception, could not insert: " + str(e))
@@ -44,3 +48,31 @@ def run_query(query):
                 print("Attempt (%s out of %s)" % (current_attempt+1, MAX_ATTEMPTS))
                 print("Trying again in %s seconds..." % RETRY_WAIT_TIME)
                 time.sleep(RETRY_WAIT_TIME)
+
+
+def run_sql(sql):
+    """
+    Runs a SQL statement through the Hasura schema API (run_sql), for the
+    set-based operations that cannot be expressed as a GraphQL mutation.
+    It requires the admin secret.
+    :param sql: string - The SQL statement
+    :return: object - A Json dictionary directly from Hasura, ie. {"result_type": "TuplesOk", "result": [...]}
+    """
+    headers = {
+        "x-hasura-admin-secret": ATD_ETL_CONFIG["HASURA_ADMIN_KEY"]
+    }
+    payload = {"type": "run_sql", "args": {"sql": sql}}
+
+    for current_attempt in range(MAX_ATTEMPTS):
+        try:
+            return requests.post(ATD_ETL_CONFIG["HASURA_QUERY_ENDPOINT"],
+                                 json=payload,
+                                 headers=headers).json()
+        except Exception as e:
+            print("Exception, could not run sql: " + str(e))
+            response = {"error": "Exception, could not run sql: " + str(e), "sql": sql}
+            if current_attempt + 1 == MAX_ATTEMPTS:
+                return response
+            print("Attempt (%s out of %s)" % (current_attempt+1, MAX_ATTEMPTS))
+            print("Trying again in %s seconds..." % RETRY_WAIT_TIME)
+            time.sleep(RETRY_WAIT_TIME)
@@ -56,11 +56,12 @@ crashes_query_template = Template(
 """
 )
 
-# Queries Hasura to retrieve records for
+# Queries Hasura to retrieve person records for
 # https://data.austintexas.gov/d/xecs-rpy9
-people_query_template = Template(
+# Crash data is fetched separately, once per crash (see crash_metadata_query_template)
+person_query_template = Template(
     """
-    query getPeopleSocrata {
+    query getPersonSocrata {
         atd_txdot_person(limit: $limit, offset: $offset, order_by: {person_id: asc}, where: {_or: [{prsn_injry_sev_id: {_eq: 1}}, {prsn_injry_sev_id: {_eq: 4}}], _and: {crash: {city_id: {_eq: 22}}}}) {
             person_id
             prsn_injry_sev_id
@@ -68,15 +69,17 @@ people_query_template = Template(
             prsn_gndr_id
             prsn_ethnicity_id
             unit_nbr
-            crash {
-                crash_date
-                atd_mode_category_metadata
-                units {
-                    unit_nbr
-                    unit_id
-                }
-            }
+            crash_id
         }
+    }
+"""
+)
+
+# Queries Hasura to retrieve primary person records for
+# https://data.austintexas.gov/d/xecs-rpy9
+primaryperson_query_template = Template(
+    """
+    query getPrimaryPersonSocrata {
         atd_txdot_primaryperson(limit: $limit, offset: $offset, order_by: {primaryperson_id: asc}, where: {_or: [{prsn_injry_sev_id: {_eq: 1}}, {prsn_injry_sev_id: {_eq: 4}}], _and: {crash: {city_id: {_eq: 22}}}}) {
             primaryperson_id
             prsn_injry_sev_id
@@ -84,13 +87,23 @@ people_query_template = Template(
             prsn_gndr_id
             prsn_ethnicity_id
             unit_nbr
-            crash {
-                crash_date
-                atd_mode_category_metadata
-                units {
-                    unit_nbr
-                    unit_id
-                }
+            crash_id
+        }
+    }
+"""
+)
+
+# Queries Hasura to retrieve the crash data shared by the people in a crash
+crash_metadata_query_template = Template(
+    """
+    query getCrashMetadataSocrata {
+        atd_txdot_crashes(where: {crash_id: {_in: [$crash_ids]}}) {
+            crash_id
+            crash_date
+            atd_mode_category_metadata
+            units {
+                unit_nbr
+                unit_id
             }
         }
     }
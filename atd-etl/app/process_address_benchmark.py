@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Geocoder - Address Normalizer Benchmark
+Author: Austin Transportation Department, Data & Technology Services
+
+Description: This script measures how many addresses per second the
+address normalizer renders. It generates synthetic crash records with the
+spelling variants found in the CRIS extracts (full and abbreviated suffixes
+and directions, repeated tokens, empty fields), renders their geocode
+addresses twice, once with empty caches (cold) and once with warm caches,
+and reports the throughput and how many unique cache keys remain after
+normalization compared to the raw addresses.
+
+Examples:
+    process_address_benchmark.py --records 100000
+    process_address_benchmark.py --records 100000 --vocabulary HASURA
+"""
+import io
+import time
+import random
+import argparse
+import contextlib
+
+from process.config import ATD_ETL_CONFIG
+
+parser = argparse.ArgumentParser(description="Benchmarks the address normalizer")
+parser.add_argument("--records", type=int, default=100000, help="Number of synthetic records")
+parser.add_argument("--locations", type=int, default=5000, help="Number of distinct addresses")
+parser.add_argument("--seed", type=int, default=1, help="Random seed")
+parser.add_argument("--vocabulary", choices=["HASURA", "BUILTIN"], default="BUILTIN",
+                    help="Where the suffix and direction vocabularies come from")
+args = parser.parse_args()
+
+ATD_ETL_CONFIG["ATD_ADDRESS_VOCABULARY"] = args.vocabulary
+
+from process.helpers_address import normalize_street, normalize_address, normalizer_cache_info
+from process.helpers_hasura_geocode import render_geocode_address
+
+# Spelling variants of the same direction or suffix
+PREFIXES = [[None], ["N", "NORTH", "N N"], ["S", "SOUTH"], ["E", "EAST"], ["W", "WEST", "W."]]
+SUFFIXES = [[None], ["ST", "STREET", "ST ST"], ["AVE", "AVENUE", "AV"], ["BLVD", "BOULEVARD"],
+            ["DR", "DRIVE"], ["LN", "LANE"], ["RD", "ROAD"]]
+
+
+def generate_records(count, location_count, seed):
+    """
+    Generates synthetic crash records with the address fields of get_geocode_list,
+    every record is one of location_count addresses with random spellings
+    :param count: int - The number of records
+    :param location_count: int - The number of distinct addresses
+    :param seed: int - The random seed
+    :return: list
+    """
+    rng = random.Random(seed)
+
+    def location_street():
+        return rng.choice(PREFIXES), "STREET%s" % rng.randrange(location_count), rng.choice(SUFFIXES)
+
+    def spell(prefix_name, street):
+        prefixes, name, suffixes = street
+        prefix, suffix = rng.choice(prefixes), rng.choice(suffixes)
+        # Some reports repeat the prefix or the suffix in the street name
+        if prefix and rng.random() < 0.1:
+            name = "%s %s" % (prefix, name)
+        if suffix and rng.random() < 0.1:
+            name = "%s %s" % (name, suffix)
+        if rng.random() < 0.05:
+            name = name.lower()
+        return {prefix_name + "street_pfx": prefix, prefix_name + "street_name": name,
+                prefix_name + "street_sfx": suffix}
+
+    locations = []
+    for _ in range(location_count):
+        is_intersection = rng.random() < 0.6
+        block_num = None if is_intersection else str(rng.randrange(1, 200) * 100)
+        locations.append((block_num, location_street(), location_street()))
+
+    records = []
+    for crash_id in range(count):
+        block_num, primary, secondary = rng.choice(locations)
+        record = {"crash_id": crash_id, "rpt_block_num": block_num, "rpt_sec_block_num": None}
+        record.update(spell("rpt_", primary))
+        record.update(spell("rpt_sec_", secondary))
+        records.append(record)
+    return records
+
+
+def render_all(records):
+    """
+    Renders the geocode address of every record, silencing the per-record output
+    :param records: list - The records
+    :return: tuple - (addresses, seconds)
+    """
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        addresses = [render_geocode_address(record) for record in records]
+    return addresses, time.perf_counter() - start
+
+
+def raw_address(record):
+    """
+    Returns the address of a record as the raw fields are written, for
+    comparing the number of unique keys before and after normalization
+    """
+    return " & ".join("%s %s %s %s" % (record[prefix + "block_num"], record[prefix + "street_pfx"],
+                                         record[prefix + "street_name"], record[prefix + "street_sfx"])
+                      for prefix in ["rpt_", "rpt_sec_"])
+
+
+records = generate_records(args.records, args.locations, args.seed)
+print("Records: %s, locations: %s, vocabulary: %s" % (len(records), args.locations, args.vocabulary))
+
+normalize_street.cache_clear()
+normalize_address.cache_clear()
+addresses, cold_seconds = render_all(records)
+print("Cold caches: %.0f addresses/s (%.2fs)" % (len(records) / cold_seconds, cold_seconds))
+
+addresses, warm_seconds = render_all(records)
+print("Warm caches: %.0f addresses/s (%.2fs)" % (len(records) / warm_seconds, warm_seconds))
+
+for name, info in normalizer_cache_info().items():
+    print("Cache '%s': %s hits, %s misses, %s entries" % (name, info.hits, info.misses, info.currsize))
+
+geocodable = [address for address in addresses if address is not None]
+print("Geocodable addresses: %s, unique raw addresses: %s, unique canonical addresses: %s" % (
+    len(geocodable), len(set(raw_address(record) for record in records)), len(set(geocodable))))
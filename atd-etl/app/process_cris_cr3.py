@@ -8,16 +8,18 @@ and download CR3 pdf files as needed. The list of CR3 files to be downloaded
 is obtained from Hasura, and it is contingent to records that do not have
 any CR3 files associated.
 
-The application requires the splinter library, and the requests library:
+The application requires the splinter library, the requests library
+and the boto3 library:
     https://splinter.readthedocs.io/en/latest/
+    https://pypi.org/project/boto3/
 """
 
 import time
-import json
 import concurrent.futures
 
 from process.config import ATD_ETL_CONFIG
 from process.helpers_cr3 import *
+from process.helpers_rate_limit import report_rate_limiters
 
 #
 # Now we import Splinter-related libraries
@@ -40,57 +42,102 @@ chrome_options.add_argument("--window-size=1920,1080")  # CRIS will not render i
 print("Initializing Chrome headless browser.")
 browser = Browser('chrome', options=chrome_options)
 
-# Visit Chris
-print("Logging in to '%s'" % ATD_ETL_CONFIG["ATD_CRIS_WEBSITE"])
-browser.visit(ATD_ETL_CONFIG["ATD_CRIS_WEBSITE"])
 
-# Select the agency, then click Continue
-print("Filling out agency.")
-browser.find_by_id('idpSelectInput').fill('* Texas Department of Transportation')
-browser.find_by_id('idpSelectSelectButton').click()
+def cris_login():
+    """
+    Logs in to the CRIS website with the browser
+    :return: dict - The session cookies
+    """
+    # Visit Chris
+    print("Logging in to '%s'" % ATD_ETL_CONFIG["ATD_CRIS_WEBSITE"])
+    browser.visit(ATD_ETL_CONFIG["ATD_CRIS_WEBSITE"])
 
-# We log in
-print("Filling out credentials.")
-browser.find_by_id('username').fill(ATD_ETL_CONFIG["ATD_CRIS_USERNAME_CR3"])
-browser.find_by_id('password').fill(ATD_ETL_CONFIG["ATD_CRIS_PASSWORD_CR3"])
-browser.find_by_name('_eventId_proceed').click()
+    # Select the agency, then click Continue
+    print("Filling out agency.")
+    browser.find_by_id('idpSelectInput').fill('* Texas Department of Transportation')
+    browser.find_by_id('idpSelectSelectButton').click()
 
-# At this point, we have all we need from the browser, the cookies:
-print("Gathering cookies.")
-CRIS_BROWSER_COOKIES = browser.cookies.all()
+    # We log in
+    print("Filling out credentials.")
+    browser.find_by_id('username').fill(ATD_ETL_CONFIG["ATD_CRIS_USERNAME_CR3"])
+    browser.find_by_id('password').fill(ATD_ETL_CONFIG["ATD_CRIS_PASSWORD_CR3"])
+    browser.find_by_name('_eventId_proceed').click()
 
-#
-# We now need to request a list of N number of records
-# that do not have a CR3. For each record we must download
-# the CR3 pdf, upload to S3
-#
-print("Preparing download loop.")
-
-print("Gathering list of crashes.")
-crashes_list = []
-try:
-    print("Hasura endpoint: '%s' " % ATD_ETL_CONFIG["HASURA_ENDPOINT"])
-    downloads_per_run = ATD_ETL_CONFIG["ATD_CRIS_CR3_DOWNLOADS_PER_RUN"]
-    print("Downloads Per This Run: %s" % str(downloads_per_run))
-
-    response = get_crash_id_list(downloads_per_run=downloads_per_run)
-    print("\nResponse from Hasura: %s" % json.dumps(response))
+    # At this point, we have all we need from the browser, the cookies:
+    print("Gathering cookies.")
+    return browser.cookies.all()
 
-    crashes_list = response['data']['atd_txdot_crashes']
-    print("\nList of crashes: %s" % json.dumps(crashes_list))
 
-    print("\nInitializing Execution Thread Pool:")
-except Exception as e:
-    crashes_list = []
-    print("Error, could not run CR3 processing: " + str(e))
-
-with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-    for crash_record in crashes_list:
-        executor.submit(process_crash_cr3, crash_record, CRIS_BROWSER_COOKIES)
+CRIS_BROWSER_COOKIES = cris_login()
 
+#
+# We now page through every crash that does not have a CR3
+# (up to ATD_CRIS_CR3_DOWNLOADS_PER_RUN, 0 for all of them).
+# For each record we stream the CR3 pdf to S3, and the stored
+# crashes are flagged in batches.
+#
+print("Preparing download loop.")
+print("Hasura endpoint: '%s' " % ATD_ETL_CONFIG["HASURA_ENDPOINT"])
+downloads_per_run = ATD_ETL_CONFIG["ATD_CRIS_CR3_DOWNLOADS_PER_RUN"]
+page_size = ATD_ETL_CONFIG["ATD_CRIS_CR3_PAGE_SIZE"]
+print("Downloads Per This Run: %s" % (downloads_per_run or "all"))
+
+cursor = 0
+processed = 0
+stored = 0
+failed_pages = 0
+
+with concurrent.futures.ThreadPoolExecutor(max_workers=ATD_ETL_CONFIG["ATD_CRIS_CR3_DOWNLOAD_THREADS"]) as executor:
+    while downloads_per_run == 0 or processed < downloads_per_run:
+        limit = page_size if downloads_per_run == 0 else min(page_size, downloads_per_run - processed)
+        try:
+            crashes_list = get_crash_id_list(cursor=cursor, page_size=limit)
+        except Exception as e:
+            print("Error, could not run CR3 processing: " + str(e))
+            break
+        if not crashes_list:
+            break
+
+        results = list(executor.map(lambda crash_record: process_crash_cr3(crash_record, CRIS_BROWSER_COOKIES),
+                                    crashes_list))
+        stored_in_page = sum(results)
+
+        # Failed downloads usually mean the CRIS session expired (for the
+        # whole page, or its tail), we log in again and retry them once
+        failed_records = [crash_record for crash_record, result in zip(crashes_list, results) if not result]
+        if failed_records:
+            print("\n%s CR3s failed in this page, logging in again to retry them." % len(failed_records))
+            CRIS_BROWSER_COOKIES = cris_login()
+            stored_in_page += sum(executor.map(
+                lambda crash_record: process_crash_cr3(crash_record, CRIS_BROWSER_COOKIES), failed_records))
+
+        cursor = crashes_list[-1]["crash_id"]
+        processed += len(crashes_list)
+        stored += stored_in_page
+        elapsed = time.time() - start
+        print("\nProgress: %s crashes processed, %s CR3s stored, %.2f files/s" % (
+            processed, stored, stored / elapsed if elapsed > 0 else 0))
+
+        # Not a single CR3 even after logging in again
+        if stored_in_page == 0:
+            failed_pages += 1
+            if failed_pages > 1:
+                print("Error, no CR3 could be downloaded after logging in again, stopping.")
+                break
+        else:
+            failed_pages = 0
+
+        if len(crashes_list) < limit:
+            break
+
+get_cr3_flag_batch().flush()
+shutdown_upload_executor()
+print(report_cr3_transfers())
+print(get_cr3_flag_batch().report())
+report_rate_limiters()
 print("\nProcess done.")
 
 end = time.time()
 hours, rem = divmod(end-start, 3600)
 minutes, seconds = divmod(rem, 60)
-print("Finished in: {:0>2}:{:0>2}:{:05.2f}".format(int(hours),int(minutes),seconds))
\ No newline at end of file
+print("Finished in: {:0>2}:{:0>2}:{:05.2f}".format(int(hours),int(minutes),seconds))
@@ -4,9 +4,31 @@ Hasura - Healer
 Author: Austin Transportation Department, Data and Technology Services
 
 Description: The purpose of this script is to search for records that
-seem to be associated to a CR3, but the file is not present in S3.
+seem to be associated to a CR3, but the file is not present in S3, and
+for CR3 files in S3 whose records are not marked. Records marked without
+a file are unmarked, so the CR3 downloader picks them up again, and
+records with a file are marked. See process/helpers_cr3_heal.py.
+
+Examples:
+    process_hasura_cr3heal.py --dry-run
+    process_hasura_cr3heal.py
+    process_hasura_cr3heal.py --force
 
 The application requires the boto3 library:
     https://pypi.org/project/boto3/
 """
-print("Hasura - Healer: Request Download: Not yet implemented.")
+import time
+import argparse
+
+from process.helpers_cr3_heal import heal_cr3_flags
+
+parser = argparse.ArgumentParser(description="Reconciles cr3_stored_flag with the CR3 files in S3")
+parser.add_argument("--dry-run", action="store_true", help="Only report the differences")
+parser.add_argument("--force", action="store_true",
+                    help="Update the flags even when more than ATD_CR3HEAL_MAX_MISSING_FRACTION PDFs are missing")
+args = parser.parse_args()
+
+start = time.time()
+stats = heal_cr3_flags(dry_run=args.dry_run, force=args.force)
+print("Crashes set to 'N' (queued for download): %s, set to 'Y': %s" % (stats["set_n"], stats["set_y"]))
+print("Finished in %.1f seconds" % (time.time() - start))
@@ -9,15 +9,33 @@ The accuracy of the geocoder is contingent on the quality of the addresses
 provided in the data; therefore, data refining needs to be a priority for
 when designing business logic or philosophy.
 
+By default every record is geocoded with its own request. With --batch,
+the addresses of all records are deduplicated and geocoded in a single
+batch job, which allows backfilling tens of thousands of records at once:
+
+    process_hasura_geocode.py --batch --limit 50000
+
 The application requires the requests library:
     https://pypi.org/project/requests/
 """
 
 import time
+import argparse
 import concurrent.futures
 
 from process.config import ATD_ETL_CONFIG
 from process.helpers_hasura_geocode import *
+from process.helpers_rate_limit import report_rate_limiters
+
+parser = argparse.ArgumentParser(description="Geocodes crashes without coordinates")
+parser.add_argument("--batch", action="store_true", help="Geocode all records in a single batch job")
+parser.add_argument("--limit", type=int, default=None,
+                    help="Records per run (default: ATD_HERE_RECORDS_PER_RUN, "
+                         "or ATD_HERE_BATCH_RECORDS_PER_RUN with --batch)")
+parser.add_argument("--provider", default=None,
+                    help="Geocode provider (default: ATD_GEOCODE_PROVIDER, "
+                         "or ATD_GEOCODE_BATCH_PROVIDER with --batch)")
+args = parser.parse_args()
 
 # Start timer
 start = time.time()
@@ -26,19 +44,75 @@ max_threads = ATD_ETL_CONFIG["MAX_THREADS"]
 print("Hasura endpoint: '%s' " % ATD_ETL_CONFIG["HASURA_ENDPOINT"])
 print("Here endpoint: '%s' " % ATD_ETL_CONFIG["ATD_HERE_API_ENDPOINT"])
 
+if args.batch:
+    provider = get_geocode_provider(args.provider or ATD_ETL_CONFIG["ATD_GEOCODE_BATCH_PROVIDER"])
+    limit = args.limit or ATD_ETL_CONFIG["ATD_HERE_BATCH_RECORDS_PER_RUN"]
+else:
+    provider = get_geocode_provider(args.provider)
+    limit = args.limit
+
+print("Geocode provider: '%s' " % provider.name)
+
+# The queue picks the records by priority and skips the ones that failed recently
+geocode_queue = get_geocode_queue()
+if geocode_queue:
+    crash_records = geocode_queue.get_records(int(limit or ATD_ETL_CONFIG["ATD_HERE_RECORDS_PER_RUN"]))
+else:
+    crash_records = get_geocode_list(limit=limit)["data"]["atd_txdot_crashes"]
+
 
-records_to_geocode = get_geocode_list()
+def save_batch_result(crash_id, geocode_response):
+    if save_geocode_response(crash_id, geocode_response, provider.get_provider_id(geocode_response)):
+        record_geocode_success(crash_id)
+    else:
+        record_geocode_failure(crash_id, geocode_response)
 
 
-print("Records to be processed: ")
+print("Records to be processed: %s" % len(crash_records))
 
-with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-    for crash_record in records_to_geocode["data"]["atd_txdot_crashes"]:
-        executor.submit(process_geocode_record, crash_record)
+if args.batch:
+    geocode_results = process_geocode_batch(crash_records, provider)
+
+    # Records without a geocodable address are not part of the results
+    geocoded_crash_ids = set(crash_id for crash_id, _ in geocode_results)
+    for crash_record in crash_records:
+        if crash_record["crash_id"] not in geocoded_crash_ids:
+            record_geocode_failure(crash_record["crash_id"], None)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
+        for crash_id, geocode_response in geocode_results:
+            executor.submit(save_batch_result, crash_id, geocode_response)
+else:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
+        for crash_record in crash_records:
+            executor.submit(process_geocode_record, crash_record, provider)
 
 # for crash_record in records_to_geocode["data"]["atd_txdot_crashes"]:
 #     process_geocode_record(crash_record)
 
+# Write the remaining geocode results to Hasura
+geocode_writer = get_geocode_writer()
+geocode_writer.close()
+print(geocode_writer.report())
+
+geocode_archive = get_geocode_archive()
+if geocode_archive:
+    geocode_archive.close()
+    print(geocode_archive.report())
+
+report_rate_limiters()
+if geocode_queue:
+    print(geocode_queue.report())
+    geocode_queue.close()
+if hasattr(provider, "report"):
+    print(provider.report())
+
+geocode_cache = get_geocode_cache()
+if geocode_cache:
+    print(geocode_cache.report())
+    print("Expired cache entries removed: %s" % geocode_cache.purge_expired())
+    geocode_cache.close()
+
 end = time.time()
 hours, rem = divmod(end - start, 3600)
 minutes, seconds = divmod(rem, 60)
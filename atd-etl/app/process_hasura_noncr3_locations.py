@@ -6,94 +6,64 @@ Description: This script searches through the non-CR3 collisions table (through
 Hasura) in Postgres, for any crashes that do not have a location
 assigned. If the crash cannot be associated to a location, then it
 should skip it. 
+By default every record is assigned in a single set-based SQL statement
+(assign_noncr3_collision_locations, see atd-vzd/triggers/assign_collision_locations.sql)
+run through the Hasura schema API. With --strtree the records are assigned
+in this process against an STRtree of the location polygons, and with
+--per-location the locations are swept one by one by worker processes;
+the sweep progress is saved, so an interrupted sweep resumes where it stopped.
 Note: This script should run always in the background at a
 proper interval.
 The application requires the requests library:
     https://pypi.org/project/requests/
 """
-import json
-import copy
-import requests
-import concurrent.futures
-from process.request import run_query
-from string import Template
+from process.config import ATD_ETL_CONFIG
+from process.helpers_locations import assign_collision_locations, assign_locations_in_process, sweep_locations
+import argparse
 
 
 from datetime import datetime
 
 
-start_time = datetime.now()
-
-# Query to gather a list of all Locations
-locations_query = """
-    query getLocations {
-        atd_txdot_locations {
-            location_id
-            description
-        }
-    }
-"""
-
-find_noncr3_collisions_for_location_query = Template("""
-query nonCR3LocationsByLocation {
-    find_noncr3_collisions_for_location(args: {id: "$id"}) {
-        address
-        hour
-        latitude
-        location_id
-        longitude
-        form_id
-    }
-}
-""")
-
-update_record_noncr3 = Template("""
-    mutation CrashesUpdateRecordNonCR3 {
-        update_atd_apd_blueform(where: {form_id: {_eq: $id}}, _set: {location_id: "$location_id"}) {
-        affected_rows
-        }
-    }
-""")
-
-#
-# This method requests all the Locations in the atd_txdot_locations table and loops through each one.
-# During each iteration of the loop, it gets all the collisions that have coordinates inside its polygon.
-# It then loops through each non CR3 record and assigns a Location ID to the nonCR3 collison's "location_id"
-# if it doesn't have an exisiting Location ID assignement.
-#
-
-
-def add_locations_to_non_cr3s_by_location():
-    result = run_query(locations_query)
-    locations = result['data']['atd_txdot_locations']
-
-    # Loop over each location
-    for idx, location in enumerate(locations):
-
-        # Using findNonCR3crashesForLocation SQL function, get all the nonCR3s whose coordinates are
-        # inside the location polygon
-        collisions_query = find_noncr3_collisions_for_location_query.substitute(
-            id=location['location_id'])
-
-        collisions_result = run_query(collisions_query)
-
-        print(collisions_result)
-
-        collisions_array = collisions_result['data']['find_noncr3_collisions_for_location']
-
-        print("Processing LOCATION ID: {}. {} NON CR3s found.".format(
-            location["location_id"], len(collisions_array)))
-        print("{} of {} Locations".format(idx + 1, len(locations)))
-
-        # Loop through the values and update their location ID
-        for collision in collisions_array:
-            non_cr3_mutation = update_record_noncr3.substitute(
-                id=collision["form_id"], location_id=location["location_id"])
-            mutation_result = run_query(non_cr3_mutation)
-            print(mutation_result)
+parser = argparse.ArgumentParser(description="Assigns a location to non-CR3 collisions")
+parser.add_argument("--per-location", action="store_true",
+                    help="Sweep the locations one by one, resuming the previous sweep if it did not finish")
+parser.add_argument("--restart", action="store_true",
+                    help="With --per-location, discard the progress of the previous sweep")
+parser.add_argument("--strtree", action="store_true",
+                    help="Assign the records in this process, against an STRtree of the location polygons")
+parser.add_argument("--workers", type=int, default=ATD_ETL_CONFIG["ATD_LOCATIONS_WORKERS"],
+                    help="With --strtree or --per-location, the number of worker processes")
+parser.add_argument("--all", action="store_true",
+                    help="Re-evaluate the collisions that already have a location")
+args = parser.parse_args()
 
+start_time = datetime.now()
 
-add_locations_to_non_cr3s_by_location()
+if args.per_location:
+    stats = sweep_locations(
+        "noncr3",
+        progress_path=ATD_ETL_CONFIG["ATD_LOCATIONS_SWEEP_PATH"],
+        workers=args.workers,
+        chunk_size=ATD_ETL_CONFIG["ATD_LOCATIONS_SWEEP_CHUNK_SIZE"],
+        only_unassigned=not args.all,
+        restart=args.restart,
+    )
+    print("Locations swept: %s, records assigned: %s, failed chunks: %s." % (
+        stats["locations"], stats["assigned"], stats["failed_chunks"]))
+elif args.strtree:
+    stats = assign_locations_in_process(
+        "noncr3",
+        cache_path=ATD_ETL_CONFIG["ATD_LOCATIONS_CACHE_PATH"],
+        page_size=ATD_ETL_CONFIG["ATD_LOCATIONS_PAGE_SIZE"],
+        workers=args.workers,
+        batch_size=ATD_ETL_CONFIG["ATD_LOCATIONS_WRITE_BATCH_SIZE"],
+    )
+    print("Locations assigned to %s of %s records in %s requests, %s failed." % (
+        stats["assigned"], stats["read"], stats["requests"], stats["failed"]))
+else:
+    updated_rows = assign_collision_locations("assign_noncr3_collision_locations", only_unassigned=not args.all)
+    print("Locations assigned to %s records." % updated_rows)
 
 end_time = datetime.now()
 print('Duration: {}'.format(end_time - start_time))
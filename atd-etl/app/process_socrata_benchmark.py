@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+"""
+Socrata - Exporter Benchmark
+Author: Austin Transportation Department, Data & Technology Services
+
+Description: This script measures the performance of the Socrata exporter
+without hitting production Hasura or Socrata. Hasura page responses are
+saved as fixtures, either recorded from a real Hasura endpoint or generated
+synthetically, and then replayed through format_crash_data and
+format_person_data and a stub upsert sink that serializes the payloads.
+
+It reports records per second, allocated and peak memory for each
+formatter and each of the formatting steps they call. Results can be saved
+as a baseline, and later runs are compared against it so regressions are
+visible.
+
+Examples:
+    process_socrata_benchmark.py generate --scale 50000
+    process_socrata_benchmark.py record --max-pages 5
+    process_socrata_benchmark.py run --save-baseline
+    process_socrata_benchmark.py run --fail-on-regression
+
+The application requires the requests and sodapy libraries:
+    https://pypi.org/project/requests/
+    https://pypi.org/project/sodapy/
+"""
+import os
+import sys
+import json
+import gzip
+import glob
+import time
+import random
+import argparse
+import tracemalloc
+from functools import wraps
+
+import process.helpers_socrata as helpers_socrata
+from process.helpers_socrata import query_configs, upsert_records
+from process.socrata_queries import crash_metadata_query_template
+
+# The formatting steps called by format_crash_data and format_person_data
+FORMATTER_STEPS = [
+    "create_mode_flags",
+    "calc_mode_injury_totals",
+    "concatTimeAndDate",
+    "set_mode_columns",
+    "flatten_hasura_response",
+    "rename_record_columns",
+    "create_point_datatype",
+    "add_value_prefix",
+    "set_person_mode",
+]
+
+CRASH_METADATA_FILE = "crash_metadata.json.gz"
+
+
+def get_streams():
+    """
+    Returns a list of (config, template, table) for every Hasura stream of
+    the exporter. The templates of a config are listed in the same order as
+    the tables in its formatter config.
+    :return: list
+    """
+    streams = []
+    for config in query_configs:
+        for template, table in zip(config["templates"], config["formatter_config"]["tables"]):
+            streams.append((config, template, table))
+    return streams
+
+
+def save_json(path, data):
+    """
+    Saves data to a gzip-compressed json file
+    :param path: string - The file path
+    :param data: object - The data to save
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, "wt", encoding="utf-8") as file:
+        json.dump(data, file)
+
+
+def load_json(path):
+    """
+    Loads data from a gzip-compressed json file
+    :param path: string - The file path
+    :return: object
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def page_path(fixtures, table, page):
+    return os.path.join(fixtures, table, "page_%05d.json.gz" % page)
+
+
+def remove_pages(fixtures, table):
+    """
+    Removes the pages of a table, so pages of a previous (larger) run
+    are not replayed
+    :param fixtures: string - The fixtures folder
+    :param table: string - The table name
+    """
+    for path in glob.glob(os.path.join(fixtures, table, "page_*.json.gz")):
+        os.remove(path)
+
+
+def record_fixtures(fixtures, page_size, max_pages):
+    """
+    Records real Hasura page responses for every exporter stream, and the
+    crash metadata needed by the person formatter.
+    :param fixtures: string - The fixtures folder
+    :param page_size: int - Records per page
+    :param max_pages: int - Maximum number of pages per stream
+    """
+    crash_ids = set()
+    for config, template, table in get_streams():
+        remove_pages(fixtures, table)
+        for page in range(max_pages):
+            data = helpers_socrata.run_hasura_query(
+                template.substitute(limit=page_size, offset=page * page_size))
+            records = data["data"][table]
+            if len(records) == 0:
+                break
+            save_json(page_path(fixtures, table, page), data)
+            crash_ids.update(record["crash_id"] for record in records
+                             if config["table"] == "person")
+            print("Recorded %s page %s: %s records" % (table, page, len(records)))
+
+    crash_metadata = []
+    crash_ids = sorted(crash_ids)
+    for i in range(0, len(crash_ids), 500):
+        data = helpers_socrata.run_hasura_query(crash_metadata_query_template.substitute(
+            crash_ids=", ".join(str(crash_id) for crash_id in crash_ids[i:i + 500])))
+        crash_metadata += data["data"]["atd_txdot_crashes"]
+    save_json(os.path.join(fixtures, CRASH_METADATA_FILE), crash_metadata)
+    print("Recorded metadata for %s crashes" % len(crash_metadata))
+
+
+def generate_crash(crash_id):
+    """
+    Generates a synthetic crash with the fields of crashes_query_template
+    :param crash_id: int - The crash id
+    :return: dict
+    """
+    units = []
+    for unit_nbr in range(1, random.choice([1, 2, 2, 2, 3, 4]) + 1):
+        mode_id = random.randint(1, 9)
+        units.append({
+            "unit_nbr": unit_nbr,
+            "unit_id": crash_id * 10 + unit_nbr,
+            "mode_id": mode_id,
+            "mode_desc": "Mode %s" % mode_id,
+            "death_cnt": random.choice([0] * 30 + [1]),
+            "sus_serious_injry_cnt": random.choice([0] * 10 + [1, 2]),
+            "contrib_factr_p1_id": random.randint(1, 80),
+            "contrib_factr_p2_id": random.choice([None, random.randint(1, 80)]),
+        })
+    has_position = random.random() < 0.95
+    return {
+        "apd_confirmed_fatality": "N",
+        "apd_confirmed_death_count": sum(unit["death_cnt"] for unit in units),
+        "crash_id": crash_id,
+        "crash_fatal_fl": "N",
+        "crash_date": "20%02d-%02d-%02d" % (random.randint(10, 20), random.randint(1, 12), random.randint(1, 28)),
+        "crash_time": "%02d:%02d:00" % (random.randint(0, 23), random.randint(0, 59)),
+        "case_id": str(random.randint(100000000, 999999999)),
+        "onsys_fl": random.choice(["Y", "N"]),
+        "private_dr_fl": "N",
+        "rpt_latitude": None,
+        "rpt_longitude": None,
+        "rpt_block_num": str(random.randint(100, 9900)),
+        "rpt_street_pfx": random.choice([None, "N", "S", "E", "W"]),
+        "rpt_street_name": random.choice(["LAMAR", "CONGRESS", "RIVERSIDE", "SLAUGHTER", "IH 35"]),
+        "rpt_street_sfx": random.choice(["BLVD", "AVE", "DR", "LN", None]),
+        "crash_speed_limit": random.choice([25, 30, 35, 45, 55, 65]),
+        "road_constr_zone_fl": "N",
+        "latitude_primary": round(random.uniform(30.1, 30.5), 6) if has_position else None,
+        "longitude_primary": round(random.uniform(-97.9, -97.6), 6) if has_position else None,
+        "street_name": None,
+        "street_nbr": None,
+        "street_name_2": None,
+        "street_nbr_2": None,
+        "crash_sev_id": random.randint(0, 5),
+        "sus_serious_injry_cnt": sum(unit["sus_serious_injry_cnt"] for unit in units),
+        "nonincap_injry_cnt": random.randint(0, 2),
+        "poss_injry_cnt": random.randint(0, 2),
+        "non_injry_cnt": random.randint(0, 4),
+        "unkn_injry_cnt": 0,
+        "tot_injry_cnt": random.randint(0, 4),
+        "death_cnt": sum(unit["death_cnt"] for unit in units),
+        "atd_mode_category_metadata": [
+            {key: unit[key] for key in ["unit_id", "mode_id", "mode_desc", "death_cnt", "sus_serious_injry_cnt"]}
+            for unit in units
+        ],
+        "units": units,
+    }
+
+
+def generate_fixtures(fixtures, scale, page_size, seed):
+    """
+    Generates synthetic Hasura page responses for every exporter stream
+    :param fixtures: string - The fixtures folder
+    :param scale: int - The number of crashes to generate
+    :param page_size: int - Records per page
+    :param seed: int - The random seed, so fixtures are reproducible
+    """
+    random.seed(seed)
+    crashes = [generate_crash(crash_id) for crash_id in range(1, scale + 1)]
+
+    people = {"atd_txdot_person": [], "atd_txdot_primaryperson": []}
+    for crash in crashes:
+        for unit in crash["units"]:
+            people["atd_txdot_primaryperson"].append(unit)
+            for _ in range(random.choice([0, 0, 1, 2])):
+                people["atd_txdot_person"].append(unit)
+
+    for table, units in people.items():
+        id_column = "person_id" if table == "atd_txdot_person" else "primaryperson_id"
+        people[table] = [{
+            id_column: person_id,
+            "prsn_injry_sev_id": random.choice([1, 4]),
+            "prsn_age": random.randint(1, 90),
+            "prsn_gndr_id": random.randint(1, 2),
+            "prsn_ethnicity_id": random.randint(1, 6),
+            "unit_nbr": unit["unit_nbr"],
+            "crash_id": unit["unit_id"] // 10,
+        } for person_id, unit in enumerate(units, start=1)]
+
+    crash_metadata = [{
+        "crash_id": crash["crash_id"],
+        "crash_date": crash["crash_date"],
+        "atd_mode_category_metadata": crash["atd_mode_category_metadata"],
+        "units": [{"unit_nbr": unit["unit_nbr"], "unit_id": unit["unit_id"]} for unit in crash["units"]],
+    } for crash in crashes]
+
+    for crash in crashes:
+        crash["units"] = [{"contrib_factr_p1_id": unit["contrib_factr_p1_id"],
+                           "contrib_factr_p2_id": unit["contrib_factr_p2_id"]} for unit in crash["units"]]
+
+    tables = dict(people, atd_txdot_crashes=crashes)
+    for config, template, table in get_streams():
+        records = tables[table]
+        remove_pages(fixtures, table)
+        for page, i in enumerate(range(0, len(records), page_size)):
+            save_json(page_path(fixtures, table, page), {"data": {table: records[i:i + page_size]}})
+        print("Generated %s: %s records" % (table, len(records)))
+    save_json(os.path.join(fixtures, CRASH_METADATA_FILE), crash_metadata)
+
+
+class StubSocrataClient:
+    """
+    Stands in for the Socrata client, it only serializes the payload
+    """
+    def __init__(self):
+        self.total_bytes = 0
+
+    def upsert(self, dataset_uid, records):
+        self.total_bytes += len(json.dumps(records))
+
+
+def replay_crash_metadata(fixtures):
+    """
+    Returns a function that answers crash metadata queries from the fixtures,
+    in place of run_hasura_query.
+    :param fixtures: string - The fixtures folder
+    :return: function
+    """
+    path = os.path.join(fixtures, CRASH_METADATA_FILE)
+    crashes = {crash["crash_id"]: crash for crash in load_json(path)} if os.path.exists(path) else {}
+
+    def run_hasura_query(query):
+        crash_ids = query[query.index("_in: [") + 6:query.index("]")].split(",")
+        return {"data": {"atd_txdot_crashes": [
+            crashes[int(crash_id)] for crash_id in crash_ids if int(crash_id) in crashes
+        ]}}
+
+    return run_hasura_query
+
+
+def wrap_steps(stats, measure_memory):
+    """
+    Replaces the formatting steps in helpers_socrata with wrappers that
+    accumulate time (or memory) per step.
+    :param stats: dict - Dict of step name and accumulated stats
+    :param measure_memory: bool - True to measure memory instead of time
+    :return: dict - The original functions, to restore them
+    """
+    originals = {}
+    for name in FORMATTER_STEPS:
+        original = getattr(helpers_socrata, name)
+        originals[name] = original
+        step_stats = stats.setdefault(name, {"calls": 0, "records": 0, "seconds": 0.0,
+                                             "allocated_bytes": 0, "peak_bytes": None})
+
+        def wrapper(original, step_stats):
+            @wraps(original)
+            def step(records, *args, **kwargs):
+                step_stats["calls"] += 1
+                step_stats["records"] += len(records)
+                if measure_memory:
+                    current_before, _ = tracemalloc.get_traced_memory()
+                    if hasattr(tracemalloc, "reset_peak"):
+                        tracemalloc.reset_peak()
+                    result = original(records, *args, **kwargs)
+                    current_after, peak = tracemalloc.get_traced_memory()
+                    step_stats["allocated_bytes"] += current_after - current_before
+                    if hasattr(tracemalloc, "reset_peak"):
+                        step_stats["peak_bytes"] = max(step_stats["peak_bytes"] or 0, peak - current_before)
+                    return result
+                start = time.perf_counter()
+                result = original(records, *args, **kwargs)
+                step_stats["seconds"] += time.perf_counter() - start
+                return result
+            return step
+
+        setattr(helpers_socrata, name, wrapper(original, step_stats))
+    return originals
+
+
+def restore_steps(originals):
+    for name, original in originals.items():
+        setattr(helpers_socrata, name, original)
+
+
+def get_pages(fixtures, config):
+    """
+    Returns the fixture files of a config, in stream order
+    :param fixtures: string - The fixtures folder
+    :param config: dict - The query config
+    :return: list - List of file paths
+    """
+    pages = []
+    for table in config["formatter_config"]["tables"]:
+        pages += sorted(glob.glob(os.path.join(fixtures, table, "page_*.json.gz")))
+    return pages
+
+
+def benchmark_config(fixtures, config):
+    """
+    Replays the fixtures of a config through its formatter and the stub sink
+    :param fixtures: string - The fixtures folder
+    :param config: dict - The query config
+    :return: dict - The results
+    """
+    pages = get_pages(fixtures, config)
+    formatter = config["formatter"]
+    steps = {}
+    result = {"pages": len(pages), "records": 0, "format_seconds": 0.0, "upsert_seconds": 0.0,
+              "payload_bytes": 0, "peak_bytes": 0, "allocated_bytes": 0, "steps": steps}
+
+    # Throughput, with every step timed
+    client = StubSocrataClient()
+    helpers_socrata.crash_metadata_cache.clear()
+    originals = wrap_steps(steps, measure_memory=False)
+    try:
+        for page in pages:
+            data = load_json(page)
+            start = time.perf_counter()
+            records = formatter(data, config["formatter_config"])
+            result["format_seconds"] += time.perf_counter() - start
+            start = time.perf_counter()
+            upsert_records(client, "benchmark", records)
+            result["upsert_seconds"] += time.perf_counter() - start
+            result["records"] += len(records)
+    finally:
+        restore_steps(originals)
+    result["payload_bytes"] = client.total_bytes
+
+    # Peak and retained memory of the whole formatter, per page
+    helpers_socrata.crash_metadata_cache.clear()
+    for page in pages:
+        data = load_json(page)
+        tracemalloc.start()
+        records = formatter(data, config["formatter_config"])
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_bytes"] = max(result["peak_bytes"], peak)
+        result["allocated_bytes"] += current
+        del records
+
+    # Memory of every step
+    memory_steps = {}
+    helpers_socrata.crash_metadata_cache.clear()
+    originals = wrap_steps(memory_steps, measure_memory=True)
+    try:
+        for page in pages:
+            data = load_json(page)
+            tracemalloc.start()
+            formatter(data, config["formatter_config"])
+            tracemalloc.stop()
+    finally:
+        restore_steps(originals)
+
+    for name in list(steps.keys()):
+        if steps[name]["calls"] == 0:
+            del steps[name]
+            continue
+        steps[name]["allocated_bytes"] = memory_steps[name]["allocated_bytes"]
+        steps[name]["peak_bytes"] = memory_steps[name]["peak_bytes"]
+        steps[name]["records_per_second"] = steps[name]["records"] / steps[name]["seconds"] \
+            if steps[name]["seconds"] > 0 else 0
+
+    result["records_per_second"] = result["records"] / result["format_seconds"] \
+        if result["format_seconds"] > 0 else 0
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the results next to the baseline and returns the regressions
+    :param results: dict - The results of this run
+    :param baseline: dict - The baseline results
+    :param tolerance: float - The allowed relative change, ie. 0.2 for 20%
+    :return: list - List of regression descriptions
+    """
+    regressions = []
+
+    def check(label, current, previous, higher_is_better):
+        if not previous or current is None:
+            return ""
+        change = (current - previous) / previous
+        worse = -change if higher_is_better else change
+        if worse > tolerance:
+            regressions.append("%s: %.1f%% worse" % (label, worse * 100))
+            return "  REGRESSION (%+.1f%%)" % (change * 100)
+        return "  (%+.1f%%)" % (change * 100)
+
+    for table, result in results.items():
+        previous = baseline.get(table, {})
+        print("\n%s: %s records in %s pages" % (table, result["records"], result["pages"]))
+        print("  formatter: %.0f records/s%s, peak %.1f MB%s, retained %.1f MB across pages" % (
+            result["records_per_second"],
+            check("%s formatter records/s" % table, result["records_per_second"],
+                  previous.get("records_per_second"), True),
+            result["peak_bytes"] / 1e6,
+            check("%s formatter peak" % table, result["peak_bytes"], previous.get("peak_bytes"), False),
+            result["allocated_bytes"] / 1e6))
+        print("  upsert stub: %.2fs for %.1f MB of payload" % (
+            result["upsert_seconds"], result["payload_bytes"] / 1e6))
+        for name, step in result["steps"].items():
+            previous_step = previous.get("steps", {}).get(name, {})
+            print("    %-26s %12.0f records/s%s, allocated %8.1f MB%s" % (
+                name, step["records_per_second"],
+                check("%s.%s records/s" % (table, name), step["records_per_second"],
+                      previous_step.get("records_per_second"), True),
+                step["allocated_bytes"] / 1e6,
+                "" if step["peak_bytes"] is None else ", peak %.1f MB" % (step["peak_bytes"] / 1e6)))
+
+    return regressions
+
+
+parser = argparse.ArgumentParser(description="Benchmarks the Socrata exporter formatters")
+parser.add_argument("command", choices=["record", "generate", "run"])
+parser.add_argument("--fixtures", default="/data/fixtures/socrata", help="Fixtures folder")
+parser.add_argument("--page-size", type=int, default=6000, help="Records per page")
+parser.add_argument("--max-pages", type=int, default=10, help="Pages per stream to record")
+parser.add_argument("--scale", type=int, default=10000, help="Number of synthetic crashes")
+parser.add_argument("--seed", type=int, default=1, help="Random seed for synthetic fixtures")
+parser.add_argument("--baseline", default=None, help="Baseline file (default: [fixtures]/baseline.json)")
+parser.add_argument("--save-baseline", action="store_true", help="Save the results as the new baseline")
+parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative change (default: 0.2)")
+parser.add_argument("--fail-on-regression", action="store_true", help="Exit with 1 when a regression is found")
+args = parser.parse_args()
+
+if args.command == "record":
+    record_fixtures(args.fixtures, args.page_size, args.max_pages)
+    sys.exit(0)
+
+if args.command == "generate":
+    generate_fixtures(args.fixtures, args.scale, args.page_size, args.seed)
+    sys.exit(0)
+
+helpers_socrata.run_hasura_query = replay_crash_metadata(args.fixtures)
+baseline_path = args.baseline or os.path.join(args.fixtures, "baseline.json")
+baseline = {}
+if os.path.exists(baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+
+results = {}
+for config in query_configs:
+    results[config["table"]] = benchmark_config(args.fixtures, config)
+
+regressions = compare(results, baseline, args.tolerance)
+
+if args.save_baseline:
+    with open(baseline_path, "w") as baseline_file:
+        json.dump(results, baseline_file, indent=2)
+    print("\nBaseline saved to %s" % baseline_path)
+
+if regressions:
+    print("\nRegressions against %s:" % baseline_path)
+    for regression in regressions:
+        print("  " + regression)
+    if args.fail_on_regression:
+        sys.exit(1)
@@ -4,7 +4,10 @@ Socrata - Exporter
 Author: Austin Transportation Department, Data & Technology Services
 
 Description: The purpose of this script is to gather data from Hasura
-and export it to the Socrata database.
+and export it to the Socrata database. Alternatively, the records can be
+written to local NDJSON, CSV or GeoJSON files for bulk snapshots:
+
+    process_socrata_export.py --sink csv --output /data/exports --gzip
 
 The application requires the requests and sodapy libraries:
     https://pypi.org/project/requests/
@@ -12,88 +15,119 @@ The application requires the requests and sodapy libraries:
 """
 import os
 import time
+import argparse
 from string import Template
-from sodapy import Socrata
 from process.config import ATD_ETL_CONFIG
 from process.helpers_socrata import *
+from process.helpers_socrata_manifest import *
+from process.helpers_export_sinks import *
 from process.socrata_queries import *
 print("Socrata - Exporter:  Started.")
 
+parser = argparse.ArgumentParser(description="Exports crash and person records from Hasura")
+parser.add_argument("--sink", choices=["socrata", "ndjson", "csv", "geojson"], default="socrata",
+                    help="Where to export the records (default: socrata)")
+parser.add_argument("--output", default="/data/exports",
+                    help="Folder for file sinks (default: /data/exports)")
+parser.add_argument("--gzip", action="store_true", help="Compress file sinks with gzip")
+parser.add_argument("--tables", default="crash,person",
+                    help="Comma-separated list of tables to export (default: crash,person)")
+args = parser.parse_args()
+tables = args.tables.split(",")
+
 # Setup connection to Socrata
-client = Socrata("data.austintexas.gov", ATD_ETL_CONFIG["SOCRATA_APP_TOKEN"],
-                 username=ATD_ETL_CONFIG["SOCRATA_KEY_ID"], password=ATD_ETL_CONFIG["SOCRATA_KEY_SECRET"], timeout=20)
-
-# Define tables to query from Hasura and publish to Socrata
-query_configs = [
-    {
-        "table": "crash",
-        "template": crashes_query_template,
-        "formatter": format_crash_data,
-        "formatter_config": {
-            "tables": ["atd_txdot_crashes"],
-            "columns_to_rename": {
-                "veh_body_styl_desc": "unit_desc",
-                "veh_unit_desc_desc": "unit_mode",
-                "latitude_primary": "latitude",
-                "longitude_primary": "longitude"
-            }
-        },
-        # "dataset_uid": "3aut-fhzp"  # TEST
-        "dataset_uid": "y2wy-tgr5"  # PROD
-    },
-    {
-        "table": "person",
-        "template": people_query_template,
-        "formatter": format_person_data,
-        "formatter_config": {
-            "tables": ["atd_txdot_person", "atd_txdot_primaryperson"],
-            "columns_to_rename": {
-                "primaryperson_id": "person_id"
-            },
-            "prefixes": {
-                "person_id": "P",
-                "primaryperson_id": "PP",
-            }
-        },
-        # "dataset_uid": "v3x4-fjgm"  # TEST
-        "dataset_uid": "xecs-rpy9"  # PROD
-    }
-]
+client = get_socrata_client() if args.sink == "socrata" else None
 
 # Start timer
 start = time.time()
 
 # For each config, get records from Hasura and upsert to Socrata until res is []
 for config in query_configs:
+    if config["table"] not in tables:
+        continue
+
     print(f'Starting {config["table"]} table...')
-    records = None
-    offset = 0
     limit = 6000
     total_records = 0
+    changed_records = 0
+    failed_chunks = 0
+    chunk_size = ATD_ETL_CONFIG["SOCRATA_UPSERT_CHUNK_SIZE"]
+    sink = open_sink(args.sink, args.output, config["table"], compress=args.gzip) \
+        if client is None else None
+    manifest = open_manifest(config["dataset_uid"]) \
+        if client is not None and manifest_enabled() else None
 
     # Query records from Hasura and upsert to Socrata
-    while records != []:
-        # Create query, increment offset, and query DB
-        query = config["template"].substitute(
-            limit=limit, offset=offset)
-        offset += limit
-        data = run_hasura_query(query)
-
-        # Format records
-        records = config["formatter"](data, config["formatter_config"])
-
-        # Upsert records to Socrata
-        client.upsert(config["dataset_uid"], records)
-        print(f'{offset} records upserted')
-        total_records += len(records)
-
-        if len(records) == 0:
-            print(
-                f'{total_records} {config["table"]} records upserted.')
-            print(f'Completed {config["table"]} table.')
+    for template in config["templates"]:
+        records = None
+        offset = 0
+        while records != []:
+            # Create query, increment offset, and query DB
+            query = template.substitute(
+                limit=limit, offset=offset)
+            offset += limit
+            data = run_hasura_query(query)
+
+            # Format records
+            records = config["formatter"](data, config["formatter_config"])
+            total_records += len(records)
+
+            # Write records to the local file, if that is the chosen sink
+            if sink is not None:
+                sink.write(records)
+                print(f'{offset} records written to {sink.path}')
+                continue
+
+            # Skip the records that have not changed since the last export
+            if manifest is not None:
+                upsert_list, fingerprints = filter_changed_records(
+                    manifest, records, config["id_column"])
+            else:
+                upsert_list, fingerprints = records, {}
+
+            # Upsert records to Socrata in concurrent chunks
+            chunk_results = upsert_records(
+                client, config["dataset_uid"], upsert_list, chunk_size=chunk_size)
+            changed_records += len(upsert_list)
+
+            # Only remember the fingerprints of the chunks that made it to Socrata
+            chunks = chunk_records(upsert_list, chunk_size)
+            for result in chunk_results:
+                if result["error"] is not None:
+                    failed_chunks += 1
+                    for record in chunks[result["chunk"] - 1]:
+                        fingerprints.pop(str(record[config["id_column"]]), None)
+            if manifest is not None:
+                save_fingerprints(manifest, fingerprints)
+
+            print(f'{offset} records processed, {len(upsert_list)} changed records upserted')
+
+    if sink is not None:
+        sink.close()
+        print(f'{sink.total_records} {config["table"]} records written to {sink.path}')
+    else:
+        print(f'{changed_records} of {total_records} {config["table"]} records upserted.')
+    if failed_chunks > 0:
+        print(f'{failed_chunks} {config["table"]} chunks failed after retries.')
+
+    # Rows in the manifest that Hasura no longer returns are listed for deletion
+    if manifest is not None:
+        deleted_row_ids = get_deleted_row_ids(manifest)
+        print(f'{len(deleted_row_ids)} {config["table"]} records no longer exported: {deleted_row_ids}')
+        if deleted_row_ids and ATD_ETL_CONFIG["SOCRATA_MANIFEST_DELETE"] == "ENABLED":
+            delete_results = upsert_records(client, config["dataset_uid"], build_delete_records(
+                deleted_row_ids, config["id_column"]), chunk_size=chunk_size)
+            delete_chunks = chunk_records(deleted_row_ids, chunk_size)
+            for result in delete_results:
+                if result["error"] is None:
+                    remove_fingerprints(manifest, delete_chunks[result["chunk"] - 1])
+        manifest.close()
+
+    print(f'Completed {config["table"]} table.')
 
 # Terminate Socrata connection
-client.close()
+if client is not None:
+    client.close()
 
 # Stop timer and print duration
 end = time.time()
@@ -0,0 +1,49 @@
+"""
+Tests of the address normalizer, with the built-in vocabulary
+Run from atd-etl/app with: python -m pytest tests
+"""
+import os
+
+os.environ["ATD_ADDRESS_VOCABULARY"] = "BUILTIN"
+
+import pytest
+
+from process.helpers_address import normalize_street, normalize_address
+
+
+@pytest.mark.parametrize("block_num, prefix, name, suffix, expected", [
+    # Street names with words that are also suffixes or directions
+    ("1100", None, "SPRING CREEK", "DR", "1100 SPRING CREEK DR"),
+    ("500", None, "MOUNTAIN VIEW", "DR", "500 MOUNTAIN VIEW DR"),
+    ("200", None, "PARK PLACE", "CT", "200 PARK PLACE CT"),
+    ("100", None, "EAST", "AVE", "100 EAST AVE"),
+    ("100", "N", "EAST", "AVE", "100 N EAST AVE"),
+    ("300", None, "NORTH LOOP", None, "300 NORTH LOOP"),
+    # Spellings of the same street
+    ("1100", "NORTH", "Lamar Boulevard", "Blvd", "1100 N LAMAR BLVD"),
+    ("1100", "N", "N LAMAR", "BLVD", "1100 N LAMAR BLVD"),
+    ("1100 1100", "N.", "lamar", "boulevard", "1100 N LAMAR BLVD"),
+    ("1100", None, "LAMAR BLVD", "NB", "1100 LAMAR BLVD N"),
+])
+def test_normalize_street(block_num, prefix, name, suffix, expected):
+    assert normalize_street(block_num, prefix, name, suffix) == expected
+
+
+def test_normalize_address():
+    assert normalize_address("n lamar blvd  & W. 5th Street, Austin, TX") == "N LAMAR BLVD & W 5TH ST, AUSTIN, TX"
+    assert normalize_address("1100 Spring Creek Drive, Austin, TX") == "1100 SPRING CREEK DR, AUSTIN, TX"
+
+
+def test_faulty_streets_are_normalized():
+    from process.helpers_hasura_geocode import build_address, is_faulty_street, render_geocode_address
+
+    record = {
+        "crash_id": 1,
+        "rpt_street_name": "PRIVATE ROAD",
+        "rpt_sec_street_name": "LAMAR",
+        "rpt_sec_street_sfx": "BLVD",
+    }
+    assert build_address(record) == "PRIVATE RD"
+    assert is_faulty_street(build_address(record))
+    assert not is_faulty_street(build_address(record, primary=False))
+    assert render_geocode_address(record) is None
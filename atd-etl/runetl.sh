@@ -64,8 +64,15 @@ function runetl {
         return;
     fi;
 
-    # If the command is Hasura locations, then change the image accordingly
-    if [[ "$RUN_COMMAND" = "app/process_hasura_locations.py" ]]; then
+    # If the command is Hasura locations, or it needs shapely (the streets
+    # geocoder or the --strtree location assignment), then change the image accordingly
+    if [[ "$RUN_COMMAND" == "app/process_hasura_locations.py"* ]] \
+        || [[ "$RUN_COMMAND" == *"--strtree"* ]] \
+        || [[ "$RUN_COMMAND" == *"--provider streets"* ]] \
+        || [[ "$RUN_COMMAND" == *"--provider=streets"* ]] \
+        || { [[ "$RUN_COMMAND" == *"process_hasura_geocode.py"* ]] \
+            && [[ "$RUN_COMMAND" != *"--provider"* ]] \
+            && grep -qE '^ATD_GEOCODE_PROVIDER="?streets' "${ATD_CRIS_CONFIG}"; }; then
         export ATD_DOCKER_IMAGE="$ATD_DOCKER_IMAGE_AGOL";
     fi;
 
@@ -0,0 +1,86 @@
+-----------------------------------------
+-- Spatial indexes on the crash (CR3) and blueform (non-CR3) points
+--
+-- find_cr3_collisions_for_location and find_noncr3_collisions_for_location
+-- build the point of every row with ST_SetSRID(ST_MakePoint(lon, lat), 4326),
+-- which forced a sequential scan of the whole table on every call. These are
+-- expression indexes on that same point, so the functions below can use them
+-- without rewriting any row (atd_txdot_crashes.position is stored without an
+-- SRID, and updating it would copy every crash into the change log).
+--
+-- CREATE INDEX CONCURRENTLY cannot run inside a transaction block,
+-- run these two statements on their own.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS atd_txdot_crashes_point_primary_gist
+    ON atd_txdot_crashes
+    USING gist (ST_SetSRID(ST_MakePoint(longitude_primary, latitude_primary), 4326))
+    WHERE latitude_primary IS NOT NULL AND longitude_primary IS NOT NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS atd_apd_blueform_point_gist
+    ON atd_apd_blueform
+    USING gist (ST_SetSRID(ST_MakePoint(longitude, latitude), 4326))
+    WHERE latitude IS NOT NULL AND longitude IS NOT NULL;
+
+ANALYZE atd_txdot_crashes;
+ANALYZE atd_apd_blueform;
+
+-----------------------------------------
+-- New versions of the lookup functions: the location is found by its primary
+-- key once, and the points are matched with a bounding-box prefilter (&&)
+-- and ST_Contains against the indexed expression (points on the boundary are
+-- left out, as in assign_*_collision_locations and find_location_for_point).
+-- See triggers/find_cr3_collisions_for_location.sql and
+-- triggers/find_noncr3_collisions_for_location.sql
+
+CREATE OR REPLACE FUNCTION public.find_cr3_collisions_for_location
+(id varchar)
+ RETURNS SETOF atd_txdot_crashes
+ LANGUAGE sql
+ STABLE
+AS $function$
+SELECT
+  cr3_crash.*
+FROM
+  atd_txdot_locations AS atd_loc
+  JOIN atd_txdot_crashes AS cr3_crash
+    ON atd_loc.shape && ST_SetSRID(ST_MakePoint(cr3_crash.longitude_primary, cr3_crash.latitude_primary), 4326)
+    AND ST_Contains(atd_loc.shape, ST_SetSRID(ST_MakePoint(cr3_crash.longitude_primary, cr3_crash.latitude_primary), 4326))
+WHERE
+  atd_loc.location_id = id
+  AND cr3_crash.latitude_primary IS NOT NULL
+  AND cr3_crash.longitude_primary IS NOT NULL
+$function$;
+
+CREATE OR REPLACE FUNCTION public.find_noncr3_collisions_for_location
+(id varchar)
+ RETURNS SETOF atd_apd_blueform
+ LANGUAGE sql
+ STABLE
+AS $function$
+SELECT
+  blueform.*
+FROM
+  atd_txdot_locations AS atd_loc
+  JOIN atd_apd_blueform AS blueform
+    ON atd_loc.shape && ST_SetSRID(ST_MakePoint(blueform.longitude, blueform.latitude), 4326)
+    AND ST_Contains(atd_loc.shape, ST_SetSRID(ST_MakePoint(blueform.longitude, blueform.latitude), 4326))
+WHERE
+  atd_loc.location_id = id
+  AND blueform.latitude IS NOT NULL
+  AND blueform.longitude IS NOT NULL
+$function$;
+
+-----------------------------------------
+-- To confirm the indexes are used, the plan of the function body should show
+-- an "Index Scan using atd_txdot_crashes_point_primary_gist" (or a Bitmap
+-- Index Scan on it) instead of a "Seq Scan on atd_txdot_crashes":
+--
+-- EXPLAIN ANALYZE
+-- SELECT cr3_crash.crash_id
+-- FROM atd_txdot_locations AS atd_loc
+--   JOIN atd_txdot_crashes AS cr3_crash
+--     ON atd_loc.shape && ST_SetSRID(ST_MakePoint(cr3_crash.longitude_primary, cr3_crash.latitude_primary), 4326)
+--     AND ST_Contains(atd_loc.shape, ST_SetSRID(ST_MakePoint(cr3_crash.longitude_primary, cr3_crash.latitude_primary), 4326))
+-- WHERE atd_loc.location_id = '<location_id>'
+--   AND cr3_crash.latitude_primary IS NOT NULL
+--   AND cr3_crash.longitude_primary IS NOT NULL;
@@ -0,0 +1,16 @@
+-----------------------------------------
+-- Side table for the full geocode responses of the ETL geocoder.
+-- With ATD_GEOCODE_METADATA=COMPACT, atd_txdot_crashes.geocode_match_metadata
+-- only holds the fields we use (relevance, match level, matched address and
+-- coordinates); the full response is kept here (ATD_GEOCODE_ARCHIVE=TABLE),
+-- outside of the crashes table and its change log.
+
+CREATE TABLE IF NOT EXISTS atd_txdot_geocode_responses (
+    crash_id integer NOT NULL,
+    geocode_provider integer,
+    response jsonb NOT NULL,
+    created_at timestamp without time zone DEFAULT now() NOT NULL,
+    CONSTRAINT atd_txdot_geocode_responses_pkey PRIMARY KEY (crash_id)
+);
+
+COMMENT ON TABLE atd_txdot_geocode_responses IS 'Latest full geocode response of every crash, keyed by crash_id';
@@ -0,0 +1,7 @@
+-----------------------------------------
+-- Register the street centerline geocoder of the ETL (provider "streets"),
+-- crashes geocoded locally against atd_txdot_streets use geocode_provider = 2
+
+INSERT INTO atd_txdot_geocoders (geocoder_id, name, description)
+VALUES (2, 'ATD Streets', 'Local geocoder backed by the street centerlines in atd_txdot_streets')
+ON CONFLICT (geocoder_id) DO NOTHING;
@@ -0,0 +1,520 @@
+-----------------------------------------
+-- Location aggregates
+--
+-- The location page (get_location_totals and the views
+-- view_location_injry_count_cost_summary,
+-- view_location_crashes_by_manner_collision and
+-- view_location_crashes_by_veh_body_style) re-aggregated every crash,
+-- blueform and unit of a location on every load. These tables keep the
+-- aggregates per location (and year), refreshed by statement-level triggers
+-- for the locations a statement touches; the views and the function now read
+-- from them.
+--
+-- Function definitions: triggers/refresh_location_totals.sql and
+-- triggers/get_location_totals.sql
+
+CREATE TABLE IF NOT EXISTS atd_location_totals (
+    location_id character varying(32) NOT NULL,
+    year integer NOT NULL,
+    cr3_crashes integer DEFAULT 0 NOT NULL,
+    cr3_deaths integer DEFAULT 0 NOT NULL,
+    cr3_serious_injuries integer DEFAULT 0 NOT NULL,
+    cr3_est_comp_cost numeric DEFAULT 0 NOT NULL,
+    cr3_austin_crashes integer DEFAULT 0 NOT NULL,
+    cr3_austin_est_comp_cost numeric DEFAULT 0 NOT NULL,
+    noncr3_crashes integer DEFAULT 0 NOT NULL,
+    CONSTRAINT atd_location_totals_pkey PRIMARY KEY (location_id, year)
+);
+
+COMMENT ON TABLE atd_location_totals IS 'CR3 and non-CR3 crash totals per location and year (year 0: no crash date), see refresh_location_totals';
+
+CREATE TABLE IF NOT EXISTS atd_location_collision_totals (
+    location_id character varying(32) NOT NULL,
+    collsn_id integer NOT NULL,
+    count integer NOT NULL,
+    CONSTRAINT atd_location_collision_totals_pkey PRIMARY KEY (location_id, collsn_id)
+);
+
+COMMENT ON TABLE atd_location_collision_totals IS 'CR3 crashes per location and manner of collision (-1: none), see refresh_location_totals';
+
+CREATE TABLE IF NOT EXISTS atd_location_body_style_totals (
+    location_id character varying(32) NOT NULL,
+    veh_body_styl_id integer NOT NULL,
+    count integer NOT NULL,
+    CONSTRAINT atd_location_body_style_totals_pkey PRIMARY KEY (location_id, veh_body_styl_id)
+);
+
+COMMENT ON TABLE atd_location_body_style_totals IS 'CR3 units per location and vehicle body style (-1: none), see refresh_location_totals';
+
+-- The refresh and the first (partial) year of get_location_totals look up
+-- the crashes and blueforms of one location
+CREATE INDEX IF NOT EXISTS atd_txdot_crash_locations_location_id_index
+    ON atd_txdot_crash_locations USING btree (location_id);
+
+CREATE INDEX IF NOT EXISTS atd_apd_blueform_location_id_index
+    ON atd_apd_blueform USING btree (location_id);
+
+-----------------------------------------
+-- Functions
+--
+-- Location aggregates: atd_location_totals (crashes, deaths, serious
+-- injuries and costs per location and year), atd_location_collision_totals
+-- (crashes per location and manner of collision) and
+-- atd_location_body_style_totals (units per location and body style).
+--
+-- refresh_location_totals recomputes the rows of a list of locations, or of
+-- every location when the list is NULL. The statement-level triggers below
+-- call it with the locations touched by a statement, so the location views
+-- and get_location_totals read a handful of pre-aggregated rows instead of
+-- every crash of the location.
+--
+-- Concurrent refreshes of the same location are serialized with transaction
+-- advisory locks, taken in a fixed order, otherwise the DELETE of the second
+-- transaction would not see the rows inserted by the first one and its INSERT
+-- would fail with a unique violation (aborting the write that fired it). A
+-- full refresh locks the aggregate tables instead.
+--
+--   SELECT refresh_location_totals();                  -- Everything
+--   SELECT refresh_location_totals(ARRAY['ABC123']);   -- One location
+--
+CREATE OR REPLACE FUNCTION public.refresh_location_totals
+(location_ids character varying[] DEFAULT NULL)
+ RETURNS void
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+    full_refresh boolean := location_ids IS NULL;
+    lock_key integer;
+BEGIN
+    IF full_refresh THEN
+        LOCK TABLE atd_location_totals, atd_location_collision_totals, atd_location_body_style_totals
+            IN SHARE ROW EXCLUSIVE MODE;
+        DELETE FROM atd_location_totals;
+        DELETE FROM atd_location_collision_totals;
+        DELETE FROM atd_location_body_style_totals;
+        SELECT array_agg(DISTINCT ids.location_id) INTO location_ids
+        FROM (
+            SELECT location_id FROM atd_txdot_crash_locations
+            UNION
+            SELECT location_id FROM atd_apd_blueform
+        ) AS ids;
+    END IF;
+
+    location_ids := array_remove(array_remove(location_ids, NULL), 'None');
+    IF location_ids IS NULL OR cardinality(location_ids) = 0 THEN
+        RETURN;
+    END IF;
+
+    -- One lock per location, in the order of the lock keys to avoid deadlocks
+    IF NOT full_refresh THEN
+        FOR lock_key IN
+            SELECT DISTINCT hashtext(ids.location_id)
+            FROM unnest(location_ids) AS ids(location_id)
+            ORDER BY 1
+        LOOP
+            PERFORM pg_advisory_xact_lock(hashtext('refresh_location_totals'), lock_key);
+        END LOOP;
+    END IF;
+
+    DELETE FROM atd_location_totals WHERE location_id = ANY(location_ids);
+    DELETE FROM atd_location_collision_totals WHERE location_id = ANY(location_ids);
+    DELETE FROM atd_location_body_style_totals WHERE location_id = ANY(location_ids);
+
+    INSERT INTO atd_location_totals (
+        location_id, year, cr3_crashes, cr3_deaths, cr3_serious_injuries, cr3_est_comp_cost,
+        cr3_austin_crashes, cr3_austin_est_comp_cost, noncr3_crashes
+    )
+    SELECT
+        totals.location_id,
+        totals.year,
+        sum(totals.cr3_crashes),
+        sum(totals.cr3_deaths),
+        sum(totals.cr3_serious_injuries),
+        sum(totals.cr3_est_comp_cost),
+        sum(totals.cr3_austin_crashes),
+        sum(totals.cr3_austin_est_comp_cost),
+        sum(totals.noncr3_crashes)
+    FROM (
+        SELECT
+            atcloc.location_id,
+            COALESCE(date_part('year', atc.crash_date)::integer, 0) AS year,
+            1 AS cr3_crashes,
+            COALESCE(atc.apd_confirmed_death_count, 0) AS cr3_deaths,
+            COALESCE(atc.sus_serious_injry_cnt, 0) AS cr3_serious_injuries,
+            COALESCE(atc.est_comp_cost, 0) AS cr3_est_comp_cost,
+            CASE WHEN atc.city_id = 22 THEN 1 ELSE 0 END AS cr3_austin_crashes,
+            CASE WHEN atc.city_id = 22 THEN COALESCE(atc.est_comp_cost, 0) ELSE 0 END AS cr3_austin_est_comp_cost,
+            0 AS noncr3_crashes
+        FROM atd_txdot_crash_locations AS atcloc
+        JOIN atd_txdot_crashes AS atc ON (atc.crash_id = atcloc.crash_id)
+        WHERE atcloc.location_id <> 'None'
+            AND atcloc.location_id = ANY(location_ids)
+        UNION ALL
+        SELECT
+            atdbf.location_id,
+            COALESCE(date_part('year', atdbf.date)::integer, 0) AS year,
+            0, 0, 0, 0, 0, 0,
+            1 AS noncr3_crashes
+        FROM atd_apd_blueform AS atdbf
+        WHERE atdbf.location_id IS NOT NULL
+            AND atdbf.location_id <> 'None'
+            AND atdbf.location_id = ANY(location_ids)
+    ) AS totals
+    GROUP BY totals.location_id, totals.year;
+
+    INSERT INTO atd_location_collision_totals (location_id, collsn_id, count)
+    SELECT
+        atcloc.location_id,
+        COALESCE(atc.fhe_collsn_id, -1),
+        count(1)
+    FROM atd_txdot_crash_locations AS atcloc
+    JOIN atd_txdot_crashes AS atc ON (atc.crash_id = atcloc.crash_id)
+    WHERE atcloc.location_id <> 'None'
+        AND atcloc.location_id = ANY(location_ids)
+    GROUP BY atcloc.location_id, COALESCE(atc.fhe_collsn_id, -1);
+
+    INSERT INTO atd_location_body_style_totals (location_id, veh_body_styl_id, count)
+    SELECT
+        atcl.location_id,
+        COALESCE(atu.veh_body_styl_id, -1),
+        count(1)
+    FROM atd_txdot_crash_locations AS atcl
+    JOIN atd_txdot_units AS atu ON (atu.crash_id = atcl.crash_id)
+    WHERE atcl.location_id <> 'None'
+        AND atcl.location_id = ANY(location_ids)
+    GROUP BY atcl.location_id, COALESCE(atu.veh_body_styl_id, -1);
+END;
+$function$;
+
+--
+-- Statement-level triggers, one per table and event (transition tables
+-- cannot be shared by several events). Updates that do not change any
+-- aggregated column are ignored.
+--
+CREATE OR REPLACE FUNCTION public.atd_txdot_crashes_refresh_location_totals()
+ RETURNS trigger
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+    location_ids character varying[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(DISTINCT atcloc.location_id) INTO location_ids
+        FROM new_rows JOIN atd_txdot_crash_locations AS atcloc ON (atcloc.crash_id = new_rows.crash_id);
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(DISTINCT atcloc.location_id) INTO location_ids
+        FROM old_rows JOIN atd_txdot_crash_locations AS atcloc ON (atcloc.crash_id = old_rows.crash_id);
+    ELSE
+        SELECT array_agg(DISTINCT atcloc.location_id) INTO location_ids
+        FROM old_rows
+        JOIN new_rows ON (new_rows.crash_id = old_rows.crash_id)
+        JOIN atd_txdot_crash_locations AS atcloc ON (atcloc.crash_id = new_rows.crash_id)
+        WHERE (old_rows.crash_date, old_rows.city_id, old_rows.apd_confirmed_death_count,
+               old_rows.sus_serious_injry_cnt, old_rows.est_comp_cost, old_rows.fhe_collsn_id)
+            IS DISTINCT FROM
+              (new_rows.crash_date, new_rows.city_id, new_rows.apd_confirmed_death_count,
+               new_rows.sus_serious_injry_cnt, new_rows.est_comp_cost, new_rows.fhe_collsn_id);
+    END IF;
+
+    IF location_ids IS NOT NULL THEN
+        PERFORM refresh_location_totals(location_ids);
+    END IF;
+    RETURN NULL;
+END;
+$function$;
+
+CREATE OR REPLACE FUNCTION public.atd_txdot_crash_locations_refresh_location_totals()
+ RETURNS trigger
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+    location_ids character varying[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(DISTINCT location_id) INTO location_ids FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(DISTINCT location_id) INTO location_ids FROM old_rows;
+    ELSE
+        SELECT array_agg(DISTINCT changed.location_id) INTO location_ids
+        FROM (
+            SELECT old_rows.location_id FROM old_rows
+            JOIN new_rows ON (new_rows.crash_location_id = old_rows.crash_location_id)
+            WHERE (old_rows.crash_id, old_rows.location_id) IS DISTINCT FROM (new_rows.crash_id, new_rows.location_id)
+            UNION ALL
+            SELECT new_rows.location_id FROM old_rows
+            JOIN new_rows ON (new_rows.crash_location_id = old_rows.crash_location_id)
+            WHERE (old_rows.crash_id, old_rows.location_id) IS DISTINCT FROM (new_rows.crash_id, new_rows.location_id)
+        ) AS changed;
+    END IF;
+
+    IF location_ids IS NOT NULL THEN
+        PERFORM refresh_location_totals(location_ids);
+    END IF;
+    RETURN NULL;
+END;
+$function$;
+
+CREATE OR REPLACE FUNCTION public.atd_apd_blueform_refresh_location_totals()
+ RETURNS trigger
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+    location_ids character varying[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(DISTINCT location_id) INTO location_ids FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(DISTINCT location_id) INTO location_ids FROM old_rows;
+    ELSE
+        SELECT array_agg(DISTINCT changed.location_id) INTO location_ids
+        FROM (
+            SELECT old_rows.location_id FROM old_rows
+            JOIN new_rows ON (new_rows.form_id = old_rows.form_id)
+            WHERE (old_rows.location_id, old_rows.date) IS DISTINCT FROM (new_rows.location_id, new_rows.date)
+            UNION ALL
+            SELECT new_rows.location_id FROM old_rows
+            JOIN new_rows ON (new_rows.form_id = old_rows.form_id)
+            WHERE (old_rows.location_id, old_rows.date) IS DISTINCT FROM (new_rows.location_id, new_rows.date)
+        ) AS changed;
+    END IF;
+
+    IF location_ids IS NOT NULL THEN
+        PERFORM refresh_location_totals(location_ids);
+    END IF;
+    RETURN NULL;
+END;
+$function$;
+
+CREATE OR REPLACE FUNCTION public.atd_txdot_units_refresh_location_totals()
+ RETURNS trigger
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+    location_ids character varying[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(DISTINCT atcl.location_id) INTO location_ids
+        FROM new_rows JOIN atd_txdot_crash_locations AS atcl ON (atcl.crash_id = new_rows.crash_id);
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(DISTINCT atcl.location_id) INTO location_ids
+        FROM old_rows JOIN atd_txdot_crash_locations AS atcl ON (atcl.crash_id = old_rows.crash_id);
+    ELSE
+        -- Compares the (crash, body style) pairs before and after the statement,
+        -- so updates of any other unit column are ignored
+        SELECT array_agg(DISTINCT atcl.location_id) INTO location_ids
+        FROM (
+            SELECT crash_id, veh_body_styl_id FROM old_rows
+            EXCEPT ALL
+            SELECT crash_id, veh_body_styl_id FROM new_rows
+            UNION ALL
+            (SELECT crash_id, veh_body_styl_id FROM new_rows
+             EXCEPT ALL
+             SELECT crash_id, veh_body_styl_id FROM old_rows)
+        ) AS changed
+        JOIN atd_txdot_crash_locations AS atcl ON (atcl.crash_id = changed.crash_id);
+    END IF;
+
+    IF location_ids IS NOT NULL THEN
+        PERFORM refresh_location_totals(location_ids);
+    END IF;
+    RETURN NULL;
+END;
+$function$;
+
+--
+-- Reads the per-year rows of atd_location_totals (see
+-- triggers/refresh_location_totals.sql) for the years after the start date,
+-- and only counts the crashes of the first, partial year, so the cost does
+-- not depend on how many crashes the location has.
+--
+CREATE
+OR REPLACE FUNCTION public.get_location_totals(
+  cr3_crash_date date,
+  noncr3_crash_date date,
+  cr3_location character varying,
+  noncr3_location character varying,
+  cost_per_crash numeric
+) RETURNS SETOF atd_location_crash_and_cost_totals AS $$
+SELECT
+  atdl.location_id,
+  (cr3.total_crashes + noncr3.total_crashes) AS total_crashes,
+  (cr3.est_comp_cost + noncr3.est_comp_cost) AS total_est_comp_cost,
+  cr3.total_crashes AS cr3_total_crashes,
+  cr3.est_comp_cost AS cr3_est_comp_cost,
+  noncr3.total_crashes AS noncr3_total_crashes,
+  noncr3.est_comp_cost AS noncr3_est_comp_cost
+FROM
+  atd_txdot_locations AS atdl,
+  LATERAL (
+    SELECT
+      (full_years.total_crashes + first_year.total_crashes) AS total_crashes,
+      (full_years.est_comp_cost + first_year.est_comp_cost) AS est_comp_cost
+    FROM
+      (
+        SELECT
+          coalesce(sum(totals.cr3_austin_crashes), 0) AS total_crashes,
+          coalesce(sum(totals.cr3_austin_est_comp_cost), 0) AS est_comp_cost
+        FROM
+          atd_location_totals AS totals
+        WHERE
+          totals.location_id = atdl.location_id
+          AND totals.year > date_part('year', cr3_crash_date)
+      ) full_years,
+      (
+        SELECT
+          count(atdc) AS total_crashes,
+          coalesce(sum(atdc.est_comp_cost), 0) AS est_comp_cost
+        FROM
+          atd_txdot_crash_locations AS atdcl
+          JOIN atd_txdot_crashes AS atdc ON (
+            atdcl.crash_id = atdc.crash_id
+            AND atdc.city_id = 22
+            AND atdc.crash_date >= cr3_crash_date :: date
+            AND atdc.crash_date < date_trunc('year', cr3_crash_date) + interval '1 year'
+          )
+        WHERE
+          atdcl.location_id = atdl.location_id
+      ) first_year
+  ) cr3,
+  LATERAL (
+    SELECT
+      (full_years.total_crashes + first_year.total_crashes) AS total_crashes,
+      ((full_years.total_crashes + first_year.total_crashes) * cost_per_crash) AS est_comp_cost
+    FROM
+      (
+        SELECT
+          coalesce(sum(totals.noncr3_crashes), 0) AS total_crashes
+        FROM
+          atd_location_totals AS totals
+        WHERE
+          totals.location_id = atdl.location_id
+          AND totals.year > date_part('year', noncr3_crash_date)
+      ) full_years,
+      (
+        SELECT
+          count(atdbf) AS total_crashes
+        FROM
+          atd_apd_blueform AS atdbf
+        WHERE
+          atdbf.location_id = atdl.location_id
+          AND atdbf.date >= noncr3_crash_date :: date
+          AND atdbf.date < date_trunc('year', noncr3_crash_date) + interval '1 year'
+      ) first_year
+  ) noncr3
+WHERE
+  atdl.location_id = cr3_location :: text
+  AND atdl.location_id = noncr3_location :: text
+  AND atdl.location_id IS NOT NULL
+  AND atdl.location_id :: text <> 'None' :: text
+  $$ LANGUAGE sql STABLE;
+
+-----------------------------------------
+-- Triggers
+
+DROP TRIGGER IF EXISTS atd_txdot_crashes_location_totals_insert ON public.atd_txdot_crashes;
+CREATE TRIGGER atd_txdot_crashes_location_totals_insert
+    AFTER INSERT ON public.atd_txdot_crashes
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.atd_txdot_crashes_refresh_location_totals();
+
+DROP TRIGGER IF EXISTS atd_txdot_crashes_location_totals_update ON public.atd_txdot_crashes;
+CREATE TRIGGER atd_txdot_crashes_location_totals_update
+    AFTER UPDATE ON public.atd_txdot_crashes
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.atd_txdot_crashes_refresh_location_totals();
+
+DROP TRIGGER IF EXISTS atd_txdot_crashes_location_totals_delete ON public.atd_txdot_crashes;
+CREATE TRIGGER atd_txdot_crashes_location_totals_delete
+    AFTER DELETE ON public.atd_txdot_crashes
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.atd_txdot_crashes_refresh_location_totals();
+
+DROP TRIGGER IF EXISTS atd_txdot_crash_locations_location_totals_insert ON public.atd_txdot_crash_locations;
+CREATE TRIGGER atd_txdot_crash_locations_location_totals_insert
+    AFTER INSERT ON public.atd_txdot_crash_locations
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.atd_txdot_crash_locations_refresh_location_totals();
+
+DROP TRIGGER IF EXISTS atd_txdot_crash_locations_location_totals_update ON public.atd_txdot_crash_locations;
+CREATE TRIGGER atd_txdot_crash_locations_location_totals_update
+    AFTER UPDATE ON public.atd_txdot_crash_locations
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.atd_txdot_crash_locations_refresh_location_totals();
+
+DROP TRIGGER IF EXISTS atd_txdot_crash_locations_location_totals_delete ON public.atd_txdot_crash_locations;
+CREATE TRIGGER atd_txdot_crash_locations_location_totals_delete
+    AFTER DELETE ON public.atd_txdot_crash_locations
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.atd_txdot_crash_locations_refresh_location_totals();
+
+DROP TRIGGER IF EXISTS atd_apd_blueform_location_totals_insert ON public.atd_apd_blueform;
+CREATE TRIGGER atd_apd_blueform_location_totals_insert
+    AFTER INSERT ON public.atd_apd_blueform
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.atd_apd_blueform_refresh_location_totals();
+
+DROP TRIGGER IF EXISTS atd_apd_blueform_location_totals_update ON public.atd_apd_blueform;
+CREATE TRIGGER atd_apd_blueform_location_totals_update
+    AFTER UPDATE ON public.atd_apd_blueform
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.atd_apd_blueform_refresh_location_totals();
+
+DROP TRIGGER IF EXISTS atd_apd_blueform_location_totals_delete ON public.atd_apd_blueform;
+CREATE TRIGGER atd_apd_blueform_location_totals_delete
+    AFTER DELETE ON public.atd_apd_blueform
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.atd_apd_blueform_refresh_location_totals();
+
+DROP TRIGGER IF EXISTS atd_txdot_units_location_totals_insert ON public.atd_txdot_units;
+CREATE TRIGGER atd_txdot_units_location_totals_insert
+    AFTER INSERT ON public.atd_txdot_units
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.atd_txdot_units_refresh_location_totals();
+
+DROP TRIGGER IF EXISTS atd_txdot_units_location_totals_update ON public.atd_txdot_units;
+CREATE TRIGGER atd_txdot_units_location_totals_update
+    AFTER UPDATE ON public.atd_txdot_units
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.atd_txdot_units_refresh_location_totals();
+
+DROP TRIGGER IF EXISTS atd_txdot_units_location_totals_delete ON public.atd_txdot_units;
+CREATE TRIGGER atd_txdot_units_location_totals_delete
+    AFTER DELETE ON public.atd_txdot_units
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.atd_txdot_units_refresh_location_totals();
+
+-----------------------------------------
+-- Views, same columns as before
+
+CREATE OR REPLACE VIEW public.view_location_injry_count_cost_summary AS
+SELECT atcloc.location_id
+        , coalesce(sum(totals.cr3_crashes), 0) AS total_crashes
+        , coalesce(sum(totals.cr3_deaths), 0) AS total_deaths
+        , coalesce(sum(totals.cr3_serious_injuries), 0) AS total_serious_injuries
+        , coalesce(sum(totals.cr3_est_comp_cost), 0) AS est_comp_cost
+
+        FROM
+             atd_txdot_locations AS atcloc
+        LEFT JOIN atd_location_totals AS totals ON (totals.location_id = atcloc.location_id)
+        GROUP BY atcloc.location_id;
+
+CREATE OR REPLACE VIEW public.view_location_crashes_by_manner_collision AS
+ SELECT totals.location_id,
+    atcol.collsn_desc,
+    sum(totals.count) AS count
+   FROM (public.atd_location_collision_totals totals
+     LEFT JOIN public.atd_txdot__collsn_lkp atcol ON ((atcol.collsn_id = totals.collsn_id)))
+  GROUP BY totals.location_id, atcol.collsn_desc;
+
+CREATE OR REPLACE VIEW public.view_location_crashes_by_veh_body_style AS
+ SELECT totals.location_id,
+    atvbsl.veh_body_styl_desc,
+    sum(totals.count) AS count
+   FROM (public.atd_location_body_style_totals totals
+     LEFT JOIN public.atd_txdot__veh_body_styl_lkp atvbsl ON ((atvbsl.veh_body_styl_id = totals.veh_body_styl_id)))
+  GROUP BY totals.location_id, atvbsl.veh_body_styl_desc;
+
+-----------------------------------------
+-- Initial load, the triggers keep the tables current afterwards
+
+SELECT refresh_location_totals();
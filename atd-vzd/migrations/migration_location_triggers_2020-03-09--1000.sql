@@ -0,0 +1,266 @@
+-----------------------------------------
+-- Incremental location maintenance
+--
+-- The atd_txdot_locations_updates_crash_locations trigger re-ran
+-- search_atd_location_crashes for the whole location on every update, and
+-- keeping crashes and locations in sync otherwise took a full sweep of every
+-- location. These triggers only re-evaluate what changed:
+--
+-- - A location shape is added, removed or edited: the crashes and blueforms
+--   inside the symmetric difference of the old and new shapes.
+-- - The coordinates of a crash (latitude_primary, longitude_primary) or a
+--   blueform (latitude, longitude) change: only that record.
+--
+-- Requires the point indexes of migration_collision_points_2020-03-06--1100.sql.
+-- Function definitions: triggers/update_collision_locations.sql,
+-- triggers/atd_txdot_locations_updates_crash_locations.sql,
+-- triggers/atd_txdot_crashes_updates_location.sql and
+-- triggers/atd_apd_blueform_updates_location.sql
+
+--
+-- Helpers of the incremental location triggers
+-- (atd_txdot_locations_updates_crash_locations, atd_txdot_crashes_updates_location
+-- and atd_apd_blueform_updates_location).
+--
+-- find_location_for_point returns the location whose polygon contains a
+-- point; when the point falls inside more than one polygon the lowest
+-- location_id wins, as in assign_cr3_collision_locations.
+--
+-- update_collision_locations_in_area re-evaluates only the crashes and
+-- blueforms whose point falls inside an area (ie. the symmetric difference of
+-- the old and new shape of a location). The bounding-box prefilter (&&) uses
+-- the expression indexes atd_txdot_crashes_point_primary_gist and
+-- atd_apd_blueform_point_gist, so the cost is proportional to the number of
+-- points in the area, not to the size of the tables.
+--
+--   SELECT update_collision_locations_in_area(shape) FROM atd_txdot_locations WHERE location_id = '...';
+--
+CREATE OR REPLACE FUNCTION public.find_location_for_point
+(point geometry)
+ RETURNS character varying
+ LANGUAGE sql
+ STABLE
+AS $function$
+SELECT
+  atd_loc.location_id
+FROM
+  atd_txdot_locations AS atd_loc
+WHERE
+  atd_loc.shape && point
+  AND ST_Contains(atd_loc.shape, point)
+ORDER BY atd_loc.location_id
+LIMIT 1
+$function$;
+
+CREATE OR REPLACE FUNCTION public.update_collision_locations_in_area
+(area geometry)
+ RETURNS integer
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+    cr3_rows integer;
+    noncr3_rows integer;
+BEGIN
+    IF area IS NULL OR ST_IsEmpty(area) THEN
+        RETURN 0;
+    END IF;
+
+    WITH matches AS (
+        SELECT
+            crash.crash_id,
+            find_location_for_point(ST_SetSRID(ST_MakePoint(crash.longitude_primary, crash.latitude_primary), 4326)) AS location_id
+        FROM atd_txdot_crashes AS crash
+        WHERE crash.latitude_primary IS NOT NULL
+            AND crash.longitude_primary IS NOT NULL
+            AND ST_SetSRID(ST_MakePoint(crash.longitude_primary, crash.latitude_primary), 4326) && area
+            AND ST_Intersects(area, ST_SetSRID(ST_MakePoint(crash.longitude_primary, crash.latitude_primary), 4326))
+    ), updated AS (
+        UPDATE atd_txdot_crashes AS cr3_crash
+        SET location_id = matches.location_id
+        FROM matches
+        WHERE cr3_crash.crash_id = matches.crash_id
+            AND cr3_crash.location_id IS DISTINCT FROM matches.location_id
+        RETURNING cr3_crash.crash_id, cr3_crash.location_id
+    ), unlinked AS (
+        -- Keep the crash/location links in sync: crashes left without a
+        -- location lose their link, the others are moved or linked
+        DELETE FROM atd_txdot_crash_locations AS crash_loc
+        USING updated
+        WHERE crash_loc.crash_id = updated.crash_id
+            AND updated.location_id IS NULL
+        RETURNING crash_loc.crash_id
+    ), relinked AS (
+        UPDATE atd_txdot_crash_locations AS crash_loc
+        SET location_id = updated.location_id,
+            last_update = now()
+        FROM updated
+        WHERE crash_loc.crash_id = updated.crash_id
+            AND updated.location_id IS NOT NULL
+        RETURNING crash_loc.crash_id
+    ), linked AS (
+        INSERT INTO atd_txdot_crash_locations (crash_id, location_id)
+        SELECT updated.crash_id, updated.location_id
+        FROM updated
+        WHERE updated.location_id IS NOT NULL
+            AND NOT EXISTS (
+                SELECT 1 FROM atd_txdot_crash_locations AS crash_loc
+                WHERE crash_loc.crash_id = updated.crash_id
+            )
+        RETURNING crash_id
+    )
+    SELECT count(*) INTO cr3_rows FROM updated;
+
+    UPDATE atd_apd_blueform AS blueform
+    SET location_id = matches.location_id
+    FROM (
+        SELECT
+            form.form_id,
+            find_location_for_point(ST_SetSRID(ST_MakePoint(form.longitude, form.latitude), 4326)) AS location_id
+        FROM atd_apd_blueform AS form
+        WHERE form.latitude IS NOT NULL
+            AND form.longitude IS NOT NULL
+            AND ST_SetSRID(ST_MakePoint(form.longitude, form.latitude), 4326) && area
+            AND ST_Intersects(area, ST_SetSRID(ST_MakePoint(form.longitude, form.latitude), 4326))
+    ) AS matches
+    WHERE blueform.form_id = matches.form_id
+        AND blueform.location_id IS DISTINCT FROM matches.location_id;
+
+    GET DIAGNOSTICS noncr3_rows = ROW_COUNT;
+    RETURN cr3_rows + noncr3_rows;
+END;
+$function$;
+
+--
+-- When a location is added, removed or its shape changes, only the
+-- collisions inside the area that changed are re-evaluated: the symmetric
+-- difference of the old and new shapes. Points inside both shapes keep
+-- their location, so editing one intersection polygon touches tens of rows.
+--
+create or replace function atd_txdot_locations_updates_crash_locations() returns trigger
+    language plpgsql
+as
+$$
+DECLARE
+    changed_area geometry;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        changed_area := NEW.shape;
+    ELSIF TG_OP = 'DELETE' THEN
+        changed_area := OLD.shape;
+    ELSIF ST_AsEWKB(OLD.shape) IS NOT DISTINCT FROM ST_AsEWKB(NEW.shape) THEN
+        RETURN NULL;
+    ELSIF OLD.shape IS NULL OR NEW.shape IS NULL THEN
+        changed_area := COALESCE(OLD.shape, NEW.shape);
+    ELSE
+        changed_area := ST_SymDifference(OLD.shape, NEW.shape);
+    END IF;
+
+    PERFORM update_collision_locations_in_area(changed_area);
+
+    RETURN NULL;
+END;
+$$;
+
+alter function atd_txdot_locations_updates_crash_locations() owner to atd_vz_data;
+
+--
+-- When the coordinates of a crash change, only that crash is re-joined
+-- to the locations. Crashes that lose their coordinates lose their location.
+-- The crash/location link in atd_txdot_crash_locations follows: it is
+-- removed when the crash has no location, created when it has none yet.
+--
+create or replace function atd_txdot_crashes_updates_location() returns trigger
+    language plpgsql
+as
+$$
+BEGIN
+    IF TG_OP = 'UPDATE'
+        AND OLD.latitude_primary IS NOT DISTINCT FROM NEW.latitude_primary
+        AND OLD.longitude_primary IS NOT DISTINCT FROM NEW.longitude_primary THEN
+        RETURN NEW;
+    END IF;
+
+    IF NEW.latitude_primary IS NULL OR NEW.longitude_primary IS NULL THEN
+        IF TG_OP = 'INSERT' THEN
+            RETURN NEW;
+        END IF;
+        NEW.location_id := NULL;
+    ELSE
+        NEW.location_id := find_location_for_point(ST_SetSRID(ST_MakePoint(NEW.longitude_primary, NEW.latitude_primary), 4326));
+    END IF;
+
+    -- Keep the crash/location links in sync
+    IF NEW.location_id IS NULL THEN
+        DELETE FROM atd_txdot_crash_locations
+        WHERE crash_id = NEW.crash_id;
+    ELSE
+        UPDATE atd_txdot_crash_locations
+            SET location_id = NEW.location_id,
+                last_update = now()
+        WHERE crash_id = NEW.crash_id
+            AND location_id IS DISTINCT FROM NEW.location_id;
+
+        INSERT INTO atd_txdot_crash_locations (crash_id, location_id)
+        SELECT NEW.crash_id, NEW.location_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM atd_txdot_crash_locations
+            WHERE crash_id = NEW.crash_id
+        );
+    END IF;
+
+    RETURN NEW;
+END;
+$$;
+
+alter function atd_txdot_crashes_updates_location() owner to atd_vz_data;
+
+--
+-- When the coordinates of a blueform (non-CR3) change, only that
+-- blueform is re-joined to the locations.
+--
+create or replace function atd_apd_blueform_updates_location() returns trigger
+    language plpgsql
+as
+$$
+BEGIN
+    IF TG_OP = 'UPDATE'
+        AND OLD.latitude IS NOT DISTINCT FROM NEW.latitude
+        AND OLD.longitude IS NOT DISTINCT FROM NEW.longitude THEN
+        RETURN NEW;
+    END IF;
+
+    IF NEW.latitude IS NULL OR NEW.longitude IS NULL THEN
+        IF TG_OP = 'UPDATE' THEN
+            NEW.location_id := NULL;
+        END IF;
+        RETURN NEW;
+    END IF;
+
+    NEW.location_id := find_location_for_point(ST_SetSRID(ST_MakePoint(NEW.longitude, NEW.latitude), 4326));
+
+    RETURN NEW;
+END;
+$$;
+
+alter function atd_apd_blueform_updates_location() owner to atd_vz_data;
+
+-----------------------------------------
+-- Triggers
+
+DROP TRIGGER IF EXISTS atd_txdot_locations_updates_crash_locations ON public.atd_txdot_locations;
+
+CREATE TRIGGER atd_txdot_locations_updates_crash_locations
+    AFTER INSERT OR DELETE OR UPDATE OF shape ON public.atd_txdot_locations
+    FOR EACH ROW EXECUTE PROCEDURE public.atd_txdot_locations_updates_crash_locations();
+
+DROP TRIGGER IF EXISTS atd_txdot_crashes_updates_location ON public.atd_txdot_crashes;
+
+CREATE TRIGGER atd_txdot_crashes_updates_location
+    BEFORE INSERT OR UPDATE OF latitude_primary, longitude_primary ON public.atd_txdot_crashes
+    FOR EACH ROW EXECUTE PROCEDURE public.atd_txdot_crashes_updates_location();
+
+DROP TRIGGER IF EXISTS atd_apd_blueform_updates_location ON public.atd_apd_blueform;
+
+CREATE TRIGGER atd_apd_blueform_updates_location
+    BEFORE INSERT OR UPDATE OF latitude, longitude ON public.atd_apd_blueform
+    FOR EACH ROW EXECUTE PROCEDURE public.atd_apd_blueform_updates_location();
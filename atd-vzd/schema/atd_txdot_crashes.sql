@@ -294,6 +294,13 @@ CREATE TRIGGER atd_txdot_crashes_audit_log BEFORE INSERT OR UPDATE ON public.atd
 ALTER TABLE public.atd_txdot_crashes DISABLE TRIGGER atd_txdot_crashes_audit_log;
 
 
+--
+-- Name: atd_txdot_crashes atd_txdot_crashes_updates_location; Type: TRIGGER; Schema: public; Owner: atd_vz_data
+--
+
+CREATE TRIGGER atd_txdot_crashes_updates_location BEFORE INSERT OR UPDATE OF latitude_primary, longitude_primary ON public.atd_txdot_crashes FOR EACH ROW EXECUTE PROCEDURE public.atd_txdot_crashes_updates_location();
+
+
 -- Completed on 2019-10-15 13:48:26 CDT
 
 --
@@ -97,9 +97,7 @@ ALTER TABLE public.atd_txdot_locations DISABLE TRIGGER atd_txdot_location_audit_
 -- Name: atd_txdot_locations atd_txdot_locations_updates_crash_locations; Type: TRIGGER; Schema: public; Owner: atd_vz_data
 --
 
-CREATE TRIGGER atd_txdot_locations_updates_crash_locations BEFORE UPDATE ON public.atd_txdot_locations FOR EACH ROW EXECUTE PROCEDURE public.atd_txdot_locations_updates_crash_locations();
-
-ALTER TABLE public.atd_txdot_locations DISABLE TRIGGER atd_txdot_locations_updates_crash_locations;
+CREATE TRIGGER atd_txdot_locations_updates_crash_locations AFTER INSERT OR DELETE OR UPDATE OF shape ON public.atd_txdot_locations FOR EACH ROW EXECUTE PROCEDURE public.atd_txdot_locations_updates_crash_locations();
 
 
 -- Completed on 2019-10-15 13:48:20 CDT
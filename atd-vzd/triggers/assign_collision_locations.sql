@@ -0,0 +1,72 @@
+--
+-- Assigns a location to every crash (CR3) and blueform (non-CR3) record whose
+-- point falls inside a location polygon, in one UPDATE per table. The join
+-- uses the GIST index on atd_txdot_locations.shape, so a full sweep takes
+-- one statement instead of one query per location and one mutation per crash.
+--
+-- When a point falls inside more than one polygon, the lowest location_id wins.
+-- By default only records without a location are updated; pass false to
+-- re-evaluate every record.
+--
+--   SELECT assign_cr3_collision_locations();
+--   SELECT assign_noncr3_collision_locations(false);
+--
+CREATE OR REPLACE FUNCTION public.assign_cr3_collision_locations
+(only_unassigned boolean DEFAULT true)
+ RETURNS integer
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+    updated_rows integer;
+BEGIN
+    UPDATE atd_txdot_crashes AS cr3_crash
+    SET location_id = matches.location_id
+    FROM (
+        SELECT DISTINCT ON (crash.crash_id)
+            crash.crash_id,
+            atd_loc.location_id
+        FROM atd_txdot_crashes AS crash
+        JOIN atd_txdot_locations AS atd_loc
+            ON ST_Contains(atd_loc.shape, ST_SetSRID(ST_MakePoint(crash.longitude_primary, crash.latitude_primary), 4326))
+        WHERE crash.latitude_primary IS NOT NULL
+            AND crash.longitude_primary IS NOT NULL
+            AND (NOT only_unassigned OR crash.location_id IS NULL OR crash.location_id = 'None')
+        ORDER BY crash.crash_id, atd_loc.location_id
+    ) AS matches
+    WHERE cr3_crash.crash_id = matches.crash_id
+        AND cr3_crash.location_id IS DISTINCT FROM matches.location_id;
+
+    GET DIAGNOSTICS updated_rows = ROW_COUNT;
+    RETURN updated_rows;
+END;
+$function$;
+
+CREATE OR REPLACE FUNCTION public.assign_noncr3_collision_locations
+(only_unassigned boolean DEFAULT true)
+ RETURNS integer
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+    updated_rows integer;
+BEGIN
+    UPDATE atd_apd_blueform AS blueform
+    SET location_id = matches.location_id
+    FROM (
+        SELECT DISTINCT ON (form.form_id)
+            form.form_id,
+            atd_loc.location_id
+        FROM atd_apd_blueform AS form
+        JOIN atd_txdot_locations AS atd_loc
+            ON ST_Contains(atd_loc.shape, ST_SetSRID(ST_MakePoint(form.longitude, form.latitude), 4326))
+        WHERE form.latitude IS NOT NULL
+            AND form.longitude IS NOT NULL
+            AND (NOT only_unassigned OR form.location_id IS NULL OR form.location_id = 'None')
+        ORDER BY form.form_id, atd_loc.location_id
+    ) AS matches
+    WHERE blueform.form_id = matches.form_id
+        AND blueform.location_id IS DISTINCT FROM matches.location_id;
+
+    GET DIAGNOSTICS updated_rows = ROW_COUNT;
+    RETURN updated_rows;
+END;
+$function$;
@@ -0,0 +1,29 @@
+--
+-- When the coordinates of a blueform (non-CR3) change, only that
+-- blueform is re-joined to the locations.
+--
+create or replace function atd_apd_blueform_updates_location() returns trigger
+    language plpgsql
+as
+$$
+BEGIN
+    IF TG_OP = 'UPDATE'
+        AND OLD.latitude IS NOT DISTINCT FROM NEW.latitude
+        AND OLD.longitude IS NOT DISTINCT FROM NEW.longitude THEN
+        RETURN NEW;
+    END IF;
+
+    IF NEW.latitude IS NULL OR NEW.longitude IS NULL THEN
+        IF TG_OP = 'UPDATE' THEN
+            NEW.location_id := NULL;
+        END IF;
+        RETURN NEW;
+    END IF;
+
+    NEW.location_id := find_location_for_point(ST_SetSRID(ST_MakePoint(NEW.longitude, NEW.latitude), 4326));
+
+    RETURN NEW;
+END;
+$$;
+
+alter function atd_apd_blueform_updates_location() owner to atd_vz_data;
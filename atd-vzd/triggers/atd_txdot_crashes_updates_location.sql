@@ -0,0 +1,50 @@
+--
+-- When the coordinates of a crash change, only that crash is re-joined
+-- to the locations. Crashes that lose their coordinates lose their location.
+-- The crash/location link in atd_txdot_crash_locations follows: it is
+-- removed when the crash has no location, created when it has none yet.
+--
+create or replace function atd_txdot_crashes_updates_location() returns trigger
+    language plpgsql
+as
+$$
+BEGIN
+    IF TG_OP = 'UPDATE'
+        AND OLD.latitude_primary IS NOT DISTINCT FROM NEW.latitude_primary
+        AND OLD.longitude_primary IS NOT DISTINCT FROM NEW.longitude_primary THEN
+        RETURN NEW;
+    END IF;
+
+    IF NEW.latitude_primary IS NULL OR NEW.longitude_primary IS NULL THEN
+        IF TG_OP = 'INSERT' THEN
+            RETURN NEW;
+        END IF;
+        NEW.location_id := NULL;
+    ELSE
+        NEW.location_id := find_location_for_point(ST_SetSRID(ST_MakePoint(NEW.longitude_primary, NEW.latitude_primary), 4326));
+    END IF;
+
+    -- Keep the crash/location links in sync
+    IF NEW.location_id IS NULL THEN
+        DELETE FROM atd_txdot_crash_locations
+        WHERE crash_id = NEW.crash_id;
+    ELSE
+        UPDATE atd_txdot_crash_locations
+            SET location_id = NEW.location_id,
+                last_update = now()
+        WHERE crash_id = NEW.crash_id
+            AND location_id IS DISTINCT FROM NEW.location_id;
+
+        INSERT INTO atd_txdot_crash_locations (crash_id, location_id)
+        SELECT NEW.crash_id, NEW.location_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM atd_txdot_crash_locations
+            WHERE crash_id = NEW.crash_id
+        );
+    END IF;
+
+    RETURN NEW;
+END;
+$$;
+
+alter function atd_txdot_crashes_updates_location() owner to atd_vz_data;
@@ -1,15 +1,32 @@
-create function atd_txdot_locations_updates_crash_locations() returns trigger
+--
+-- When a location is added, removed or its shape changes, only the
+-- collisions inside the area that changed are re-evaluated: the symmetric
+-- difference of the old and new shapes. Points inside both shapes keep
+-- their location, so editing one intersection polygon touches tens of rows.
+--
+create or replace function atd_txdot_locations_updates_crash_locations() returns trigger
     language plpgsql
 as
 $$
+DECLARE
+    changed_area geometry;
 BEGIN
-    UPDATE atd_txdot_crash_locations
-        SET location_id = NEW.location_id
-    WHERE crash_id IN (SELECT crash_id FROM search_atd_location_crashes(NEW.location_id));
+    IF TG_OP = 'INSERT' THEN
+        changed_area := NEW.shape;
+    ELSIF TG_OP = 'DELETE' THEN
+        changed_area := OLD.shape;
+    ELSIF ST_AsEWKB(OLD.shape) IS NOT DISTINCT FROM ST_AsEWKB(NEW.shape) THEN
+        RETURN NULL;
+    ELSIF OLD.shape IS NULL OR NEW.shape IS NULL THEN
+        changed_area := COALESCE(OLD.shape, NEW.shape);
+    ELSE
+        changed_area := ST_SymDifference(OLD.shape, NEW.shape);
+    END IF;
 
-    RETURN NEW;
+    PERFORM update_collision_locations_in_area(changed_area);
+
+    RETURN NULL;
 END;
 $$;
 
 alter function atd_txdot_locations_updates_crash_locations() owner to atd_vz_data;
-
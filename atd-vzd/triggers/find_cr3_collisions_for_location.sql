@@ -5,14 +5,14 @@ CREATE OR REPLACE FUNCTION public.find_cr3_collisions_for_location
  STABLE
 AS $function$
 SELECT
-  *
+  cr3_crash.*
 FROM
-  atd_txdot_crashes AS cr3_crash
+  atd_txdot_locations AS atd_loc
+  JOIN atd_txdot_crashes AS cr3_crash
+    ON atd_loc.shape && ST_SetSRID(ST_MakePoint(cr3_crash.longitude_primary, cr3_crash.latitude_primary), 4326)
+    AND ST_Contains(atd_loc.shape, ST_SetSRID(ST_MakePoint(cr3_crash.longitude_primary, cr3_crash.latitude_primary), 4326))
 WHERE
-	ST_Contains((
-		SELECT
-  atd_loc.shape
-FROM atd_txdot_locations AS atd_loc
-WHERE
-			atd_loc.location_id::VARCHAR=id), ST_SetSRID(ST_MakePoint(cr3_crash.longitude_primary, cr3_crash.latitude_primary), 4326))
+  atd_loc.location_id = id
+  AND cr3_crash.latitude_primary IS NOT NULL
+  AND cr3_crash.longitude_primary IS NOT NULL
 $function$
@@ -5,14 +5,14 @@ CREATE OR REPLACE FUNCTION public.find_noncr3_collisions_for_location
  STABLE
 AS $function$
 SELECT
-  *
+  blueform.*
 FROM
-  atd_apd_blueform AS blueform
+  atd_txdot_locations AS atd_loc
+  JOIN atd_apd_blueform AS blueform
+    ON atd_loc.shape && ST_SetSRID(ST_MakePoint(blueform.longitude, blueform.latitude), 4326)
+    AND ST_Contains(atd_loc.shape, ST_SetSRID(ST_MakePoint(blueform.longitude, blueform.latitude), 4326))
 WHERE
-	ST_Contains((
-		SELECT
-  atd_loc.shape
-FROM atd_txdot_locations AS atd_loc
-WHERE
-			atd_loc.location_id::VARCHAR=id), ST_SetSRID(ST_MakePoint (blueform.longitude, blueform.latitude), 4326))
+  atd_loc.location_id = id
+  AND blueform.latitude IS NOT NULL
+  AND blueform.longitude IS NOT NULL
 $function$
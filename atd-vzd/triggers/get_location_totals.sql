@@ -1,3 +1,9 @@
+--
+-- Reads the per-year rows of atd_location_totals (see
+-- triggers/refresh_location_totals.sql) for the years after the start date,
+-- and only counts the crashes of the first, partial year, so the cost does
+-- not depend on how many crashes the location has.
+--
 CREATE
 OR REPLACE FUNCTION public.get_location_totals(
   cr3_crash_date date,
@@ -7,7 +13,7 @@ OR REPLACE FUNCTION public.get_location_totals(
   cost_per_crash numeric
 ) RETURNS SETOF atd_location_crash_and_cost_totals AS $$
 SELECT
-  cr3.location_id,
+  atdl.location_id,
   (cr3.total_crashes + noncr3.total_crashes) AS total_crashes,
   (cr3.est_comp_cost + noncr3.est_comp_cost) AS total_est_comp_cost,
   cr3.total_crashes AS cr3_total_crashes,
@@ -15,42 +21,66 @@ SELECT
   noncr3.total_crashes AS noncr3_total_crashes,
   noncr3.est_comp_cost AS noncr3_est_comp_cost
 FROM
-  (
+  atd_txdot_locations AS atdl,
+  LATERAL (
     SELECT
-      atdcl.location_id AS location_id,
-      count(atdc) AS total_crashes,
-      coalesce(sum(atdc.est_comp_cost), 0) AS est_comp_cost
+      (full_years.total_crashes + first_year.total_crashes) AS total_crashes,
+      (full_years.est_comp_cost + first_year.est_comp_cost) AS est_comp_cost
     FROM
-      atd_txdot_locations AS atdl
-      LEFT JOIN atd_txdot_crash_locations AS atdcl ON (atdcl.location_id = atdl.location_id)
-      LEFT JOIN atd_txdot_crashes AS atdc ON (
-        atdcl.crash_id = atdc.crash_id
-        AND atdc.city_id = 22
-        AND atdc.crash_date >= cr3_crash_date :: date
-      )
-    WHERE
-      atdl.location_id = cr3_location :: text
-      AND atdl.location_id IS NOT NULL
-      AND atdl.location_id :: text <> 'None' :: text
-    GROUP BY
-      atdcl.location_id
-  ) cr3
-  JOIN (
+      (
+        SELECT
+          coalesce(sum(totals.cr3_austin_crashes), 0) AS total_crashes,
+          coalesce(sum(totals.cr3_austin_est_comp_cost), 0) AS est_comp_cost
+        FROM
+          atd_location_totals AS totals
+        WHERE
+          totals.location_id = atdl.location_id
+          AND totals.year > date_part('year', cr3_crash_date)
+      ) full_years,
+      (
+        SELECT
+          count(atdc) AS total_crashes,
+          coalesce(sum(atdc.est_comp_cost), 0) AS est_comp_cost
+        FROM
+          atd_txdot_crash_locations AS atdcl
+          JOIN atd_txdot_crashes AS atdc ON (
+            atdcl.crash_id = atdc.crash_id
+            AND atdc.city_id = 22
+            AND atdc.crash_date >= cr3_crash_date :: date
+            AND atdc.crash_date < date_trunc('year', cr3_crash_date) + interval '1 year'
+          )
+        WHERE
+          atdcl.location_id = atdl.location_id
+      ) first_year
+  ) cr3,
+  LATERAL (
     SELECT
-      atdl.location_id AS location_id,
-      count(atdbf) AS total_crashes,
-      coalesce((count(1) * cost_per_crash), 0) AS est_comp_cost
+      (full_years.total_crashes + first_year.total_crashes) AS total_crashes,
+      ((full_years.total_crashes + first_year.total_crashes) * cost_per_crash) AS est_comp_cost
     FROM
-      atd_txdot_locations AS atdl
-      LEFT JOIN atd_apd_blueform AS atdbf ON (
-        atdl.location_id = atdbf.location_id
-        AND atdbf.date >= noncr3_crash_date :: date
-      )
-    WHERE
-      atdl.location_id IS NOT NULL
-      AND atdl.location_id :: text <> 'None' :: text
-      AND atdl.location_id = noncr3_location :: text
-    GROUP BY
-      atdl.location_id
-  ) noncr3 on cr3.location_id = noncr3.location_id
-  $$ LANGUAGE sql STABLE;
\ No newline at end of file
+      (
+        SELECT
+          coalesce(sum(totals.noncr3_crashes), 0) AS total_crashes
+        FROM
+          atd_location_totals AS totals
+        WHERE
+          totals.location_id = atdl.location_id
+          AND totals.year > date_part('year', noncr3_crash_date)
+      ) full_years,
+      (
+        SELECT
+          count(atdbf) AS total_crashes
+        FROM
+          atd_apd_blueform AS atdbf
+        WHERE
+          atdbf.location_id = atdl.location_id
+          AND atdbf.date >= noncr3_crash_date :: date
+          AND atdbf.date < date_trunc('year', noncr3_crash_date) + interval '1 year'
+      ) first_year
+  ) noncr3
+WHERE
+  atdl.location_id = cr3_location :: text
+  AND atdl.location_id = noncr3_location :: text
+  AND atdl.location_id IS NOT NULL
+  AND atdl.location_id :: text <> 'None' :: text
+  $$ LANGUAGE sql STABLE;
@@ -0,0 +1,264 @@
+--
+-- Location aggregates: atd_location_totals (crashes, deaths, serious
+-- injuries and costs per location and year), atd_location_collision_totals
+-- (crashes per location and manner of collision) and
+-- atd_location_body_style_totals (units per location and body style).
+--
+-- refresh_location_totals recomputes the rows of a list of locations, or of
+-- every location when the list is NULL. The statement-level triggers below
+-- call it with the locations touched by a statement, so the location views
+-- and get_location_totals read a handful of pre-aggregated rows instead of
+-- every crash of the location.
+--
+-- Concurrent refreshes of the same location are serialized with transaction
+-- advisory locks, taken in a fixed order, otherwise the DELETE of the second
+-- transaction would not see the rows inserted by the first one and its INSERT
+-- would fail with a unique violation (aborting the write that fired it). A
+-- full refresh locks the aggregate tables instead.
+--
+--   SELECT refresh_location_totals();                  -- Everything
+--   SELECT refresh_location_totals(ARRAY['ABC123']);   -- One location
+--
+CREATE OR REPLACE FUNCTION public.refresh_location_totals
+(location_ids character varying[] DEFAULT NULL)
+ RETURNS void
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+    full_refresh boolean := location_ids IS NULL;
+    lock_key integer;
+BEGIN
+    IF full_refresh THEN
+        LOCK TABLE atd_location_totals, atd_location_collision_totals, atd_location_body_style_totals
+            IN SHARE ROW EXCLUSIVE MODE;
+        DELETE FROM atd_location_totals;
+        DELETE FROM atd_location_collision_totals;
+        DELETE FROM atd_location_body_style_totals;
+        SELECT array_agg(DISTINCT ids.location_id) INTO location_ids
+        FROM (
+            SELECT location_id FROM atd_txdot_crash_locations
+            UNION
+            SELECT location_id FROM atd_apd_blueform
+        ) AS ids;
+    END IF;
+
+    location_ids := array_remove(array_remove(location_ids, NULL), 'None');
+    IF location_ids IS NULL OR cardinality(location_ids) = 0 THEN
+        RETURN;
+    END IF;
+
+    -- One lock per location, in the order of the lock keys to avoid deadlocks
+    IF NOT full_refresh THEN
+        FOR lock_key IN
+            SELECT DISTINCT hashtext(ids.location_id)
+            FROM unnest(location_ids) AS ids(location_id)
+            ORDER BY 1
+        LOOP
+            PERFORM pg_advisory_xact_lock(hashtext('refresh_location_totals'), lock_key);
+        END LOOP;
+    END IF;
+
+    DELETE FROM atd_location_totals WHERE location_id = ANY(location_ids);
+    DELETE FROM atd_location_collision_totals WHERE location_id = ANY(location_ids);
+    DELETE FROM atd_location_body_style_totals WHERE location_id = ANY(location_ids);
+
+    INSERT INTO atd_location_totals (
+        location_id, year, cr3_crashes, cr3_deaths, cr3_serious_injuries, cr3_est_comp_cost,
+        cr3_austin_crashes, cr3_austin_est_comp_cost, noncr3_crashes
+    )
+    SELECT
+        totals.location_id,
+        totals.year,
+        sum(totals.cr3_crashes),
+        sum(totals.cr3_deaths),
+        sum(totals.cr3_serious_injuries),
+        sum(totals.cr3_est_comp_cost),
+        sum(totals.cr3_austin_crashes),
+        sum(totals.cr3_austin_est_comp_cost),
+        sum(totals.noncr3_crashes)
+    FROM (
+        SELECT
+            atcloc.location_id,
+            COALESCE(date_part('year', atc.crash_date)::integer, 0) AS year,
+            1 AS cr3_crashes,
+            COALESCE(atc.apd_confirmed_death_count, 0) AS cr3_deaths,
+            COALESCE(atc.sus_serious_injry_cnt, 0) AS cr3_serious_injuries,
+            COALESCE(atc.est_comp_cost, 0) AS cr3_est_comp_cost,
+            CASE WHEN atc.city_id = 22 THEN 1 ELSE 0 END AS cr3_austin_crashes,
+            CASE WHEN atc.city_id = 22 THEN COALESCE(atc.est_comp_cost, 0) ELSE 0 END AS cr3_austin_est_comp_cost,
+            0 AS noncr3_crashes
+        FROM atd_txdot_crash_locations AS atcloc
+        JOIN atd_txdot_crashes AS atc ON (atc.crash_id = atcloc.crash_id)
+        WHERE atcloc.location_id <> 'None'
+            AND atcloc.location_id = ANY(location_ids)
+        UNION ALL
+        SELECT
+            atdbf.location_id,
+            COALESCE(date_part('year', atdbf.date)::integer, 0) AS year,
+            0, 0, 0, 0, 0, 0,
+            1 AS noncr3_crashes
+        FROM atd_apd_blueform AS atdbf
+        WHERE atdbf.location_id IS NOT NULL
+            AND atdbf.location_id <> 'None'
+            AND atdbf.location_id = ANY(location_ids)
+    ) AS totals
+    GROUP BY totals.location_id, totals.year;
+
+    INSERT INTO atd_location_collision_totals (location_id, collsn_id, count)
+    SELECT
+        atcloc.location_id,
+        COALESCE(atc.fhe_collsn_id, -1),
+        count(1)
+    FROM atd_txdot_crash_locations AS atcloc
+    JOIN atd_txdot_crashes AS atc ON (atc.crash_id = atcloc.crash_id)
+    WHERE atcloc.location_id <> 'None'
+        AND atcloc.location_id = ANY(location_ids)
+    GROUP BY atcloc.location_id, COALESCE(atc.fhe_collsn_id, -1);
+
+    INSERT INTO atd_location_body_style_totals (location_id, veh_body_styl_id, count)
+    SELECT
+        atcl.location_id,
+        COALESCE(atu.veh_body_styl_id, -1),
+        count(1)
+    FROM atd_txdot_crash_locations AS atcl
+    JOIN atd_txdot_units AS atu ON (atu.crash_id = atcl.crash_id)
+    WHERE atcl.location_id <> 'None'
+        AND atcl.location_id = ANY(location_ids)
+    GROUP BY atcl.location_id, COALESCE(atu.veh_body_styl_id, -1);
+END;
+$function$;
+
+--
+-- Statement-level triggers, one per table and event (transition tables
+-- cannot be shared by several events). Updates that do not change any
+-- aggregated column are ignored.
+--
+CREATE OR REPLACE FUNCTION public.atd_txdot_crashes_refresh_location_totals()
+ RETURNS trigger
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+    location_ids character varying[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(DISTINCT atcloc.location_id) INTO location_ids
+        FROM new_rows JOIN atd_txdot_crash_locations AS atcloc ON (atcloc.crash_id = new_rows.crash_id);
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(DISTINCT atcloc.location_id) INTO location_ids
+        FROM old_rows JOIN atd_txdot_crash_locations AS atcloc ON (atcloc.crash_id = old_rows.crash_id);
+    ELSE
+        SELECT array_agg(DISTINCT atcloc.location_id) INTO location_ids
+        FROM old_rows
+        JOIN new_rows ON (new_rows.crash_id = old_rows.crash_id)
+        JOIN atd_txdot_crash_locations AS atcloc ON (atcloc.crash_id = new_rows.crash_id)
+        WHERE (old_rows.crash_date, old_rows.city_id, old_rows.apd_confirmed_death_count,
+               old_rows.sus_serious_injry_cnt, old_rows.est_comp_cost, old_rows.fhe_collsn_id)
+            IS DISTINCT FROM
+              (new_rows.crash_date, new_rows.city_id, new_rows.apd_confirmed_death_count,
+               new_rows.sus_serious_injry_cnt, new_rows.est_comp_cost, new_rows.fhe_collsn_id);
+    END IF;
+
+    IF location_ids IS NOT NULL THEN
+        PERFORM refresh_location_totals(location_ids);
+    END IF;
+    RETURN NULL;
+END;
+$function$;
+
+CREATE OR REPLACE FUNCTION public.atd_txdot_crash_locations_refresh_location_totals()
+ RETURNS trigger
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+    location_ids character varying[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(DISTINCT location_id) INTO location_ids FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(DISTINCT location_id) INTO location_ids FROM old_rows;
+    ELSE
+        SELECT array_agg(DISTINCT changed.location_id) INTO location_ids
+        FROM (
+            SELECT old_rows.location_id FROM old_rows
+            JOIN new_rows ON (new_rows.crash_location_id = old_rows.crash_location_id)
+            WHERE (old_rows.crash_id, old_rows.location_id) IS DISTINCT FROM (new_rows.crash_id, new_rows.location_id)
+            UNION ALL
+            SELECT new_rows.location_id FROM old_rows
+            JOIN new_rows ON (new_rows.crash_location_id = old_rows.crash_location_id)
+            WHERE (old_rows.crash_id, old_rows.location_id) IS DISTINCT FROM (new_rows.crash_id, new_rows.location_id)
+        ) AS changed;
+    END IF;
+
+    IF location_ids IS NOT NULL THEN
+        PERFORM refresh_location_totals(location_ids);
+    END IF;
+    RETURN NULL;
+END;
+$function$;
+
+CREATE OR REPLACE FUNCTION public.atd_apd_blueform_refresh_location_totals()
+ RETURNS trigger
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+    location_ids character varying[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(DISTINCT location_id) INTO location_ids FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(DISTINCT location_id) INTO location_ids FROM old_rows;
+    ELSE
+        SELECT array_agg(DISTINCT changed.location_id) INTO location_ids
+        FROM (
+            SELECT old_rows.location_id FROM old_rows
+            JOIN new_rows ON (new_rows.form_id = old_rows.form_id)
+            WHERE (old_rows.location_id, old_rows.date) IS DISTINCT FROM (new_rows.location_id, new_rows.date)
+            UNION ALL
+            SELECT new_rows.location_id FROM old_rows
+            JOIN new_rows ON (new_rows.form_id = old_rows.form_id)
+            WHERE (old_rows.location_id, old_rows.date) IS DISTINCT FROM (new_rows.location_id, new_rows.date)
+        ) AS changed;
+    END IF;
+
+    IF location_ids IS NOT NULL THEN
+        PERFORM refresh_location_totals(location_ids);
+    END IF;
+    RETURN NULL;
+END;
+$function$;
+
+CREATE OR REPLACE FUNCTION public.atd_txdot_units_refresh_location_totals()
+ RETURNS trigger
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+    location_ids character varying[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(DISTINCT atcl.location_id) INTO location_ids
+        FROM new_rows JOIN atd_txdot_crash_locations AS atcl ON (atcl.crash_id = new_rows.crash_id);
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(DISTINCT atcl.location_id) INTO location_ids
+        FROM old_rows JOIN atd_txdot_crash_locations AS atcl ON (atcl.crash_id = old_rows.crash_id);
+    ELSE
+        -- Compares the (crash, body style) pairs before and after the statement,
+        -- so updates of any other unit column are ignored
+        SELECT array_agg(DISTINCT atcl.location_id) INTO location_ids
+        FROM (
+            SELECT crash_id, veh_body_styl_id FROM old_rows
+            EXCEPT ALL
+            SELECT crash_id, veh_body_styl_id FROM new_rows
+            UNION ALL
+            (SELECT crash_id, veh_body_styl_id FROM new_rows
+             EXCEPT ALL
+             SELECT crash_id, veh_body_styl_id FROM old_rows)
+        ) AS changed
+        JOIN atd_txdot_crash_locations AS atcl ON (atcl.crash_id = changed.crash_id);
+    END IF;
+
+    IF location_ids IS NOT NULL THEN
+        PERFORM refresh_location_totals(location_ids);
+    END IF;
+    RETURN NULL;
+END;
+$function$;
@@ -0,0 +1,112 @@
+--
+-- Helpers of the incremental location triggers
+-- (atd_txdot_locations_updates_crash_locations, atd_txdot_crashes_updates_location
+-- and atd_apd_blueform_updates_location).
+--
+-- find_location_for_point returns the location whose polygon contains a
+-- point; when the point falls inside more than one polygon the lowest
+-- location_id wins, as in assign_cr3_collision_locations.
+--
+-- update_collision_locations_in_area re-evaluates only the crashes and
+-- blueforms whose point falls inside an area (ie. the symmetric difference of
+-- the old and new shape of a location). The bounding-box prefilter (&&) uses
+-- the expression indexes atd_txdot_crashes_point_primary_gist and
+-- atd_apd_blueform_point_gist, so the cost is proportional to the number of
+-- points in the area, not to the size of the tables.
+--
+--   SELECT update_collision_locations_in_area(shape) FROM atd_txdot_locations WHERE location_id = '...';
+--
+CREATE OR REPLACE FUNCTION public.find_location_for_point
+(point geometry)
+ RETURNS character varying
+ LANGUAGE sql
+ STABLE
+AS $function$
+SELECT
+  atd_loc.location_id
+FROM
+  atd_txdot_locations AS atd_loc
+WHERE
+  atd_loc.shape && point
+  AND ST_Contains(atd_loc.shape, point)
+ORDER BY atd_loc.location_id
+LIMIT 1
+$function$;
+
+CREATE OR REPLACE FUNCTION public.update_collision_locations_in_area
+(area geometry)
+ RETURNS integer
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+    cr3_rows integer;
+    noncr3_rows integer;
+BEGIN
+    IF area IS NULL OR ST_IsEmpty(area) THEN
+        RETURN 0;
+    END IF;
+
+    WITH matches AS (
+        SELECT
+            crash.crash_id,
+            find_location_for_point(ST_SetSRID(ST_MakePoint(crash.longitude_primary, crash.latitude_primary), 4326)) AS location_id
+        FROM atd_txdot_crashes AS crash
+        WHERE crash.latitude_primary IS NOT NULL
+            AND crash.longitude_primary IS NOT NULL
+            AND ST_SetSRID(ST_MakePoint(crash.longitude_primary, crash.latitude_primary), 4326) && area
+            AND ST_Intersects(area, ST_SetSRID(ST_MakePoint(crash.longitude_primary, crash.latitude_primary), 4326))
+    ), updated AS (
+        UPDATE atd_txdot_crashes AS cr3_crash
+        SET location_id = matches.location_id
+        FROM matches
+        WHERE cr3_crash.crash_id = matches.crash_id
+            AND cr3_crash.location_id IS DISTINCT FROM matches.location_id
+        RETURNING cr3_crash.crash_id, cr3_crash.location_id
+    ), unlinked AS (
+        -- Keep the crash/location links in sync: crashes left without a
+        -- location lose their link, the others are moved or linked
+        DELETE FROM atd_txdot_crash_locations AS crash_loc
+        USING updated
+        WHERE crash_loc.crash_id = updated.crash_id
+            AND updated.location_id IS NULL
+        RETURNING crash_loc.crash_id
+    ), relinked AS (
+        UPDATE atd_txdot_crash_locations AS crash_loc
+        SET location_id = updated.location_id,
+            last_update = now()
+        FROM updated
+        WHERE crash_loc.crash_id = updated.crash_id
+            AND updated.location_id IS NOT NULL
+        RETURNING crash_loc.crash_id
+    ), linked AS (
+        INSERT INTO atd_txdot_crash_locations (crash_id, location_id)
+        SELECT updated.crash_id, updated.location_id
+        FROM updated
+        WHERE updated.location_id IS NOT NULL
+            AND NOT EXISTS (
+                SELECT 1 FROM atd_txdot_crash_locations AS crash_loc
+                WHERE crash_loc.crash_id = updated.crash_id
+            )
+        RETURNING crash_id
+    )
+    SELECT count(*) INTO cr3_rows FROM updated;
+
+    UPDATE atd_apd_blueform AS blueform
+    SET location_id = matches.location_id
+    FROM (
+        SELECT
+            form.form_id,
+            find_location_for_point(ST_SetSRID(ST_MakePoint(form.longitude, form.latitude), 4326)) AS location_id
+        FROM atd_apd_blueform AS form
+        WHERE form.latitude IS NOT NULL
+            AND form.longitude IS NOT NULL
+            AND ST_SetSRID(ST_MakePoint(form.longitude, form.latitude), 4326) && area
+            AND ST_Intersects(area, ST_SetSRID(ST_MakePoint(form.longitude, form.latitude), 4326))
+    ) AS matches
+    WHERE blueform.form_id = matches.form_id
+        AND blueform.location_id IS DISTINCT FROM matches.location_id;
+
+    GET DIAGNOSTICS noncr3_rows = ROW_COUNT;
+    RETURN cr3_rows + noncr3_rows;
+END;
+$function$;
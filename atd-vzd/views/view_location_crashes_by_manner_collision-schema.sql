@@ -24,14 +24,12 @@ SET row_security = off;
 --
 
 CREATE VIEW public.view_location_crashes_by_manner_collision AS
- SELECT atcloc.location_id,
+ SELECT totals.location_id,
     atcol.collsn_desc,
-    count(1) AS count
-   FROM ((public.atd_txdot_crashes atc
-     LEFT JOIN public.atd_txdot__collsn_lkp atcol ON ((atcol.collsn_id = atc.fhe_collsn_id)))
-     LEFT JOIN public.atd_txdot_crash_locations atcloc ON ((atcloc.crash_id = atc.crash_id)))
-  WHERE ((1 = 1) AND (atcloc.location_id IS NOT NULL) AND ((atcloc.location_id)::text <> 'None'::text))
-  GROUP BY atcloc.location_id, atcol.collsn_desc;
+    sum(totals.count) AS count
+   FROM (public.atd_location_collision_totals totals
+     LEFT JOIN public.atd_txdot__collsn_lkp atcol ON ((atcol.collsn_id = totals.collsn_id)))
+  GROUP BY totals.location_id, atcol.collsn_desc;
 
 
 ALTER TABLE public.view_location_crashes_by_manner_collision OWNER TO atd_vz_data;
@@ -24,14 +24,12 @@ SET row_security = off;
 --
 
 CREATE VIEW public.view_location_crashes_by_veh_body_style AS
- SELECT atcl.location_id,
+ SELECT totals.location_id,
     atvbsl.veh_body_styl_desc,
-    count(1) AS count
-   FROM ((public.atd_txdot_units atu
-     LEFT JOIN public.atd_txdot__veh_body_styl_lkp atvbsl ON ((atu.veh_body_styl_id = atvbsl.veh_body_styl_id)))
-     LEFT JOIN public.atd_txdot_crash_locations atcl ON ((atcl.crash_id = atu.crash_id)))
-  WHERE ((1 = 1) AND (atcl.location_id IS NOT NULL) AND ((atcl.location_id)::text <> 'None'::text))
-  GROUP BY atcl.location_id, atvbsl.veh_body_styl_desc;
+    sum(totals.count) AS count
+   FROM (public.atd_location_body_style_totals totals
+     LEFT JOIN public.atd_txdot__veh_body_styl_lkp atvbsl ON ((atvbsl.veh_body_styl_id = totals.veh_body_styl_id)))
+  GROUP BY totals.location_id, atvbsl.veh_body_styl_desc;
 
 
 ALTER TABLE public.view_location_crashes_by_veh_body_style OWNER TO atd_vz_data;